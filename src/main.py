@@ -43,6 +43,12 @@ def main():
 	# Create session object to hold data and results
 	session = Session()
 
+	# Warm up the worker processes used by the analysis
+	# routines and release them when the application quits.
+	session.process_pool.start()
+	app.aboutToQuit.connect(session.process_pool.shutdown)
+	app.aboutToQuit.connect(session.curve_prefetcher.shutdown)
+
 	# Create and show main MDI window
 	ex = MainWindow(session)
 	ex.show()
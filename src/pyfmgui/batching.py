@@ -0,0 +1,134 @@
+# Import for multiprocessing
+import time
+import pickle
+import concurrent.futures
+# Import constants
+import pyfmgui.const as cts
+
+def run_timed(fn, args, chunk):
+    # Run a task on a block of items and measure
+    # the time spent by the worker processing it.
+    t0 = time.perf_counter()
+    results = fn(*args, chunk)
+    return results, time.perf_counter() - t0
+
+class ChunkSizeTuner:
+    '''
+    Estimates how many items should be sent in each task from the
+    measured cost per item, so every task takes roughly
+    const.chunk_target_time seconds in the worker.
+
+    :param nb_workers: Number of processes in the pool.
+    :type nb_workers: int
+
+    '''
+    def __init__(self, nb_workers):
+        self.nb_workers = nb_workers
+        self.cost_per_item = None
+
+    def update(self, nb_items, elapsed):
+        cost = elapsed / max(nb_items, 1)
+        if self.cost_per_item is None:
+            self.cost_per_item = cost
+        else:
+            # Exponential moving average to smooth the estimate
+            self.cost_per_item = 0.7 * self.cost_per_item + 0.3 * cost
+
+    def next_size(self, nb_remaining):
+        if self.cost_per_item is None:
+            size = cts.initial_chunk_size
+        else:
+            size = int(cts.chunk_target_time / max(self.cost_per_item, 1e-6))
+        # Keep enough tasks in the queue so all the workers
+        # stay busy until the end of the job.
+        balanced_size = nb_remaining // (self.nb_workers * cts.chunks_per_worker)
+        size = min(size, max(balanced_size, cts.initial_chunk_size), cts.max_chunk_size)
+        return max(1, min(size, nb_remaining))
+
+class IPCStats:
+    '''
+    Counts the bytes pickled to send the tasks of a job to the workers,
+    the arguments shared by all the tasks and the block of items of each.
+
+    :param args: Arguments passed to every task.
+    :type args: tuple
+    :param broadcast_nbytes: Size of the values published once for the job
+                             instead of being sent with every task.
+    :type broadcast_nbytes: int
+
+    '''
+    def __init__(self, args, broadcast_nbytes=0):
+        self.args_nbytes = len(pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL))
+        self.broadcast_nbytes = broadcast_nbytes
+        self.nb_tasks = 0
+        self.nbytes = 0
+
+    def add(self, chunk):
+        self.nb_tasks += 1
+        self.nbytes += self.args_nbytes + len(pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def summary(self):
+        if not self.nb_tasks:
+            return "IPC: no tasks sent"
+        text = f"IPC: {self.nbytes} bytes sent in {self.nb_tasks} tasks, {self.nbytes / self.nb_tasks:.0f} bytes per task"
+        if self.broadcast_nbytes:
+            text += f"; {self.broadcast_nbytes} bytes of parameters published once instead of {self.broadcast_nbytes * self.nb_tasks}"
+        return text
+
+def cancel_pending(futures):
+    # Cancel the tasks that did not start yet and
+    # return the ones still running in the workers.
+    return {future for future in futures if not future.cancel()}
+
+def iter_completed(futures, stop_event=None):
+    # Yields the futures as they complete, like as_completed, checking
+    # stop_event every const.stop_poll_interval seconds. Once it is set
+    # the queued tasks are cancelled and the running ones are not waited.
+    pending = set(futures)
+    while pending:
+        if stop_event is not None and stop_event.is_set():
+            cancel_pending(pending)
+            return
+        done, pending = concurrent.futures.wait(
+            pending, timeout=cts.stop_poll_interval, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            if not future.cancelled():
+                yield future
+
+def run_in_chunks(executor, fn, args, items, nb_workers, stop_event=None, ipc_stats=None):
+    '''
+    Process items in the executor calling fn(*args, chunk) on contiguous
+    blocks of items. Yields the list of results returned by each task
+    as soon as it is completed.
+
+    If stop_event is set no more tasks are submitted, the queued ones
+    are cancelled and only the results of the running ones are yielded.
+    The size of the tasks submitted is added to ipc_stats if given.
+    '''
+    tuner = ChunkSizeTuner(nb_workers)
+    max_in_flight = nb_workers * cts.chunks_per_worker
+    position = 0
+    pending = set()
+    while position < len(items) or pending:
+        if stop_event is not None and stop_event.is_set():
+            position = len(items)
+            pending = cancel_pending(pending)
+            if not pending:
+                break
+        while position < len(items) and len(pending) < max_in_flight:
+            size = tuner.next_size(len(items) - position)
+            chunk = items[position:position+size]
+            pending.add(executor.submit(run_timed, fn, args, chunk))
+            if ipc_stats is not None:
+                ipc_stats.add(chunk)
+            position += size
+        done, pending = concurrent.futures.wait(
+            pending, timeout=cts.stop_poll_interval, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            if future.cancelled():
+                continue
+            results, elapsed = future.result()
+            tuner.update(len(results), elapsed)
+            yield results
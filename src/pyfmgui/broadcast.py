@@ -0,0 +1,85 @@
+import pickle
+from collections import OrderedDict
+from multiprocessing import shared_memory
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import constants
+import pyfmgui.const as cts
+
+# Values already read by this worker process, keyed by the name
+# of their shared memory block. Each job publishes its own block.
+_worker_broadcasts = OrderedDict()
+
+class BroadcastRef:
+    '''
+    Handle sent to the workers instead of a value published by Broadcast,
+    only the name and the size of the shared memory block are pickled.
+
+    :param name: Name of the shared memory block holding the value.
+    :type name: str
+    :param nbytes: Size of the pickled value.
+    :type nbytes: int
+
+    '''
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+class Broadcast:
+    '''
+    Publishes a value shared by all the tasks of a job, e.g. the analysis
+    parameters. The value is pickled once to a shared memory block and the
+    tasks get a BroadcastRef, each worker unpickles it on its first task.
+    Used as a context manager, the block is released when the job ends.
+
+    If the block can not be created the value itself is returned and
+    pickled with every task, as it was without broadcast.
+
+    :param value: Value to publish, it must not change during the job.
+    :type value: object
+
+    '''
+    def __init__(self, value):
+        self.value = value
+        self.payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.nbytes = len(self.payload)
+        self._shm = None
+
+    def __enter__(self):
+        try:
+            self._shm = shared_memory.SharedMemory(create=True, size=max(self.nbytes, 1))
+            self._shm.buf[:self.nbytes] = self.payload
+        except Exception as error:
+            logger.info(f'Failed to publish the parameters in shared memory, sending them with every task: {error}')
+            self._shm = None
+            return self.value
+        return BroadcastRef(self._shm.name, self.nbytes)
+
+    @property
+    def published(self):
+        return self._shm is not None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+def resolve(value):
+    # Value published by Broadcast, read from shared memory the first
+    # time in each worker. Other values are returned unchanged.
+    if not isinstance(value, BroadcastRef):
+        return value
+    resolved = _worker_broadcasts.get(value.name)
+    if resolved is None:
+        shm = shared_memory.SharedMemory(name=value.name)
+        try:
+            payload = bytes(shm.buf[:value.nbytes])
+        finally:
+            shm.close()
+        resolved = pickle.loads(payload)
+        if len(_worker_broadcasts) >= cts.worker_broadcast_cache_size:
+            _worker_broadcasts.popitem(last=False)
+        _worker_broadcasts[value.name] = resolved
+    return resolved
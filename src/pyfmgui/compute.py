@@ -1,44 +1,200 @@
+from zipfile import ZipFile
 # Import for multiprocessing
-import concurrent.futures
-import contextlib
+from concurrent.futures.process import BrokenProcessPool
+import time
 from functools import partial
+import numpy as np
 # Import logging and get global logger
 import logging
 logger = logging.getLogger()
 # Import constants
 import pyfmgui.const as cts
+# Import chunked task submission
+from pyfmgui.batching import run_in_chunks, iter_completed, IPCStats
+# Import parameter broadcast to the workers
+from pyfmgui.broadcast import Broadcast, resolve
+# Import preprocessed curves cache
+from pyfmgui.curve_cache import get_disk_cache, preprocess_curve, get_force_curve
+# Import batched PoC detection
+from pyfmgui.poc import get_curves_poc
+# Import closed form Hertz fit
+from pyfmgui.hertz_fast import fit_hertz_closed_form, doHertzFitClosedForm
+# Import batched spectral routines
+from pyfmgui.spectral import spectral_routines, analyze_spectral_block, doSpectralRoutine
+# Import warm started fits
+from pyfmgui.warm_start import get_map_coords, get_tiles, get_seed, fit_seeded, WarmStartReport
+# Import result stores
+from pyfmgui.results import new_result_store
+# Get loadfile function from PyFMReader
+from pyfmreader import loadfile
 # Import predefined routines from PyFMRheo
 from pyfmrheo.routines.HertzFit import doHertzFit
 from pyfmrheo.routines.TingFit import doTingFit
-from pyfmrheo.routines.PiezoCharacterization import doPiezoCharacterization
-from pyfmrheo.routines.ViscousDragSteps import doViscousDragSteps
-from pyfmrheo.routines.MicrorheologyFFT import doMicrorheologyFFT
-from pyfmrheo.routines.MicrorheologySine import doMicrorheologySine
 
-def prepare_map_fdc(file, params, curve_idx):
-    try:
-        # Do fdc preprocessing
-        fdc_at_indx = file.getcurve(curve_idx)
-        fdc_at_indx.preprocess_force_curve(params['def_sens'], params['height_channel'])
-        if file.filemetadata['file_type'] in cts.jpk_file_extensions:
-            fdc_at_indx.shift_height()
-        return fdc_at_indx
-    except Exception as error:
-        return (file.filemetadata['Entry_filename'], curve_idx, error)
+# Files opened by this worker process, keyed by file path.
+# Each worker reads the headers of a file only once and then
+# loads the curves it is assigned directly from disk.
+_worker_files = {}
+
+def get_worker_file(file_path):
+    file = _worker_files.get(file_path)
+    if file is None:
+        if len(_worker_files) >= cts.worker_file_cache_size:
+            _worker_files.pop(next(iter(_worker_files)))
+        file = loadfile(file_path)
+        _worker_files[file_path] = file
+    return file
+
+def load_curves(file, curve_indices):
+    # Yields (curve_idx, fdc) pairs or (curve_idx, error) if the curve
+    # could not be loaded. UFF.getcurve opens the JPK archive for every
+    # curve, here it is opened once for the whole block of curves.
+    file_type = file.filemetadata['file_type']
+    if file_type in cts.jpk_file_extensions:
+        with open(file.filemetadata['file_path'], 'rb') as f:
+            afmfile = ZipFile(f)
+            for curve_idx in curve_indices:
+                try:
+                    yield curve_idx, file._loadcurve(curve_idx, afmfile, file_type)
+                except Exception as error:
+                    yield curve_idx, error
+    else:
+        for curve_idx in curve_indices:
+            try:
+                yield curve_idx, file.getcurve(curve_idx)
+            except Exception as error:
+                yield curve_idx, error
+
+def load_preprocessed_curves(file, params, curve_indices):
+    # Yields (curve_idx, fdc) pairs with the preprocessed curves, or
+    # (curve_idx, error) if the curve could not be loaded. The curves
+    # are yielded in the order of curve_indices.
+    file_path = file.filemetadata['file_path']
+    shift_height = file.filemetadata['file_type'] in cts.jpk_file_extensions
+    cache_params = (params['def_sens'], params['height_channel'], shift_height)
+    disk_cache = get_disk_cache()
+    # Curves preprocessed before with the same parameters
+    # are read from the cache, the rest are decoded.
+    cached_curves = {}
+    curves_to_load = []
+    for curve_idx in curve_indices:
+        fdc = disk_cache.get(file_path, curve_idx, *cache_params) if disk_cache is not None else None
+        if fdc is None:
+            curves_to_load.append(curve_idx)
+        else:
+            cached_curves[curve_idx] = fdc
+    # The curves to load are decoded in the same order, one at a time
+    # as they are needed, so they are interleaved with the cached ones.
+    loaded_curves = load_curves(file, curves_to_load)
+    for curve_idx in curve_indices:
+        if curve_idx in cached_curves:
+            yield curve_idx, cached_curves[curve_idx]
+            continue
+        _, fdc = next(loaded_curves)
+        if isinstance(fdc, Exception):
+            yield curve_idx, fdc
+            continue
+        # Curves are preprocessed one by one on purpose. Preprocessing is a
+        # single scaling per segment, stacking the segments of the block to
+        # do it in one operation copies the data and was measured slower.
+        try:
+            preprocess_curve(file, curve_idx, params['def_sens'], params['height_channel'], force_curve=fdc)
+        except Exception as error:
+            yield curve_idx, error
+            continue
+        if disk_cache is not None:
+            disk_cache.put(file_path, curve_idx, *cache_params, fdc)
+        yield curve_idx, fdc
+
+def process_map_chunk(file_path, params, curve_indices):
+    # Load, preprocess and analyze a block of curves in the worker.
+    # Only the analysis results are sent back to the main process.
+    params = resolve(params)
+    file = get_worker_file(file_path)
+    file_id = file.filemetadata['Entry_filename']
+    chunk_results = []
+    force_curves = []
+    block_routine = get_block_routine(params)
+    for curve_idx, fdc in load_preprocessed_curves(file, params, curve_indices):
+        if isinstance(fdc, Exception):
+            chunk_results.append((file_id, curve_idx, fdc, 'error'))
+        elif block_routine is not None:
+            force_curves.append(fdc)
+        else:
+            chunk_results.append(analyze_fdc(params, fdc))
+    # Some routines process the whole block of curves at once
+    if force_curves:
+        for fdc, result in zip(force_curves, block_routine(force_curves, params)):
+            if isinstance(result, Exception):
+                chunk_results.append((file_id, fdc.curve_index, result, 'error'))
+            else:
+                chunk_results.append((file_id, fdc.curve_index, result))
+    return chunk_results
+
+def process_tile_chunk(file_path, params, tiles):
+    # Fit the curves of a block of tiles in the worker, in the order of
+    # the tiles, each fit is started from its fitted neighbours.
+    # Returns the list of results of each tile.
+    params = resolve(params)
+    file = get_worker_file(file_path)
+    file_id = file.filemetadata['Entry_filename']
+    chunk_results = []
+    for tile in tiles:
+        neighbours = dict(tile)
+        fitted = {}
+        tile_results = []
+        for curve_idx, fdc in load_preprocessed_curves(file, params, list(neighbours.keys())):
+            if isinstance(fdc, Exception):
+                tile_results.append((file_id, curve_idx, fdc, 'error'))
+                continue
+            seed = get_seed([fitted[idx] for idx in neighbours[curve_idx] if idx in fitted], params['method'])
+            try:
+                fitted[curve_idx] = fit_seeded(fdc, params, seed)
+                tile_results.append((file_id, curve_idx, fitted[curve_idx]))
+            except Exception as error:
+                tile_results.append((file_id, curve_idx, error, 'error'))
+        chunk_results.append(tile_results)
+    return chunk_results
+
+def process_poc_chunk(file_path, params, curve_indices):
+    # Find the PoC of a block of curves in the worker, returns
+    # a list of (curve_idx, PoC height) pairs.
+    params = resolve(params)
+    file = get_worker_file(file_path)
+    loaded = [(curve_idx, fdc) for curve_idx, fdc in load_preprocessed_curves(file, params, curve_indices)]
+    force_curves = [fdc for _, fdc in loaded if not isinstance(fdc, Exception)]
+    pocs = iter(get_curves_poc(force_curves, params))
+    return [(curve_idx, np.nan if isinstance(fdc, Exception) else next(pocs)) for curve_idx, fdc in loaded]
+
+def is_closed_form_fit(param_dict):
+    return param_dict['method'] == 'HertzFit' and param_dict.get('fit_method') == 'closed form'
+
+def get_block_routine(param_dict):
+    # Routine processing a list of curves at once, if the method has one
+    if is_closed_form_fit(param_dict):
+        return fit_hertz_closed_form
+    elif param_dict['method'] in spectral_routines:
+        return analyze_spectral_block
+    return None
 
 def analyze_fdc(param_dict, fdc):
-    # Create map relating methods to compute routine
+    param_dict = resolve(param_dict)
+    # Create map relating methods to compute routine, the spectral
+    # methods give the same results as the PyFMRheo routines
     method_routines = {
         "HertzFit":doHertzFit,
         "TingFit":doTingFit,
-        "PiezoChar":doPiezoCharacterization,
-        "VDrag":doViscousDragSteps,
-        "Microrheo":doMicrorheologyFFT,
-        "MicrorheoSine":doMicrorheologySine
+        "PiezoChar":doSpectralRoutine,
+        "VDrag":doSpectralRoutine,
+        "Microrheo":doSpectralRoutine,
+        "MicrorheoLockIn":doSpectralRoutine,
+        "MicrorheoSine":doSpectralRoutine
     }
     # Process FDC with routine
     try:
         routine = method_routines.get(param_dict['method'])
+        if is_closed_form_fit(param_dict):
+            routine = doHertzFitClosedForm
         return (fdc.file_id, fdc.curve_index, routine(fdc, param_dict))
     except Exception as error:
         return (fdc.file_id, fdc.curve_index, error, 'error')
@@ -50,6 +206,7 @@ def get_method_to_session_vars(session):
         "PiezoChar":session.piezo_char_results,
         "VDrag":session.vdrag_results,
         "Microrheo":session.microrheo_results,
+        "MicrorheoLockIn":session.microrheo_results,
         "MicrorheoSine":session.microrheo_results
     }
 
@@ -66,7 +223,7 @@ def clear_file_results(session, method, file_id):
     if file_id in session_save_var:
         session_save_var.pop(file_id)
 
-def save_file_results(session, params, file_results):
+def save_file_results(session, params, file_results, keep_objects=False):
     # Create map relating methods to where they should be saved in the session
     method_session_vars = get_method_to_session_vars(session)
     # Get var to save results in session
@@ -81,17 +238,18 @@ def save_file_results(session, params, file_results):
             file_id, curve_idx, analysis_result, _ = item
         else:
             file_id, curve_idx, analysis_result = item
-        if file_id in session_save_var.keys():
-            session_save_var[file_id].append((curve_idx, analysis_result))
-        else:
-            session_save_var[file_id] = [(curve_idx, analysis_result)]
+        if file_id not in session_save_var.keys():
+            session_save_var[file_id] = new_result_store(params['method'], keep_objects)
+        session_save_var[file_id].add(curve_idx, analysis_result)
 
-def process_sfc(session, params, filedict, method, progress_callback, range_callback, step_callback):
+def process_sfc(session, params, filedict, method, progress_callback, range_callback, step_callback, results_callback, stop_event):
     # Get curves to process for each file to process
     file_ids = filedict.keys()
     fdc_to_process = []
     step_callback.emit('Step 1/2: Preprocessing')
     for file_id in file_ids:
+        if stop_event.is_set():
+            break
         # Get fileid
         file = filedict[file_id]
         # Clear
@@ -99,12 +257,8 @@ def process_sfc(session, params, filedict, method, progress_callback, range_call
         # Get current selected index
         curve_idx = session.current_curve_index
         try:
-            # Get force distance curve at index
-            fdc_at_indx = file.getcurve(curve_idx)
-            # Do fdc preprocessing
-            fdc_at_indx.preprocess_force_curve(params['def_sens'], params['height_channel'])
-            if session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
-                fdc_at_indx.shift_height()
+            # Get preprocessed force distance curve at index
+            fdc_at_indx = get_force_curve(file, curve_idx, params['def_sens'], params['height_channel'])
             fdc_to_process.append(fdc_at_indx)
         except Exception as error:
             logger.info(f"Failed to preprocess curve {curve_idx} in file {file.filemetadata['Entry_filename']}: {error}")
@@ -114,76 +268,121 @@ def process_sfc(session, params, filedict, method, progress_callback, range_call
     count = 0
     range_callback.emit(len(fdc_to_process))
     step_callback.emit('Step 2/2: Computing')
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = [executor.submit(analyze_fdc, params, fdc) for fdc in fdc_to_process]
-        with contextlib.suppress(concurrent.futures.TimeoutError):
-            for future in concurrent.futures.as_completed(futures):
-                file_results.append(future.result())
-                count+=1
+    executor = session.process_pool
+    # The parameters are published once, the tasks only carry the curves
+    with Broadcast(params) as params_ref:
+        futures = [executor.submit(analyze_fdc, params_ref, fdc) for fdc in fdc_to_process]
+        for future in iter_completed(futures, stop_event):
+            file_results.append(future.result())
+            count+=1
+            progress_callback.emit(count)
+    # Save results, keep the fit objects of single curves
+    save_file_results(session, params, file_results, keep_objects=True)
+    for file_id in filedict.keys():
+        results_callback.emit(file_id)
+
+def use_warm_start(params):
+    return params.get('warm_start', False) and params['method'] in ('HertzFit', 'TingFit') and not is_closed_form_fit(params)
+
+def run_map_tasks(executor, file, params, stop_event, params_ref=None, ipc_stats=None):
+    # Yields the list of results of each task for a force map. With warm
+    # start the map is processed in tiles, the results of each task are
+    # flattened, so both modes yield one result per curve. The tasks get
+    # params_ref instead of the parameters if they were broadcast.
+    file_path = file.filemetadata['file_path']
+    nb_curves = file.filemetadata['Entry_tot_nb_curve']
+    args = (file_path, params if params_ref is None else params_ref)
+    if not use_warm_start(params):
+        yield from run_in_chunks(executor, process_map_chunk, args, list(range(nb_curves)), executor.max_workers, stop_event, ipc_stats)
+        return
+    tiles = get_tiles(get_map_coords(file), cts.warm_start_tile_size, nb_curves)
+    for chunk_results in run_in_chunks(executor, process_tile_chunk, args, tiles, executor.max_workers, stop_event, ipc_stats):
+        yield [file_result for tile_results in chunk_results for file_result in tile_results]
+
+def process_maps(session, params, filedict, method, progress_callback, range_callback, step_callback, results_callback, stop_event):
+    executor = session.process_pool
+    # The parameters are published once for all the files,
+    # the tasks only carry the indices of their curves.
+    broadcast = Broadcast(params)
+    with broadcast as params_ref:
+        for file_id, file in filedict.items():
+            if stop_event.is_set():
+                break
+            logger.info(f"Processing file: {file_id}")
+            # Delete previous results for the file
+            clear_file_results(session, method, file_id)
+            nb_curves = file.filemetadata['Entry_tot_nb_curve']
+            range_callback.emit(nb_curves)
+            step_callback.emit('Computing')
+            # Each task loads, preprocesses and analyzes a block of curves
+            # in the worker, so the curve data never goes through IPC.
+            count = 0
+            last_emit = time.perf_counter()
+            warm_start_report = WarmStartReport()
+            ipc_stats = IPCStats((file.filemetadata['file_path'], params_ref), broadcast.nbytes if broadcast.published else 0)
+            for chunk_results in run_map_tasks(executor, file, params, stop_event, params_ref, ipc_stats):
+                for file_result in chunk_results:
+                    if 'error' in file_result:
+                        logger.info(f"Failed to process curve {file_result[1]} in file {file_result[0]}: {file_result[2]}")
+                    else:
+                        warm_start_report.add(file_result[2])
+                # Save the results as they arrive so they can be
+                # inspected while the rest of the map is computed.
+                save_file_results(session, params, chunk_results, cts.keep_map_fit_objects)
+                count+=len(chunk_results)
                 progress_callback.emit(count)
-    # Save results
-    save_file_results(session, params, file_results)
-
-def process_maps(session, params, filedict, method, progress_callback, range_callback, step_callback):
-    # Process files and curves
-    for file_id, file in filedict.items():
-        logger.info(f"Processing file: {file_id}")
-        # Delete previous results for the file
-        clear_file_results(session, method, file_id)
-        # Prepare all fdc to process
-        fdc_to_process = []
-        errors = []
-        # Prepare curves
-        # Not sure if paralelization helps much, it is mostly limited
-        # by file access (opening / closing file)
-        raw_fdc_to_process = []
-        count = 0
-        nb_curves = file.filemetadata['Entry_tot_nb_curve']
-        range_callback.emit(nb_curves)
-        step_callback.emit('Step 1/2: Preprocessing')
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            futures = [executor.submit(prepare_map_fdc, file, params, curveidx) for curveidx in range(nb_curves)]
-            with contextlib.suppress(concurrent.futures.TimeoutError):
-                for future in concurrent.futures.as_completed(futures):
-                    raw_fdc_to_process.append(future.result())
-                    count+=1
-                    progress_callback.emit(count)
-        # Check for errors
-        for item in raw_fdc_to_process:
-            if type(item) is tuple:
-                errors.append(item)
-                logger.info(f"Failed to preprocess curve {item[1]} in file {item[0]}: {item[2]}")
-            else: fdc_to_process.append(item)
-        progress_callback.emit(0)
-        # Process curves
-        file_results = []
-        count = 0
-        range_callback.emit(len(fdc_to_process))
-        step_callback.emit('Step 2/2: Computing')
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            # file_results = executor.map(partial(analyze_fdc, params), fdc_to_process)
-            futures = [executor.submit(analyze_fdc, params, fdc) for fdc in fdc_to_process]
-            with contextlib.suppress(concurrent.futures.TimeoutError):
-                for future in concurrent.futures.as_completed(futures):
-                    file_results.append(future.result())
-                    count+=1
-                    progress_callback.emit(count)
-        file_results = list(file_results)
-        for file_result in file_results:
-            if 'error' in file_result:
-                logger.info(f"Failed to process curve {file_result[1]} in file {file_result[0]}: {file_result[2]}")
-        # Extend file results with the errors encountered in preprocessing
-        file_results.extend(errors)
-        # Save results
-        save_file_results(session, params, file_results)
-        # Reset pbar
-        progress_callback.emit(0)
-
-def compute(session, params, filedict, method, progress_callback, range_callback, step_callback):
+                # Do not flood the GUI thread with updates
+                if time.perf_counter() - last_emit >= cts.results_emit_interval:
+                    results_callback.emit(file_id)
+                    last_emit = time.perf_counter()
+            results_callback.emit(file_id)
+            if use_warm_start(params):
+                logger.info(f"{warm_start_report.summary()} in file {file_id}")
+            logger.info(f"{ipc_stats.summary()} in file {file_id}")
+            if stop_event.is_set():
+                logger.info(f"Cancelled after processing {count} of {nb_curves} curves in file {file_id}")
+            # Reset pbar
+            progress_callback.emit(0)
+
+def compute_poc_map(session, params, file, progress_callback, range_callback, step_callback, results_callback, stop_event):
+    # Find the PoC of every curve of a force map, the
+    # values are saved in session.poc_maps by curve index.
+    executor = session.process_pool
+    file_id = file.filemetadata['Entry_filename']
+    nb_curves = file.filemetadata['Entry_tot_nb_curve']
+    poc_map = np.full(nb_curves, np.nan)
+    range_callback.emit(nb_curves)
+    step_callback.emit('Computing PoC')
+    count = 0
+    broadcast = Broadcast(params)
+    try:
+        with broadcast as params_ref:
+            args = (file.filemetadata['file_path'], params_ref)
+            ipc_stats = IPCStats(args, broadcast.nbytes if broadcast.published else 0)
+            for chunk_results in run_in_chunks(executor, process_poc_chunk, args, list(range(nb_curves)), executor.max_workers, stop_event, ipc_stats):
+                for curve_idx, poc in chunk_results:
+                    poc_map[curve_idx] = poc
+                count+=len(chunk_results)
+                progress_callback.emit(count)
+        logger.info(f"{ipc_stats.summary()} in file {file_id}")
+    except BrokenProcessPool:
+        # One of the workers died, get a fresh pool for the next job
+        session.process_pool.restart()
+        raise
+    session.poc_maps[file_id] = poc_map
+    results_callback.emit(file_id)
+    return poc_map
+
+def compute(session, params, filedict, method, progress_callback, range_callback, step_callback, results_callback, stop_event):
     # Check if the file is a force map
     fv_flag = any(file.isFV for file in filedict.values())
     # Call the proper method to process the file
-    if not params['compute_all_curves'] or not fv_flag:
-        process_sfc(session, params, filedict, method, progress_callback, range_callback, step_callback)
-    else:
-        process_maps(session, params, filedict, method, progress_callback, range_callback, step_callback)
+    try:
+        if not params['compute_all_curves'] or not fv_flag:
+            process_sfc(session, params, filedict, method, progress_callback, range_callback, step_callback, results_callback, stop_event)
+        else:
+            process_maps(session, params, filedict, method, progress_callback, range_callback, step_callback, results_callback, stop_event)
+    except BrokenProcessPool:
+        # One of the workers died, get a fresh pool for the next job
+        session.process_pool.restart()
+        raise
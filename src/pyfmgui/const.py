@@ -1,3 +1,4 @@
+import os
 import logging
 import pyqtgraph.parametertree.parameterTypes as pTypes
 from .canti_list import canti_list
@@ -20,8 +21,43 @@ SADER_API_version = 'Python API/0.20'
 SADER_API_type = 'text/xml'
 SADER_API_url = 'https://sadermethod.org/api/1.1/api.php'
 
+# GUI params ######################################################
+update_debounce_interval = 150 # ms, wait after a parameter change before updating the plots
+
 # MULTIPROCESSING params ##########################################
 timeout_time = 20 # s
+pool_max_workers = None # None --> number of cores - 1
+pool_warmup_delay = 0.5 # s
+initial_chunk_size = 4 # curves
+max_chunk_size = 256 # curves
+chunk_target_time = 0.5 # s
+chunks_per_worker = 2
+worker_file_cache_size = 4 # files
+worker_broadcast_cache_size = 4 # jobs, parameters kept by each worker
+results_emit_interval = 1 # s
+stop_poll_interval = 0.2 # s
+keep_map_fit_objects = False # Keep full fit objects for force maps
+warm_start_tile_size = 8 # pixels per side of the tiles fitted in order with warm start
+
+# EXPORT params ###################################################
+parquet_compression = 'zstd'
+hdf_complib = 'blosc'
+hdf_complevel = 5 # 0-9
+hdf_min_itemsize = 512 # characters in text columns
+export_block_rows = 100000 # rows written at once
+export_preview_rows = 50
+
+# CURVE CACHE params ##############################################
+curve_cache_enabled = True
+curve_cache_dir = os.path.join(os.path.expanduser('~'), '.pyfmgui', 'curve_cache')
+curve_cache_max_bytes = 4 * 1024**3 # bytes
+curve_cache_evict_fraction = 0.1 # free space left after eviction
+curve_cache_hash_bytes = 1024**2 # bytes hashed at the start and end of each file
+curve_memory_cache_max_bytes = 256 * 1024**2 # bytes
+prefetch_enabled = True
+prefetch_radius = 1 # pixels --> 1: 8 neighbour curves, 2: 24 neighbour curves
+prefetch_max_workers = 2 # threads
+piezo_char_cache_suffix = '.calibration.npz' # piezo characterization cache, saved next to its CSV
 
 # Default parameters ##############################################
 
@@ -48,7 +84,7 @@ class AnalysisParams(pTypes.GroupParameter):
 
         if self.mode == "microrheo":
             self.addChildren([
-                {'name': 'Method', 'type': 'list', 'limits':['FFT', 'Sine Fit']},
+                {'name': 'Method', 'type': 'list', 'limits':['FFT', 'Lock-in', 'Sine Fit']},
                 {'name': 'Computed Working Indentation', 'type': 'float', 'value': None, 'units':'nm', 'readonly':True},
                 {'name': 'Working Indentation', 'type': 'float', 'value': None, 'units':'nm'},
                 {'name': 'Overwrite Working Ind.', 'type': 'bool', 'value':False},
@@ -89,13 +125,22 @@ class AnalysisParams(pTypes.GroupParameter):
             self.param('Abs. Max Offset').show(True)
 
 class HertzFitParams(pTypes.GroupParameter):
-    def __init__(self, **opts):
+    def __init__(self, fit_options=False, **opts):
         pTypes.GroupParameter.__init__(self, **opts)
         self.addChildren([
             {'name': 'Poisson Ratio', 'type': 'float', 'value': 0.5},
             {'name': 'PoC Method', 'type': 'list', 'limits':['RoV', 'regulaFalsi']},
             {'name': 'PoC Window', 'type': 'int', 'value': 350, 'units':'nm'},
-            {'name': 'Sigma', 'type': 'int', 'value': 0},
+            {'name': 'Sigma', 'type': 'int', 'value': 0}
+        ])
+        # Options of the elasticity fit, the other widgets
+        # only use the Hertz fit to find the PoC
+        if fit_options:
+            self.addChildren([
+                {'name': 'Fit Method', 'type': 'list', 'limits': ['lmfit', 'closed form']},
+                {'name': 'Warm Start', 'type': 'bool', 'value': False}
+            ])
+        self.addChildren([
             {'name': 'Fit Range Type', 'type': 'list', 'limits': ['full', 'indentation', 'force']},
             {'name': 'Min Indentation', 'type': 'float', 'value': None, 'units':'nm'},
             {'name': 'Max Indentation', 'type': 'float', 'value': None, 'units':'nm'},
@@ -165,6 +210,7 @@ class TingFitParams(pTypes.GroupParameter):
             {'name': 'PoC Method', 'type': 'list', 'limits':['RoV', 'regulaFalsi']},
             {'name': 'PoC Window', 'type': 'int', 'value': 350, 'units':'nm'},
             {'name': 'Sigma', 'type': 'int', 'value': 0},
+            {'name': 'Warm Start', 'type': 'bool', 'value': False},
             {'name': 'Fit Range Type', 'type': 'list', 'limits': ['full', 'indentation', 'force']},
             {'name': 'Min Indentation', 'type': 'float', 'value': None, 'units':'nm'},
             {'name': 'Max Indentation', 'type': 'float', 'value': None, 'units':'nm'},
@@ -317,7 +363,7 @@ sader_method_params = {'name': 'Calibration Params', 'type': 'group', 'children'
 
 data_viewer_params = [plot_params]
 
-hertzfit_params = [general_params, AnalysisParams(mode='hertzfit', name='Analysis Params'), HertzFitParams(name='Hertz Fit Params')]
+hertzfit_params = [general_params, AnalysisParams(mode='hertzfit', name='Analysis Params'), HertzFitParams(fit_options=True, name='Hertz Fit Params')]
 
 thermaltune_params = [ambient_params, CantileverParams(name='Cantilever Params'), sader_method_params]
 
@@ -0,0 +1,331 @@
+import os
+import copy
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import constants
+import pyfmgui.const as cts
+
+# Arrays computed by the preprocessing, saved in the .npy file
+segment_arrays = ('zheight', 'vdeflection', 'time')
+segment_lists = ('extend_segments', 'retract_segments', 'pause_segments', 'modulation_segments')
+# Bump when the layout of the cached curves changes
+cache_version = 2
+
+# Hashes of the files already fingerprinted, keyed
+# by (file path, file size, modification time).
+_file_hashes = {}
+
+def get_file_hash(file_path):
+    # Hash the size, the modification time and the first and last
+    # bytes of the file, without reading the whole file. The
+    # modification time invalidates the cached curves of files edited
+    # or exported again with the same size, the dataset keeps its
+    # hash if it is moved or copied preserving its timestamps.
+    stat = os.stat(file_path)
+    stat_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    file_hash = _file_hashes.get(stat_key)
+    if file_hash is None:
+        sha = hashlib.sha1(f'{stat.st_size}-{stat.st_mtime_ns}'.encode())
+        with open(file_path, 'rb') as f:
+            sha.update(f.read(cts.curve_cache_hash_bytes))
+            if stat.st_size > cts.curve_cache_hash_bytes:
+                f.seek(max(stat.st_size - cts.curve_cache_hash_bytes, cts.curve_cache_hash_bytes))
+                sha.update(f.read())
+        file_hash = sha.hexdigest()
+        _file_hashes[stat_key] = file_hash
+    return file_hash
+
+def get_curve_key(file_path, curve_idx, deflection_sens, height_channel, shift_height):
+    key = f'{get_file_hash(file_path)}-{curve_idx}-{deflection_sens!r}-{height_channel}-{shift_height}-{cache_version}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def split_force_curve(force_curve):
+    # Separate the preprocessed arrays from the rest of the curve.
+    # Returns the curve without data and the arrays concatenated.
+    skeleton = copy.copy(force_curve)
+    arrays = []
+    offsets = []
+    position = 0
+    for segments_key in segment_lists:
+        segments = []
+        for segment_id, segment in getattr(force_curve, segments_key):
+            segment = copy.copy(segment)
+            # Raw data is not needed once the curve is preprocessed
+            segment.segment_raw_data = None
+            segment.segment_formated_data = None
+            segment_offsets = {}
+            for name in segment_arrays:
+                values = getattr(segment, name)
+                if values is None:
+                    continue
+                values = np.asarray(values).ravel()
+                segment_offsets[name] = (position, position + len(values))
+                position += len(values)
+                arrays.append(values)
+                setattr(segment, name, None)
+            segments.append((segment_id, segment))
+            offsets.append(segment_offsets)
+        setattr(skeleton, segments_key, segments)
+    skeleton.cache_offsets = offsets
+    data = np.concatenate(arrays) if arrays else np.empty(0)
+    return skeleton, data
+
+def clone_force_curve(force_curve, keep_raw_data=True):
+    # Copy the curve and its segments but not the arrays, so the
+    # segment attributes can be replaced without changing the original.
+    clone = copy.copy(force_curve)
+    for segments_key in segment_lists:
+        segments = [(segment_id, copy.copy(segment)) for segment_id, segment in getattr(force_curve, segments_key)]
+        if not keep_raw_data:
+            for _, segment in segments:
+                segment.segment_raw_data = None
+                segment.segment_formated_data = None
+        setattr(clone, segments_key, segments)
+    return clone
+
+def get_force_curve_nbytes(force_curve):
+    nbytes = 0
+    for segments_key in segment_lists:
+        for _, segment in getattr(force_curve, segments_key):
+            for name in segment_arrays:
+                values = getattr(segment, name)
+                if values is not None:
+                    nbytes += np.asarray(values).nbytes
+    return nbytes
+
+def join_force_curve(skeleton, data):
+    # Inverse of split_force_curve, the arrays are views of data
+    offsets = skeleton.__dict__.pop('cache_offsets')
+    segments = [
+        segment for segments_key in segment_lists
+        for _, segment in getattr(skeleton, segments_key)
+    ]
+    for segment, segment_offsets in zip(segments, offsets):
+        for name, (start, stop) in segment_offsets.items():
+            setattr(segment, name, data[start:stop])
+    return skeleton
+
+class CurveDiskCache:
+    '''
+    Cache of preprocessed force curves saved on disk.
+
+    Each curve is saved as a pickle with its metadata and a .npy file with
+    its arrays, loaded memory mapped. Entries are keyed by the content of
+    the file, the curve index and the preprocessing parameters. The least
+    recently used entries are removed when the cache exceeds max_bytes.
+
+    :param cache_dir: Directory where the curves are saved.
+    :type cache_dir: str
+    :param max_bytes: Maximum size of the cache in bytes.
+    :type max_bytes: int
+
+    '''
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._written_bytes = 0
+        self._lock = threading.Lock()
+
+    def _get_paths(self, key):
+        entry_dir = os.path.join(self.cache_dir, key[:2])
+        return entry_dir, os.path.join(entry_dir, f'{key}.pkl'), os.path.join(entry_dir, f'{key}.npy')
+
+    def get(self, file_path, curve_idx, deflection_sens, height_channel, shift_height):
+        try:
+            key = get_curve_key(file_path, curve_idx, deflection_sens, height_channel, shift_height)
+        except OSError:
+            return None
+        _, skeleton_path, data_path = self._get_paths(key)
+        if not os.path.exists(skeleton_path):
+            return None
+        try:
+            with open(skeleton_path, 'rb') as f:
+                skeleton = pickle.load(f)
+            # Copy on write, the cached file is never modified
+            data = np.load(data_path, mmap_mode='c').view(np.ndarray)
+            # Mark the entry as recently used
+            os.utime(skeleton_path)
+        except Exception as error:
+            logger.info(f'Failed to load cached curve {curve_idx} of {file_path}: {error}')
+            self._remove(skeleton_path, data_path)
+            return None
+        return join_force_curve(skeleton, data)
+
+    def put(self, file_path, curve_idx, deflection_sens, height_channel, shift_height, force_curve):
+        try:
+            key = get_curve_key(file_path, curve_idx, deflection_sens, height_channel, shift_height)
+            entry_dir, skeleton_path, data_path = self._get_paths(key)
+            os.makedirs(entry_dir, exist_ok=True)
+            skeleton, data = split_force_curve(force_curve)
+            # Write to temporary files and rename them, so other processes
+            # never read half written entries. The skeleton is written
+            # last, an entry is complete once it exists.
+            suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(data_path + suffix, 'wb') as f:
+                np.save(f, data)
+            os.replace(data_path + suffix, data_path)
+            with open(skeleton_path + suffix, 'wb') as f:
+                pickle.dump(skeleton, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(skeleton_path + suffix, skeleton_path)
+        except Exception as error:
+            logger.info(f'Failed to cache curve {curve_idx} of {file_path}: {error}')
+            return
+        with self._lock:
+            self._written_bytes += data.nbytes
+            check_size = self._written_bytes > self.max_bytes * cts.curve_cache_evict_fraction
+            if check_size:
+                self._written_bytes = 0
+        if check_size:
+            self.evict()
+
+    def _remove(self, *paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                # Missing or still memory mapped on Windows
+                pass
+
+    def evict(self):
+        # Remove the least recently used entries until the cache
+        # is below max_bytes, leaving some free space.
+        entries = []
+        total_bytes = 0
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if not file_name.endswith('.pkl'):
+                    continue
+                skeleton_path = os.path.join(root, file_name)
+                data_path = skeleton_path[:-4] + '.npy'
+                try:
+                    last_used = os.path.getmtime(skeleton_path)
+                    nbytes = os.path.getsize(skeleton_path) + os.path.getsize(data_path)
+                except OSError:
+                    continue
+                entries.append((last_used, nbytes, skeleton_path, data_path))
+                total_bytes += nbytes
+        if total_bytes <= self.max_bytes:
+            return
+        target_bytes = self.max_bytes * (1 - cts.curve_cache_evict_fraction)
+        for _, nbytes, skeleton_path, data_path in sorted(entries):
+            if total_bytes <= target_bytes:
+                break
+            self._remove(skeleton_path, data_path)
+            total_bytes -= nbytes
+
+    def clear(self):
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                self._remove(os.path.join(root, file_name))
+
+class CurveMemoryCache:
+    '''
+    Least recently used cache of preprocessed force curves kept in
+    memory, shared by all the widgets. Curves are returned as copies
+    sharing the arrays, so callers can replace segment attributes.
+
+    :param max_bytes: Maximum size of the cached arrays in bytes.
+    :type max_bytes: int
+
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._curves = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._curves.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._curves.move_to_end(key)
+            self.hits += 1
+        return clone_force_curve(entry[0])
+
+    def __contains__(self, key):
+        # Does not count as a hit or a miss
+        return key in self._curves
+
+    def put(self, key, force_curve):
+        # Raw channels are not needed once the curve is preprocessed
+        force_curve = clone_force_curve(force_curve, keep_raw_data=False)
+        nbytes = get_force_curve_nbytes(force_curve)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._curves.pop(key, None)
+            if old_entry is not None:
+                self.nbytes -= old_entry[1]
+            self._curves[key] = (force_curve, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, old_nbytes) = self._curves.popitem(last=False)
+                self.nbytes -= old_nbytes
+
+    def clear(self):
+        with self._lock:
+            self._curves.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'curves': len(self._curves), 'nbytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+# Caches used by this process, created when first needed
+_memory_cache = None
+_disk_cache = None
+
+def get_memory_cache():
+    global _memory_cache
+    if _memory_cache is None:
+        _memory_cache = CurveMemoryCache(cts.curve_memory_cache_max_bytes)
+    return _memory_cache
+
+def get_disk_cache():
+    global _disk_cache
+    if not cts.curve_cache_enabled:
+        return None
+    if _disk_cache is None:
+        _disk_cache = CurveDiskCache(cts.curve_cache_dir, cts.curve_cache_max_bytes)
+    return _disk_cache
+
+def preprocess_curve(file, curve_idx, deflection_sens, height_channel, shift_height=True, force_curve=None):
+    # Load (unless force_curve is given) and preprocess a curve.
+    # shift_height is only applied to JPK files.
+    if force_curve is None:
+        force_curve = file.getcurve(curve_idx)
+    force_curve.preprocess_force_curve(deflection_sens, height_channel)
+    if shift_height and file.filemetadata['file_type'] in cts.jpk_file_extensions:
+        force_curve.shift_height()
+    return force_curve
+
+def get_force_curve(file, curve_idx, deflection_sens, height_channel, shift_height=True):
+    '''
+    Get a preprocessed force curve, from the cache if it was
+    already preprocessed with the same parameters.
+    '''
+    shift_height = shift_height and file.filemetadata['file_type'] in cts.jpk_file_extensions
+    file_path = file.filemetadata['file_path']
+    cache_key = (file_path, curve_idx, deflection_sens, height_channel, shift_height)
+    memory_cache = get_memory_cache()
+    force_curve = memory_cache.get(cache_key)
+    if force_curve is not None:
+        return force_curve
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        force_curve = disk_cache.get(*cache_key)
+    if force_curve is None:
+        force_curve = preprocess_curve(file, curve_idx, deflection_sens, height_channel, shift_height)
+        if disk_cache is not None:
+            disk_cache.put(*cache_key, force_curve)
+    memory_cache.put(cache_key, force_curve)
+    return force_curve
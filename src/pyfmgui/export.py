@@ -1,12 +1,25 @@
-import contextlib
 import os
 import pandas as pd
 import numpy as np
-import traceback
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import constants
+import pyfmgui.const as cts
+# Import the exported columns of the fit results
+from pyfmgui.results import hertz_columns, ting_columns
 
-# Import for multiprocessing
-import concurrent.futures
-from functools import partial
+# Optional dependencies for the binary export formats
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import tables
+except ImportError:
+    tables = None
 
 result_types = [
     'hertz_results',
@@ -16,134 +29,179 @@ result_types = [
     'microrheo_results'
 ]
 
-def unpack_hertz_result(row_dict, hertz_result):
-    row_dict['hertz_ind_geometry'] = hertz_result.ind_geom
-    row_dict['hertz_tip_parameter'] = hertz_result.tip_parameter
-    row_dict['hertz_apply_BEC'] = hertz_result.apply_bec_flag
-    row_dict['hertz_BEC_model'] = hertz_result.bec_model
-    row_dict['hertz_fit_hline_on_baseline'] = hertz_result.fit_hline_flag
-    row_dict['hertz_delta0'] = hertz_result.delta0
-    row_dict['hertz_E0'] = hertz_result.E0
-    row_dict['hertz_f0'] = hertz_result.f0
-    row_dict['hertz_slope'] = hertz_result.slope
-    row_dict['hertz_poisson_ratio'] = hertz_result.poisson_ratio
-    row_dict['hertz_sample_height'] = hertz_result.sample_height
-    row_dict['hertz_MAE'] = hertz_result.MAE
-    row_dict['hertz_MSE'] = hertz_result.MSE
-    row_dict['hertz_RMSE'] = hertz_result.RMSE
-    row_dict['hertz_Rsquared'] = hertz_result.Rsquared
-    row_dict['hertz_chisq'] = hertz_result.chisq
-    row_dict['hertz_redchi'] = hertz_result.redchi
-    return row_dict
-
-def unpack_ting_result(row_dict, ting_result):
-    row_dict['ting_ind_geometry'] = ting_result.ind_geom
-    row_dict['ting_tip_parameter'] = ting_result.tip_parameter
-    row_dict['ting_modelFt'] = ting_result.modelFt
-    row_dict['ting_apply_BEC'] = ting_result.apply_bec_flag
-    row_dict['ting_BEC_model'] = ting_result.bec_model
-    row_dict['ting_fit_hline_on_baseline'] = ting_result.fit_hline_flag
-    row_dict['ting_t0'] = ting_result.t0
-    row_dict['ting_E0'] = ting_result.E0
-    row_dict['ting_tc'] = ting_result.tc
-    row_dict['ting_betaE'] = ting_result.betaE
-    row_dict['ting_f0'] = ting_result.F0
-    row_dict['ting_poisson_ratio'] = ting_result.poisson_ratio
-    row_dict['ting_vdrag'] = ting_result.vdrag
-    row_dict['ting_smooth_w'] = ting_result.smooth_w
-    row_dict['ting_idx_tm'] = ting_result.idx_tm
-    row_dict['ting_MAE'] = ting_result.MAE
-    row_dict['ting_MSE'] = ting_result.MSE
-    row_dict['ting_RMSE'] = ting_result.RMSE
-    row_dict['ting_Rsquared'] = ting_result.Rsquared
-    row_dict['ting_chisq'] = ting_result.chisq
-    row_dict['ting_redchi'] = ting_result.redchi
-    return row_dict
-
-def unpack_piezochar_result(row_dict, piezochar_result):
-    row_dict['frequency'] = piezochar_result[0]
-    row_dict['fi_degrees'] = piezochar_result[1]
-    row_dict['amp_quotient'] = piezochar_result[2]
-    return row_dict
-
-def unpack_vdrag_result(row_dict, vdrag_result):
-    row_dict['frequency'] = vdrag_result[0]
-    row_dict['Bh'] = vdrag_result[1]
-    row_dict['Hd_real'] = vdrag_result[2].real
-    row_dict['Hd_imag'] = vdrag_result[2].imag
-    row_dict['distances'] = vdrag_result[4]
-    row_dict['fi_degrees'] = vdrag_result[5]
-    row_dict['amp_quotient'] = vdrag_result[6]
-    return row_dict
-
-def unpack_microrheo_result(row_dict, microrheo_result):
-    row_dict['frequency'] = microrheo_result[0]
-    row_dict['G_storage'] = microrheo_result[1]
-    row_dict['G_loss'] = microrheo_result[2]
-    row_dict['losstan'] = np.array(row_dict['G_storage']) / np.array(row_dict['G_loss'])
-    row_dict['fi_degrees'] = microrheo_result[-4]
-    row_dict['amp_quotient'] = microrheo_result[-3]
-    row_dict['B(0)'] = microrheo_result[-2]
-    row_dict['w_ind'] = microrheo_result[-1]
-    return row_dict
-
-def get_file_results(result_type, file_metadata_and_results):
-    file_id, filemetadata, file_result = file_metadata_and_results
-    file_path = filemetadata['file_path']
-    k = filemetadata['spring_const_Nbym']
-    defl_sens = filemetadata['defl_sens_nmbyV']
-    file_results = []
-    for curve_result in file_result:
-        curve_indx = curve_result[0]
-        row_dict = {
-            'file_path': file_path, 'file_id': file_id, 
-            'curve_idx': curve_indx, 'kcanti': k, 'defl_sens': defl_sens
-        }
-        try:
-            if result_type == 'hertz_results' and curve_result[1] is not None:
-                hertz_result = curve_result[1]
-                if hertz_result is not None:
-                    row_dict = unpack_hertz_result(row_dict, hertz_result)
-            elif result_type == 'ting_results' and curve_result[1] is not None:
-                curve_indx = curve_result[0]
-                ting_result = curve_result[1][0]
-                hertz_result = curve_result[1][1]
-                if ting_result is not None and hertz_result is not None:
-                    row_dict = unpack_hertz_result(row_dict, hertz_result)
-                    row_dict = unpack_ting_result(row_dict, ting_result)
-            elif result_type == 'piezochar_results':
-                curve_indx = curve_result[0]
-                piezochar_result = curve_result[1]
-                if piezochar_result is not None:
-                    row_dict = unpack_piezochar_result(row_dict, piezochar_result)
-            elif result_type == 'vdrag_results':
-                curve_indx = curve_result[0]
-                vdrag_result = curve_result[1]
-                if vdrag_result is not None:
-                    row_dict = unpack_vdrag_result(row_dict, vdrag_result)
-            elif result_type == 'microrheo_results':
-                curve_indx = curve_result[0]
-                microrheo_result = curve_result[1]
-                if microrheo_result is not None:
-                    row_dict = unpack_microrheo_result(row_dict, microrheo_result)
-        except Exception as e:
-            file_results.append(row_dict)
-            print(e)
-            continue
-        file_results.append(row_dict)
-    return file_results
-
-def prepare_export_results(session, progress_callback, range_callback, step_callback):
+# Columns holding one value per frequency, the tables
+# have one row for each value in these columns.
+list_result_columns = {
+    'piezochar_results': ['frequency', 'fi_degrees', 'amp_quotient'],
+    'vdrag_results': ['frequency', 'Bh', 'Hd_real', 'Hd_imag', 'distances', 'fi_degrees', 'amp_quotient'],
+    'microrheo_results': ['frequency', 'G_storage', 'G_loss', 'losstan', 'fi_degrees', 'amp_quotient', 'B(0)', 'w_ind']
+}
+
+def unpack_piezochar_result(piezochar_result):
+    return {
+        'frequency': piezochar_result[0],
+        'fi_degrees': piezochar_result[1],
+        'amp_quotient': piezochar_result[2]
+    }
+
+def unpack_vdrag_result(vdrag_result):
+    Hd = np.asarray(vdrag_result[2])
+    return {
+        'frequency': vdrag_result[0],
+        'Bh': vdrag_result[1],
+        'Hd_real': Hd.real,
+        'Hd_imag': Hd.imag,
+        'distances': vdrag_result[4],
+        'fi_degrees': vdrag_result[5],
+        'amp_quotient': vdrag_result[6]
+    }
+
+def unpack_microrheo_result(microrheo_result):
+    G_storage = np.asarray(microrheo_result[1])
+    G_loss = np.asarray(microrheo_result[2])
+    return {
+        'frequency': microrheo_result[0],
+        'G_storage': G_storage,
+        'G_loss': G_loss,
+        'losstan': G_storage / G_loss,
+        'fi_degrees': microrheo_result[-4],
+        'amp_quotient': microrheo_result[-3],
+        # Scalars, repeated in every row of the curve
+        'B(0)': microrheo_result[-2],
+        'w_ind': microrheo_result[-1]
+    }
+
+list_result_unpackers = {
+    'piezochar_results': unpack_piezochar_result,
+    'vdrag_results': unpack_vdrag_result,
+    'microrheo_results': unpack_microrheo_result
+}
+
+def new_file_columns(nb_rows):
+    return {
+        'file_path': np.empty(nb_rows, dtype=object),
+        'file_id': np.empty(nb_rows, dtype=object),
+        'curve_idx': np.empty(nb_rows, dtype=int),
+        'kcanti': np.empty(nb_rows),
+        'defl_sens': np.empty(nb_rows)
+    }
+
+def fill_file_columns(table, start, stop, file_id, filemetadata, curve_idx):
+    table['file_path'][start:stop] = filemetadata['file_path']
+    table['file_id'][start:stop] = file_id
+    table['curve_idx'][start:stop] = curve_idx
+    table['kcanti'][start:stop] = filemetadata['spring_const_Nbym']
+    table['defl_sens'][start:stop] = filemetadata['defl_sens_nmbyV']
+
+def new_column(kind, nb_rows, has_errors):
+    if kind == 'str' or (kind == 'bool' and has_errors):
+        return np.empty(nb_rows, dtype=object)
+    elif kind == 'bool':
+        return np.empty(nb_rows, dtype=bool)
+    return np.empty(nb_rows)
+
+def iter_columnar_results(files, block_size):
+    # Yields (nb_files_done, table) with at most block_size rows, the
+    # columns are copied straight from the columnar stores. nb_files_done
+    # is the number of files whose rows have all been yielded.
+    # The column types do not change between blocks.
+    has_errors = any(store.errors for _, _, store in files)
+    export_columns = files[0][2].export_columns
+    for file_position, (file_id, filemetadata, store) in enumerate(files):
+        indices = store.export_indices()
+        for start in range(0, len(indices), block_size):
+            block_indices = indices[start:start+block_size]
+            nb_rows = len(block_indices)
+            table = new_file_columns(nb_rows)
+            fill_file_columns(table, 0, nb_rows, file_id, filemetadata, block_indices)
+            for name, _, kind in export_columns:
+                table[name] = new_column(kind, nb_rows, has_errors)
+                store.export_column(name, block_indices, table[name])
+            file_done = start + block_size >= len(indices)
+            yield file_position + file_done, table
+
+def build_list_results_table(columns, blocks, nb_rows):
+    # Allocate the columns once and copy the values of each curve
+    table = new_file_columns(nb_rows)
+    for name in columns:
+        dtypes = [values[name].dtype for _, _, _, values, _ in blocks if values is not None]
+        table[name] = np.full(nb_rows, np.nan, dtype=np.result_type(float, *dtypes))
+    start = 0
+    for file_id, filemetadata, curve_idx, values, nb_curve_rows in blocks:
+        stop = start + nb_curve_rows
+        fill_file_columns(table, start, stop, file_id, filemetadata, curve_idx)
+        if values is not None:
+            for name in columns:
+                table[name][start:stop] = values[name]
+        start = stop
+    return table
+
+def iter_list_results(result_type, files, block_size):
+    # Yields (nb_files_done, table) with about block_size rows,
+    # one row per value in the list columns of each curve.
+    # Several small files can end in the same table.
+    unpack = list_result_unpackers[result_type]
+    columns = list_result_columns[result_type]
+    blocks = []
+    nb_rows = 0
+    for file_position, (file_id, filemetadata, store) in enumerate(files):
+        for curve_idx, result in store:
+            values = None
+            if result is not None and not isinstance(result, Exception):
+                try:
+                    values = {name: np.asarray(value) for name, value in unpack(result).items()}
+                except Exception as error:
+                    logger.info(f'Failed to unpack {result_type} of curve {curve_idx} in file {file_id}: {error}')
+            # Curves without results are kept as an empty row
+            nb_values = len(values['frequency']) if values is not None else 0
+            blocks.append((file_id, filemetadata, curve_idx, values, max(nb_values, 1)))
+            nb_rows += max(nb_values, 1)
+            if nb_rows >= block_size:
+                # The files before the current one are complete
+                yield file_position, build_list_results_table(columns, blocks, nb_rows)
+                blocks = []
+                nb_rows = 0
+    if blocks:
+        yield len(files), build_list_results_table(columns, blocks, nb_rows)
+
+def iter_results(result_type, files, block_size):
+    if result_type in list_result_columns:
+        return iter_list_results(result_type, files, block_size)
+    return iter_columnar_results(files, block_size)
+
+def count_result_rows(result_type, files):
+    if result_type not in list_result_columns:
+        return sum(len(store.export_indices()) for _, _, store in files)
+    nb_rows = 0
+    for _, _, store in files:
+        for _, result in store:
+            try:
+                nb_rows += max(len(result[0]), 1)
+            except Exception:
+                nb_rows += 1
+    return nb_rows
+
+def get_session_results(session):
     # Map to relate result type to variable
     # where they are saved in the session.
-    results = {
+    return {
         'hertz_results': session.hertz_fit_results,
         'ting_results': session.ting_fit_results,
         'piezochar_results': session.piezo_char_results,
         'vdrag_results': session.vdrag_results,
         'microrheo_results': session.microrheo_results
     }
-    # Dictionary to output results
+
+def get_result_files(session, result):
+    # Get files in session, sorted by file path so
+    # the rows come out sorted by file and curve index.
+    return sorted(
+        [(file_id, session.loaded_files[file_id].filemetadata, file_result) for (file_id, file_result) in result.items()],
+        key=lambda item: item[1]['file_path']
+    )
+
+def prepare_export_results(session, progress_callback, range_callback, step_callback, results_callback, stop_event):
+    # Dictionary to output the preview of the results
     output = {
         'hertz_results': None,
         'ting_results': None, 
@@ -151,47 +209,178 @@ def prepare_export_results(session, progress_callback, range_callback, step_call
         'vdrag_results': None,
         'microrheo_results': None
     }
+    # Total number of rows for each result type
+    output_rows = {}
+    results = get_session_results(session)
+    range_callback.emit(len(results))
     # Loop through the results stored in the 
     # session and check if they are empty.
-    for result_type, result in results.items():
+    for count, (result_type, result) in enumerate(results.items()):
+        if stop_event.is_set():
+            break
         if result != {}:
-            # Get files in session
-            files_metadata_and_results = [(file_id, session.loaded_files[file_id].filemetadata, file_result) for (file_id, file_result) in result.items()]
-            # Start multiprocessing
-            count = 0
-            range_callback.emit(len(files_metadata_and_results))
-            file_results = []
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                # file_results = executor.map(partial(get_file_results, result_type), files_metadata_and_results)
-                futures = [executor.submit(get_file_results, result_type, fileinfo) for fileinfo in files_metadata_and_results]
-                for future in concurrent.futures.as_completed(futures):
-                    file_results.append(future.result())
-                    count+=1
-                    progress_callback.emit(count)
-            # Flatten result list
-            flat_file_results = [item for sublist in file_results for item in sublist]
-            # Create dataframe from list of dicts
-            outputdf = pd.DataFrame(flat_file_results) # This consumes too much memory?
-            # There are some parameters in the dicts that contain lists.
-            # The explode method creates a new row from each item in the list.
-            if result_type == 'piezochar_results':
-                outputdf = outputdf.explode(['frequency', 'fi_degrees', 'amp_quotient'])
-            elif result_type == 'vdrag_results':
-                outputdf = outputdf.explode(['frequency', 'Bh', 'Hd_real', 'Hd_imag', 'distances', 'fi_degrees', 'amp_quotient'])
-            elif result_type == 'microrheo_results':
-                outputdf = outputdf.explode(['frequency', 'G_storage', 'G_loss', 'losstan', 'fi_degrees', 'amp_quotient'])
-            # Sort values by file path and curve index
-            outputdf.sort_values(by=['file_path', 'curve_idx'])
-            # Assign results to proper result type
-            output[result_type] = outputdf
+            files = get_result_files(session, result)
+            # Only the first rows are unpacked for the preview
+            preview = []
+            nb_rows = 0
+            for _, table in iter_results(result_type, files, cts.export_preview_rows):
+                preview.append(pd.DataFrame(table))
+                nb_rows += len(preview[-1])
+                if nb_rows >= cts.export_preview_rows:
+                    break
+            if preview:
+                output[result_type] = pd.concat(preview, ignore_index=True).head(cts.export_preview_rows)
+                output_rows[result_type] = count_result_rows(result_type, files)
+        progress_callback.emit(count + 1)
     # Output loaded results
     session.prepared_results = output
+    session.prepared_results_rows = output_rows
+
+def get_export_formats():
+    # Formats available with the installed packages
+    export_formats = ['CSV']
+    if pyarrow is not None:
+        export_formats.extend(['Parquet', 'Feather'])
+    if tables is not None:
+        export_formats.append('HDF5')
+    return export_formats
+
+def prepare_hdf_table(result_df):
+    # PyTables can only save text in object columns
+    text_columns = [
+        column for column in result_df.columns
+        if not pd.api.types.is_numeric_dtype(result_df[column]) and not pd.api.types.is_bool_dtype(result_df[column])
+    ]
+    for column in text_columns:
+        result_df[column] = result_df[column].astype(str)
+    return result_df, text_columns
+
+# Boolean columns that may contain empty values
+bool_columns = [name for name, _, kind in hertz_columns + ting_columns if kind == 'bool']
+
+def get_arrow_schema(table):
+    fields = []
+    for name, column in table.items():
+        if column.dtype == object:
+            arrow_type = pyarrow.bool_() if name in bool_columns else pyarrow.string()
+        else:
+            arrow_type = pyarrow.from_numpy_dtype(column.dtype)
+        fields.append(pyarrow.field(name, arrow_type))
+    return pyarrow.schema(fields)
+
+def close_temp_file(writer, temp_path, file_path, keep):
+    # Move the temporary file to file_path if the export completed,
+    # otherwise, or if it can not be closed, remove it.
+    try:
+        if writer is not None:
+            writer.close()
+    except Exception:
+        keep = False
+        raise
+    finally:
+        if keep and writer is not None:
+            os.replace(temp_path, file_path)
+        elif os.path.exists(temp_path):
+            os.remove(temp_path)
+
+class ResultWriter:
+    '''
+    Writes the tables of one result type to disk block by block.
+    Data is written to a temporary file that replaces file_path
+    when the writer is closed, or is removed if the export fails.
+
+    :param file_path: Path of the output file, without extension.
+    :type file_path: str
+    :param file_format: One of the formats in get_export_formats.
+    :type file_format: str
+
+    '''
+    extensions = {'CSV': 'csv', 'Parquet': 'parquet', 'Feather': 'feather'}
+
+    def __init__(self, file_path, file_format):
+        self.file_format = file_format
+        self.file_path = f'{file_path}.{self.extensions[file_format]}'
+        self.temp_path = f'{self.file_path}.part'
+        self.schema = None
+        self.writer = None
+
+    def write(self, table):
+        if self.file_format == 'CSV':
+            header = self.writer is None
+            if header:
+                self.writer = open(self.temp_path, 'w', newline='')
+            pd.DataFrame(table).to_csv(self.writer, header=header, index=False)
+            return
+        if self.writer is None:
+            self.schema = get_arrow_schema(table)
+            if self.file_format == 'Parquet':
+                self.writer = pyarrow.parquet.ParquetWriter(self.temp_path, self.schema, compression=cts.parquet_compression)
+            else:
+                options = pyarrow.ipc.IpcWriteOptions(compression=cts.parquet_compression)
+                self.writer = pyarrow.ipc.new_file(self.temp_path, self.schema, options=options)
+        self.writer.write_table(pyarrow.Table.from_pydict(table, schema=self.schema))
+
+    def close(self, keep=True):
+        close_temp_file(self.writer, self.temp_path, self.file_path, keep)
+
+class HDFResultWriter:
+    '''
+    Writes all the result types to one HDF5 file, one table per result type.
+    '''
+    def __init__(self, file_path):
+        self.file_path = f'{file_path}.h5'
+        self.temp_path = f'{self.file_path}.part'
+        self.writer = None
+
+    def write(self, result_type, table):
+        if self.writer is None:
+            self.writer = pd.HDFStore(self.temp_path, mode='w', complib=cts.hdf_complib, complevel=cts.hdf_complevel)
+        result_df, text_columns = prepare_hdf_table(pd.DataFrame(table))
+        min_itemsize = {column: cts.hdf_min_itemsize for column in text_columns}
+        self.writer.append(result_type, result_df, format='table', index=False, min_itemsize=min_itemsize)
+
+    def close(self, keep=True):
+        close_temp_file(self.writer, self.temp_path, self.file_path, keep)
 
-def export_results(results, dirname, file_prefix):
+def export_results(session, dirname, file_prefix, file_format, progress_callback, range_callback, step_callback, results_callback, stop_event):
+    # Write the results to disk in blocks of const.export_block_rows rows,
+    # only one block is held in memory at a time.
+    results = {result_type: result for result_type, result in get_session_results(session).items() if result != {}}
+    range_callback.emit(sum(len(result) for result in results.values()))
+    count = 0
     success_flag = False
-    for result_type, result_df in results.items():
-        if result_df is None:
-            continue
-        result_df.to_csv(os.path.join(dirname, f'{file_prefix}_{result_type}.csv'), index=False)
-        success_flag = True
-    return success_flag
\ No newline at end of file
+    completed = False
+    hdf_writer = HDFResultWriter(os.path.join(dirname, f'{file_prefix}_results')) if file_format == 'HDF5' else None
+    try:
+        for result_type, result in results.items():
+            if file_format != 'HDF5':
+                writer = ResultWriter(os.path.join(dirname, f'{file_prefix}_{result_type}'), file_format)
+            step_callback.emit(result_type)
+            result_files = get_result_files(session, result)
+            type_completed = False
+            try:
+                for nb_files_done, table in iter_results(result_type, result_files, cts.export_block_rows):
+                    if stop_event.is_set():
+                        break
+                    if hdf_writer is not None:
+                        hdf_writer.write(result_type, table)
+                    else:
+                        writer.write(table)
+                    progress_callback.emit(count + nb_files_done)
+                type_completed = not stop_event.is_set()
+            finally:
+                # Do not leave incomplete files, the file is only kept
+                # if all the blocks were written without errors
+                if hdf_writer is None:
+                    writer.close(keep=type_completed)
+            if not type_completed:
+                break
+            # Files without rows do not yield any table
+            count += len(result_files)
+            progress_callback.emit(count)
+            success_flag = True
+        completed = not stop_event.is_set()
+    finally:
+        if hdf_writer is not None:
+            hdf_writer.close(keep=completed)
+    return success_flag and completed
@@ -0,0 +1,107 @@
+from collections import defaultdict
+import numpy as np
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import batched PoC detection
+from pyfmgui.poc import get_poc_segment, get_segments_poc
+# Import Hertz model from PyFMRheo
+from pyfmrheo.models.hertz import HertzModel
+from pyfmrheo.models.geom_coeffs import get_coeff
+
+def get_hertz_fit_data(zheight, vdeflection, poc, params):
+    # Force vs indentation data fitted by doHertzFit, returns the
+    # indentation, the force and the mask of the contact points used.
+    indentation = zheight - vdeflection - poc
+    force = vdeflection * params['k']
+    force = force - force[0]
+    contact_mask = indentation >= 0
+    if params['fit_range_type'] == 'indentation':
+        contact_mask &= (indentation >= params['min_ind']) & (indentation <= params['max_ind'])
+    elif params['fit_range_type'] == 'force':
+        contact_mask &= (force >= params['min_force']) & (force <= params['max_force'])
+    fit_mask = contact_mask | (indentation < 0)
+    return indentation, force, contact_mask, fit_mask
+
+def solve_hertz_stack(indentation, force, contact_mask, fit_mask, coeff, n):
+    '''
+    Closed form Hertz fit of a stack of curves with the same number of
+    points, one curve per row. With d0 fixed at the PoC, f0 is the mean
+    force out of contact and the linearised relation
+    (F - f0)^(1/n) = (coeff * E0)^(1/n) * indentation
+    is solved by least squares through the origin.
+
+    Returns E0, f0 and the goodness of fit metrics of each curve.
+    '''
+    noncontact_mask = fit_mask & ~contact_mask
+    nb_noncontact = noncontact_mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f0 = np.where(nb_noncontact > 0, np.where(noncontact_mask, force, 0).sum(axis=1) / nb_noncontact, 0)
+        delta = np.where(contact_mask, indentation, 0)
+        linear_force = np.power(np.clip(force - f0[:, None], 0, None), 1 / n) * contact_mask
+        slope = (delta * linear_force).sum(axis=1) / (delta * delta).sum(axis=1)
+        E0 = np.power(slope, n) / coeff
+        # Metrics computed on the fitted points, as in HertzModel.fit
+        predictions = coeff * E0[:, None] * np.power(delta, n) + f0[:, None]
+        errors = np.where(fit_mask, predictions - force, np.nan)
+        fitted_force = np.where(fit_mask, force, np.nan)
+        MAE = np.nanmean(errors, axis=1)
+        MSE = np.nanmean(errors * errors, axis=1)
+        Rsquared = 1.0 - np.nanvar(errors, axis=1) / np.nanvar(fitted_force, axis=1)
+        chisq_terms = errors * errors / fitted_force
+        chisq = np.where(np.isfinite(chisq_terms), chisq_terms, 0).sum(axis=1)
+    return {'E0': E0, 'f0': f0, 'MAE': MAE, 'MSE': MSE, 'RMSE': np.sqrt(MSE), 'Rsquared': Rsquared, 'chisq': chisq}
+
+def fit_hertz_closed_form(force_curves, params):
+    '''
+    Fast estimate of the Hertz fit of a block of preprocessed curves.
+    The PoC of all the curves is found at once and E0 is solved in
+    closed form for the curves with the same number of points together.
+
+    Returns a list with a HertzModel for each curve, or the error
+    raised if the curve could not be processed.
+    '''
+    results = [None] * len(force_curves)
+    segments = []
+    for i, fdc in enumerate(force_curves):
+        try:
+            segments.append(get_poc_segment(fdc, params))
+        except Exception as error:
+            results[i] = error
+            segments.append((np.zeros(0), np.zeros(0)))
+    pocs = get_segments_poc(segments, params)
+    # Same Poisson ratio as the models fitted by doHertzFit
+    poisson_ratio = HertzModel(params['contact_model'], params['tip_param']).poisson_ratio
+    coeff, n = get_coeff(params['contact_model'], params['tip_param'], poisson_ratio)
+    groups = defaultdict(list)
+    for i, (zheight, vdeflection) in enumerate(segments):
+        if results[i] is not None:
+            continue
+        if np.isnan(pocs[i]):
+            results[i] = ValueError('Failed to compute the PoC')
+            continue
+        fit_data = get_hertz_fit_data(zheight, vdeflection, pocs[i], params)
+        if not fit_data[2].any():
+            results[i] = ValueError('No contact points in the fit range')
+            continue
+        groups[len(zheight)].append((i, fit_data))
+    for group in groups.values():
+        positions = [i for i, _ in group]
+        stacked = [np.stack([fit_data[j] for _, fit_data in group]) for j in range(4)]
+        fit_values = solve_hertz_stack(*stacked, coeff, n)
+        for row, i in enumerate(positions):
+            hertz_model = HertzModel(params['contact_model'], params['tip_param'])
+            hertz_model.n_params = 2
+            hertz_model.delta0 = 0
+            for name, values in fit_values.items():
+                setattr(hertz_model, name, float(values[row]))
+            hertz_model.redchi = hertz_model.chisq / hertz_model.n_params
+            results[i] = hertz_model
+    return results
+
+def doHertzFitClosedForm(fdc, param_dict):
+    # Same interface as the routines of PyFMRheo, for single curves
+    result = fit_hertz_closed_form([fdc], param_dict)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
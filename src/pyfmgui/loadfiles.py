@@ -2,9 +2,11 @@
 import logging
 logger = logging.getLogger()
 # Import for multiprocessing
-import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 # Get loadfile function from PyFMReader
 from pyfmreader import loadfile
+# Import task cancellation
+from pyfmgui.batching import iter_completed
 # Get constants
 import pyfmgui.const as const
 
@@ -19,18 +21,27 @@ def load_single_file(filepath):
     except Exception as error:
         logger.info(f'Failed to load {filepath} with error: {error}')
 
-def loadfiles(session, filelist, progress_callback, range_callback, step_callback):
+def loadfiles(session, filelist, progress_callback, range_callback, step_callback, results_callback, stop_event):
     files_to_load = [path for path in filelist if path not in session.loaded_files_paths]
     loaded_files = []
     count = 0
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        # loaded_files = executor.map(load_single_file, files_to_load)
+    executor = session.process_pool
+    try:
         futures = [executor.submit(load_single_file, filepath) for filepath in files_to_load]
-        for future in concurrent.futures.as_completed(futures):
-            loaded_files.append(future.result())
+        # Cancel stops waiting for the files still loading,
+        # the files already loaded are kept.
+        for future in iter_completed(futures, stop_event):
+            loaded_file = future.result()
             count+=1
             progress_callback.emit(count)
-    # loaded_files = list(loaded_files)
-    # Loop and save files in the session
-    for file_id, file in loaded_files:
-        session.loaded_files[file_id] = file
+            # Files that failed to load return None
+            if loaded_file is not None:
+                loaded_files.append(loaded_file)
+    except BrokenProcessPool:
+        # One of the workers died, get a fresh pool for the next job
+        session.process_pool.restart()
+        raise
+    finally:
+        # Loop and save files in the session
+        for file_id, file in loaded_files:
+            session.loaded_files[file_id] = file
@@ -240,6 +240,7 @@ class MainWindow(QtWidgets.QMainWindow):
 		self.session.pbar_widget.set_pbar_range(0, len(filelist))
 		self.thread = QtCore.QThread()
 		self.worker = Worker(loadfiles, self.session, filelist)
+		self.session.pbar_widget.set_worker(self.worker)
 		self.worker.moveToThread(self.thread)
 		self.thread.started.connect(self.worker.run)
 		self.worker.signals.progress.connect(self.reportProgress)
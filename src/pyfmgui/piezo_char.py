@@ -0,0 +1,162 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import constants
+import pyfmgui.const as cts
+
+# Bump when the layout of the cached calibrations changes
+calibration_version = 1
+
+# Calibrations already loaded by this process, keyed by
+# (source path, source signature). Worker processes load
+# each calibration from its disk cache only once.
+_loaded_calibrations = {}
+_loaded_calibrations_lock = threading.Lock()
+
+def get_source_signature(source_path):
+    # Identify the version of the source CSV without reading it
+    stat = os.stat(source_path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}-{calibration_version}'
+
+def get_cache_path(source_path):
+    # The calibration is cached next to the CSV it was built from
+    return source_path + cts.piezo_char_cache_suffix
+
+class PiezoCharCalibration:
+    '''
+    Piezo characterization: phase shift and amplitude quotient of the
+    piezo for each frequency, sorted by frequency, with the slopes of the
+    linear interpolation between frequencies precomputed.
+
+    Pickled instances only carry the path and signature of their source CSV,
+    processes unpickling them load the calibration from its disk cache once
+    and reuse it for every task afterwards. Unpickling fails if the CSV
+    changed since the calibration was built.
+
+    :param frequency: Frequencies characterized, in Hz.
+    :type frequency: np.ndarray
+    :param fi_degrees: Phase shift at each frequency, in degrees.
+    :type fi_degrees: np.ndarray
+    :param amp_quotient: Amplitude quotient at each frequency.
+    :type amp_quotient: np.ndarray
+    :param source_path: Path of the CSV the calibration was built from.
+    :type source_path: str
+    :param signature: Version of the source CSV the calibration was built from.
+    :type signature: str
+
+    '''
+    def __init__(self, frequency, fi_degrees, amp_quotient, source_path=None, signature=None):
+        order = np.argsort(frequency)
+        self.frequency = np.asarray(frequency, dtype=float)[order]
+        self.fi_degrees = np.asarray(fi_degrees, dtype=float)[order]
+        self.amp_quotient = np.asarray(amp_quotient, dtype=float)[order]
+        self.source_path = source_path
+        self.signature = signature
+        with np.errstate(divide='ignore', invalid='ignore'):
+            deltaf = np.diff(self.frequency)
+            self.fi_slopes = np.diff(self.fi_degrees) / deltaf
+            self.amp_slopes = np.diff(self.amp_quotient) / deltaf
+
+    def __len__(self):
+        return len(self.frequency)
+
+    def __reduce__(self):
+        if self.source_path is not None and os.path.exists(get_cache_path(self.source_path)):
+            return get_calibration, (self.source_path, self.signature)
+        return PiezoCharCalibration, (self.frequency, self.fi_degrees, self.amp_quotient, self.source_path, self.signature)
+
+    def get(self, frequency):
+        '''
+        Phase shift in degrees and amplitude quotient at frequency. The
+        frequencies between the characterized ones are interpolated.
+
+        Returns None if frequency is out of the characterized range.
+        '''
+        idx = int(np.searchsorted(self.frequency, frequency))
+        if idx < len(self.frequency) and self.frequency[idx] == frequency:
+            return self.fi_degrees[idx], self.amp_quotient[idx]
+        if idx == 0 or idx == len(self.frequency):
+            return None
+        deltaf = frequency - self.frequency[idx-1]
+        return (
+            self.fi_degrees[idx-1] + self.fi_slopes[idx-1] * deltaf,
+            self.amp_quotient[idx-1] + self.amp_slopes[idx-1] * deltaf
+        )
+
+def read_calibration_csv(source_path, signature):
+    # Median of the values measured at each frequency
+    piezo_char_data_raw = pd.read_csv(source_path)
+    piezo_char_data = piezo_char_data_raw[["frequency",  "fi_degrees",  "amp_quotient"]]
+    piezo_char_data = piezo_char_data.groupby('frequency', as_index=False).median()
+    return PiezoCharCalibration(
+        piezo_char_data['frequency'].values, piezo_char_data['fi_degrees'].values,
+        piezo_char_data['amp_quotient'].values, source_path, signature
+    )
+
+def read_calibration_cache(source_path, signature):
+    cache_path = get_cache_path(source_path)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cached:
+            if str(cached['signature']) != signature:
+                return None
+            return PiezoCharCalibration(
+                cached['frequency'], cached['fi_degrees'], cached['amp_quotient'], source_path, signature)
+    except Exception as error:
+        logger.info(f'Failed to load cached piezo characterization {cache_path}: {error}')
+        return None
+
+def write_calibration_cache(calibration):
+    cache_path = get_cache_path(calibration.source_path)
+    # Write to a temporary file and rename it, so other
+    # processes never read a half written cache.
+    temp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f, frequency=calibration.frequency, fi_degrees=calibration.fi_degrees,
+                amp_quotient=calibration.amp_quotient, signature=np.array(calibration.signature)
+            )
+        os.replace(temp_path, cache_path)
+    except Exception as error:
+        logger.info(f'Failed to cache piezo characterization {cache_path}: {error}')
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def get_calibration(source_path, signature=None):
+    '''
+    Load the piezo characterization of a CSV file, from its disk cache if
+    it is up to date. Otherwise the CSV is read and the cache rebuilt.
+    Raises ValueError if signature is given and the CSV no longer matches it.
+
+    :param source_path: Path of the CSV saved by the piezo characterization.
+    :type source_path: str
+    :param signature: Version of the CSV expected, None to use the current one.
+    :type signature: str
+
+    Returns a PiezoCharCalibration.
+    '''
+    current_signature = None
+    if signature is None:
+        signature = current_signature = get_source_signature(source_path)
+    key = (os.path.abspath(source_path), signature)
+    with _loaded_calibrations_lock:
+        calibration = _loaded_calibrations.get(key)
+    if calibration is not None:
+        return calibration
+    if current_signature is None and get_source_signature(source_path) != signature:
+        # The CSV changed since the calibration was loaded, the
+        # data in use would differ from the one that was selected.
+        raise ValueError(f'Piezo characterization {source_path} changed since it was loaded, load it again')
+    calibration = read_calibration_cache(source_path, signature)
+    if calibration is None:
+        calibration = read_calibration_csv(source_path, signature)
+        write_calibration_cache(calibration)
+    with _loaded_calibrations_lock:
+        _loaded_calibrations[key] = calibration
+    return calibration
@@ -0,0 +1,125 @@
+from collections import defaultdict
+import numpy as np
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import processing utilities from PyFMRheo
+from pyfmrheo.utils.force_curves import get_poc_RoV_method, get_poc_regulaFalsi_method, correct_tilt, correct_offset
+
+def rolling_var(values, window):
+    # Variance of each row of values over a centered window of size
+    # window, windows are truncated at the edges of the rows. Same as
+    # pd.Series.rolling(window, center=True, min_periods=1).var(ddof=0)
+    nb_points = values.shape[1]
+    # Remove the mean of each row to keep the precision of the sums
+    values = values - values.mean(axis=1, keepdims=True)
+    zeros = np.zeros((len(values), 1))
+    sums = np.concatenate([zeros, np.cumsum(values, axis=1)], axis=1)
+    squares = np.concatenate([zeros, np.cumsum(values * values, axis=1)], axis=1)
+    starts = np.clip(np.arange(nb_points) - window // 2, 0, nb_points)
+    ends = np.clip(np.arange(nb_points) - window // 2 + window, 0, nb_points)
+    counts = ends - starts
+    mean = (sums[:, ends] - sums[:, starts]) / counts
+    var = (squares[:, ends] - squares[:, starts]) / counts - mean * mean
+    return np.maximum(var, 0)
+
+def get_poc_RoV_stack(vdeflection, win_size):
+    '''
+    Ratio of variances PoC of a stack of deflection curves with the same
+    number of points and window size, one curve per row. Gives the same results as
+    get_poc_RoV_method applied to every row.
+
+    Returns the indices of the PoC, -1 for the curves where it could not
+    be computed.
+    '''
+    rov_dfl_1 = rolling_var(vdeflection[:, win_size+1:], win_size)
+    rov_dfl_2 = rolling_var(vdeflection[:, :-win_size], win_size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rovi = rov_dfl_1 / rov_dfl_2[:, :rov_dfl_1.shape[1]]
+    valid = ~np.all(np.isnan(rovi), axis=1)
+    rovi_idx = np.full(len(rovi), -1)
+    rovi_idx[valid] = np.nanargmax(rovi[valid], axis=1)
+    return rovi_idx
+
+def get_rov_window(zheight, windowforCP):
+    # Window size in points used by get_poc_RoV_method
+    deltaz = np.abs(zheight.max() - zheight.min())
+    zperpt = deltaz / len(zheight)
+    return int(windowforCP/2/zperpt)*2
+
+def get_poc_segment(fdc, params):
+    # Segment data used by the routines to find the PoC, with
+    # the baseline corrected the same way as in doHertzFit.
+    if params.get('curve_seg', 'extend') == 'extend':
+        segment_data = fdc.extend_segments[0][1]
+        zheight, vdeflection = segment_data.zheight, segment_data.vdeflection
+    else:
+        segment_data = fdc.retract_segments[-1][1]
+        zheight, vdeflection = segment_data.zheight[::-1], segment_data.vdeflection[::-1]
+    if params['offset_type'] == 'percentage':
+        deltaz = zheight.max() - zheight.min()
+        maxoffset = zheight.min() + deltaz * params['max_offset']
+        minoffset = zheight.min() + deltaz * params['min_offset']
+    else:
+        maxoffset = params['max_offset']
+        minoffset = params['min_offset']
+    if params['correct_tilt']:
+        vdeflection = correct_tilt(zheight, vdeflection, maxoffset, minoffset)
+    else:
+        vdeflection = correct_offset(zheight, vdeflection, maxoffset, minoffset)
+    return zheight, vdeflection
+
+def get_segments_poc(segments, params):
+    '''
+    Compute the PoC of a list of (zheight, vdeflection) segments, already
+    baseline corrected. With the RoV method the segments with the same
+    number of points and window size are stacked and processed at once.
+
+    Returns an array with the PoC height of each segment, NaN if it failed.
+    '''
+    pocs = np.full(len(segments), np.nan)
+    groups = defaultdict(list)
+    for i, (zheight, vdeflection) in enumerate(segments):
+        try:
+            if params['poc_method'] != 'RoV':
+                comp_PoC = get_poc_regulaFalsi_method(zheight, vdeflection, params['sigma'])
+                pocs[i] = comp_PoC[0]
+                continue
+            win_size = get_rov_window(zheight, params['poc_win'])
+        except Exception as error:
+            logger.debug(f'Failed to compute PoC of segment {i}: {error}')
+            continue
+        groups[(len(zheight), win_size)].append(i)
+    for (nb_points, win_size), group in groups.items():
+        if win_size <= 0 or nb_points <= win_size + 1:
+            # Degenerated windows, use the reference implementation
+            for i in group:
+                try:
+                    pocs[i] = get_poc_RoV_method(*segments[i], params['poc_win'])[0]
+                except Exception as error:
+                    logger.debug(f'Failed to compute PoC of segment {i}: {error}')
+            continue
+        zheight = np.stack([segments[i][0] for i in group])
+        rovi_idx = get_poc_RoV_stack(np.stack([segments[i][1] for i in group]), win_size)
+        found = rovi_idx >= 0
+        pocs[np.array(group)[found]] = zheight[found, rovi_idx[found]]
+    return pocs
+
+def get_curves_poc(force_curves, params):
+    '''
+    Compute the PoC of a block of preprocessed curves.
+
+    Returns an array with the PoC height of each curve, NaN if it failed.
+    '''
+    segments = []
+    failed = []
+    for i, fdc in enumerate(force_curves):
+        try:
+            segments.append(get_poc_segment(fdc, params))
+        except Exception as error:
+            logger.debug(f'Failed to compute PoC of curve {fdc.curve_index}: {error}')
+            failed.append(i)
+            segments.append((np.zeros(0), np.zeros(0)))
+    pocs = get_segments_poc(segments, params)
+    pocs[failed] = np.nan
+    return pocs
@@ -0,0 +1,88 @@
+# Import for multithreading
+import threading
+import concurrent.futures
+import numpy as np
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import constants
+import pyfmgui.const as cts
+# Import preprocessed curves cache
+from pyfmgui.curve_cache import get_memory_cache, get_force_curve
+
+def get_neighbour_indices(map_coords, curve_idx, radius):
+    # Curve indices of the pixels around the pixel of curve_idx,
+    # sorted by distance (8 pixels for radius 1, 24 for radius 2).
+    positions = np.argwhere(map_coords == curve_idx)
+    if len(positions) == 0:
+        return []
+    x, y = positions[0]
+    nx, ny = map_coords.shape[:2]
+    neighbours = []
+    for dx in range(-radius, radius + 1):
+        for dy in range(-radius, radius + 1):
+            if (dx, dy) == (0, 0) or not (0 <= x + dx < nx and 0 <= y + dy < ny):
+                continue
+            neighbours.append((max(abs(dx), abs(dy)), dx * dx + dy * dy, int(map_coords[x + dx, y + dy])))
+    return [idx for _, _, idx in sorted(neighbours)]
+
+class CurvePrefetcher:
+    '''
+    Loads and preprocesses the curves around the selected pixel of a
+    force map in background threads, so they are already in the curve
+    cache when the user moves to the next pixel.
+
+    Each request cancels the curves still queued by the previous one.
+
+    :param max_workers: Number of threads used to load the curves.
+    :type max_workers: int
+    :param radius: Number of pixels around the selected one to load.
+    :type radius: int
+
+    '''
+    def __init__(self, max_workers=None, radius=None):
+        self.max_workers = max_workers or cts.prefetch_max_workers
+        self.radius = radius or cts.prefetch_radius
+        self._executor = None
+        self._pending = []
+        self._lock = threading.RLock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='curve_prefetch'
+            )
+        return self._executor
+
+    def prefetch(self, file, map_coords, curve_idx, deflection_sens, height_channel, shift_height=True):
+        if not cts.prefetch_enabled or not file.isFV or map_coords is None or curve_idx is None:
+            return
+        memory_cache = get_memory_cache()
+        shift_height = shift_height and file.filemetadata['file_type'] in cts.jpk_file_extensions
+        file_path = file.filemetadata['file_path']
+        with self._lock:
+            self.cancel()
+            for idx in get_neighbour_indices(map_coords, curve_idx, self.radius):
+                if (file_path, idx, deflection_sens, height_channel, shift_height) in memory_cache:
+                    continue
+                future = self.executor.submit(self._load, file, idx, deflection_sens, height_channel, shift_height)
+                self._pending.append(future)
+
+    def _load(self, file, curve_idx, deflection_sens, height_channel, shift_height):
+        try:
+            get_force_curve(file, curve_idx, deflection_sens, height_channel, shift_height)
+        except Exception as error:
+            logger.debug(f"Failed to prefetch curve {curve_idx} in file {file.filemetadata['Entry_filename']}: {error}")
+
+    def cancel(self):
+        # Curves being loaded are finished, the queued ones are dropped
+        with self._lock:
+            for future in self._pending:
+                future.cancel()
+            self._pending = []
+
+    def shutdown(self, wait=False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
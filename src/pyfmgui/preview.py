@@ -0,0 +1,268 @@
+import numpy as np
+# Import preprocessed curves cache
+from pyfmgui.curve_cache import get_force_curve, clone_force_curve
+from pyfmgui.spectral import get_psds, get_lock_in_amplitudes
+# Import processing utilities from PyFMRheo
+from pyfmrheo.utils.force_curves import get_poc_RoV_method, get_poc_regulaFalsi_method, correct_viscous_drag, correct_tilt, correct_offset
+from pyfmrheo.utils.signal_processing import detrend_rolling_average
+
+# Functions computing the data shown by the widgets for the selected
+# curve. They run in a background thread and only return arrays,
+# the widgets draw them once they are ready.
+
+class StageCache:
+    '''
+    Saves the output of the last run of each stage of a preview, keyed
+    on its inputs. The key of a stage includes the key of the stages it
+    depends on, so when a parameter changes only the stages downstream
+    of it are computed again.
+
+    The outputs are shared between runs, stages must not modify them.
+    '''
+    def __init__(self):
+        self._outputs = {}
+
+    def run(self, name, key, fn, *args):
+        entry = self._outputs.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        output = fn(*args)
+        self._outputs[name] = (key, output)
+        return output
+
+    def clear(self):
+        self._outputs = {}
+
+def get_tilt_offsets(zheight, params):
+    # Returns the (max, min) zheight of the region used to correct the baseline
+    if params['offset_type'] == 'percentage':
+        deltaz = zheight.max() - zheight.min()
+        return zheight.min() + deltaz * params['max_offset'], zheight.min() + deltaz * params['min_offset']
+    return params['max_offset'], params['min_offset']
+
+def get_poc(zheight, vdeflection, params):
+    if params['poc_method'] == 'RoV':
+        comp_PoC = get_poc_RoV_method(zheight, vdeflection, params['poc_win'])
+    else:
+        comp_PoC = get_poc_regulaFalsi_method(zheight, vdeflection, params['sigma'])
+    if comp_PoC is not None:
+        return [comp_PoC[0], 0]
+    return [0, 0]
+
+def get_baseline_corrected(zheight, vdeflection, params, maxoffset, minoffset):
+    if params['correct_tilt']:
+        return correct_tilt(zheight, vdeflection, maxoffset, minoffset)
+    return correct_offset(zheight, vdeflection, maxoffset, minoffset)
+
+def correct_baseline(force_curve, params, curve_seg):
+    # Correct the baseline of the extend or retract segment, or of
+    # both using the extend segment to place the offset region.
+    ext_data = force_curve.extend_segments[0][1]
+    ret_data = force_curve.retract_segments[-1][1]
+    baseline = {'extend': None, 'retract': None}
+    if curve_seg == 'both':
+        sep_idx = len(ext_data.zheight)
+        zheight = np.r_[ext_data.zheight, ret_data.zheight]
+        vdeflection = np.r_[ext_data.vdeflection, ret_data.vdeflection]
+        maxoffset, minoffset = get_tilt_offsets(zheight[:sep_idx], params)
+        vdeflection = get_baseline_corrected(zheight, vdeflection, params, maxoffset, minoffset)
+        baseline['extend'] = vdeflection[:sep_idx]
+        baseline['retract'] = vdeflection[sep_idx:]
+    else:
+        seg_data = ext_data if curve_seg == 'extend' else ret_data
+        maxoffset, minoffset = get_tilt_offsets(seg_data.zheight, params)
+        baseline[curve_seg] = get_baseline_corrected(seg_data.zheight, seg_data.vdeflection, params, maxoffset, minoffset)
+    baseline['maxoffset'] = maxoffset
+    baseline['minoffset'] = minoffset
+    return baseline
+
+def get_force_indentation(force_curve, baseline, poc, spring_k):
+    # Work on a copy, the segments of the cached curve are not modified
+    force_curve = clone_force_curve(force_curve, keep_raw_data=False)
+    segments = {'extend': force_curve.extend_segments[0][1], 'retract': force_curve.retract_segments[-1][1]}
+    for curve_seg, segment in segments.items():
+        if baseline is not None and baseline[curve_seg] is not None:
+            segment.vdeflection = baseline[curve_seg]
+    force_curve.get_force_vs_indentation(poc, spring_k)
+    return force_curve
+
+def load_curve_stage(stages, file, curve_idx, params):
+    curve_key = (file.filemetadata['file_path'], id(file), curve_idx, params['def_sens'], params['height_channel'])
+    force_curve = stages.run('curve', curve_key, get_force_curve, file, curve_idx, params['def_sens'], params['height_channel'])
+    return force_curve, curve_key
+
+def run_common_stages(stages, file, curve_idx, params, curve_seg=None, poc_offset=0):
+    # Stages shared by the widgets: load the curve, correct the baseline,
+    # detect the PoC and compute force vs indentation. Returns the loaded
+    # curve, the baseline correction and the curve with force and indentation.
+    force_curve, curve_key = load_curve_stage(stages, file, curve_idx, params)
+    ext_data = force_curve.extend_segments[0][1]
+    ret_data = force_curve.retract_segments[-1][1]
+    if curve_seg is None:
+        baseline_key = curve_key
+        baseline = None
+        poc_zheight, poc_vdeflection = ext_data.zheight, ext_data.vdeflection
+    else:
+        baseline_key = (curve_key, curve_seg, params['correct_tilt'], params['offset_type'], params['max_offset'], params['min_offset'])
+        baseline = stages.run('baseline', baseline_key, correct_baseline, force_curve, params, curve_seg)
+        poc_segment = 'retract' if curve_seg == 'retract' else 'extend'
+        poc_zheight = ext_data.zheight if poc_segment == 'extend' else ret_data.zheight
+        poc_vdeflection = baseline[poc_segment]
+    poc_key = (baseline_key, params['poc_method'], params['poc_win'] if params['poc_method'] == 'RoV' else params['sigma'])
+    poc = stages.run('poc', poc_key, get_poc, poc_zheight, poc_vdeflection, params)
+    poc = [poc[0] + poc_offset, poc[1]]
+    indentation_key = (poc_key, poc_offset, params['k'])
+    indented_curve = stages.run('indentation', indentation_key, get_force_indentation, force_curve, baseline, poc, params['k'])
+    return force_curve, baseline, poc, indented_curve, indentation_key
+
+def get_hertz_data(indented_curve, params):
+    curve_seg = params['curve_seg']
+    if curve_seg == 'extend':
+        seg_data = indented_curve.extend_segments[0][1]
+        force = seg_data.force - seg_data.force[0]
+    else:
+        seg_data = indented_curve.retract_segments[-1][1]
+        force = seg_data.force - seg_data.force[-1]
+    indentation = seg_data.indentation
+    if params['downsample_flag']:
+        downfactor = len(indentation) // params['pts_downsample']
+        idxDown = list(range(0, len(indentation), downfactor))
+        indentation = indentation[idxDown]
+        force = force[idxDown]
+    return indentation, force
+
+def compute_hertz_preview(file, curve_idx, params, fit_data, stages):
+    force_curve, baseline, poc, indented_curve, indentation_key = run_common_stages(
+        stages, file, curve_idx, params, params['curve_seg'])
+    ext_data = force_curve.extend_segments[0][1]
+    ret_data = force_curve.retract_segments[-1][1]
+    data_key = (indentation_key, params['curve_seg'], params['downsample_flag'], params['pts_downsample'])
+    indentation, force = stages.run('hertz_data', data_key, get_hertz_data, indented_curve, params)
+    preview = {
+        'ext_zheight': ext_data.zheight, 'ext_vdeflection': ext_data.vdeflection,
+        'ret_zheight': ret_data.zheight, 'ret_vdeflection': ret_data.vdeflection,
+        'maxoffset': baseline['maxoffset'], 'minoffset': baseline['minoffset'], 'poc': poc,
+        'indentation': indentation, 'force': force, 'fit_data': fit_data
+    }
+    # The fit overlay changes with the results, it is always computed
+    if fit_data is not None:
+        preview['fit'] = fit_data.eval(indentation)
+        preview['residuals'] = fit_data.get_residuals(indentation, force)
+    return preview
+
+def get_ting_data(indented_curve, params):
+    ext_data = indented_curve.extend_segments[0][1]
+    ret_data = indented_curve.retract_segments[-1][1]
+    ext_force, ret_force = ext_data.force, ret_data.force
+    if params['vdragcorr']:
+        ext_force, ret_force = correct_viscous_drag(
+            ext_data.indentation, ext_force, ret_data.indentation, ret_force,
+            poly_order=params['polyordr'], speed=params['rampspeed'])
+    idx_tc = (np.abs(ext_data.indentation - 0)).argmin()
+    t0 = ext_data.time[-1]
+    indentation = np.r_[ext_data.indentation, ret_data.indentation]
+    time = np.r_[ext_data.time, ret_data.time + t0]
+    force = np.r_[ext_force, ret_force]
+    fit_mask = indentation > (-1 * params['contact_offset'])
+    tc = time[idx_tc]
+    ind_fit = indentation[fit_mask]
+    force_fit = force[fit_mask]
+    force_fit = force_fit - force_fit[0]
+    time_fit = time[fit_mask]
+    tc_fit = tc-time_fit[0]
+    time_fit = time_fit - time_fit[0] - tc_fit
+    downfactor = len(time_fit) // params['pts_downsample']
+    idxDown = list(range(0, len(time_fit), downfactor))
+    return {
+        'ext_indentation': ext_data.indentation, 'ext_force': ext_force,
+        'ret_indentation': ret_data.indentation, 'ret_force': ret_force,
+        'time_fit': time_fit[idxDown], 'force_fit': force_fit[idxDown], 'ind_fit': ind_fit[idxDown],
+        'tc_fit': tc_fit
+    }
+
+def compute_ting_preview(file, curve_idx, params, fit_data, hertz_d0, stages):
+    force_curve, baseline, poc, indented_curve, indentation_key = run_common_stages(
+        stages, file, curve_idx, params, 'both', poc_offset=hertz_d0)
+    ext_data = force_curve.extend_segments[0][1]
+    ret_data = force_curve.retract_segments[-1][1]
+    data_key = (
+        indentation_key, params['vdragcorr'], params['polyordr'], params['rampspeed'],
+        params['contact_offset'], params['pts_downsample']
+    )
+    preview = dict(stages.run('ting_data', data_key, get_ting_data, indented_curve, params))
+    preview.update({
+        'ext_zheight': ext_data.zheight, 'ext_vdeflection': ext_data.vdeflection,
+        'ret_zheight': ret_data.zheight, 'ret_vdeflection': ret_data.vdeflection,
+        'maxoffset': baseline['maxoffset'], 'minoffset': baseline['minoffset'], 'poc': poc,
+        'fit_data': fit_data
+    })
+    # The fit overlay changes with the results, it is always computed
+    if fit_data is not None:
+        fit_args = (preview['time_fit'], preview['force_fit'], preview['ind_fit'])
+        fit_kwargs = dict(
+            t0=params['t0'], idx_tm=fit_data.idx_tm, smooth_w=fit_data.smooth_w,
+            v0t=fit_data.v0t, v0r=fit_data.v0r
+        )
+        preview['fit'] = fit_data.eval(*fit_args, **fit_kwargs)
+        preview['residuals'] = fit_data.get_residuals(*fit_args, **fit_kwargs)
+    return preview
+
+def get_modulation_data(force_curve, method):
+    segments = []
+    t0 = 0
+    t0_2 = 0
+    if method == 'FFT':
+        # Spectra of all the segments computed at once
+        psds = get_psds([segment for _, segment in force_curve.modulation_segments])
+    elif method == 'Lock-in':
+        amplitudes = get_lock_in_amplitudes([segment for _, segment in force_curve.modulation_segments])
+    for i, (_, segment) in enumerate(force_curve.modulation_segments):
+        time = segment.time
+        freq = segment.segment_metadata['frequency']
+        plot_time = time + t0
+        segment_preview = {
+            'freq': freq, 'time': plot_time, 'raw_time': time,
+            'zheight': segment.zheight, 'vdeflection': segment.vdeflection
+        }
+        t0 = plot_time[-1]
+        if method == 'FFT':
+            W, psd_height, psd_deflect = psds[i]
+            segment_preview.update({'W': W, 'psd_height': psd_height, 'psd_deflect': psd_deflect})
+        elif method == 'Lock-in':
+            segment_preview.update({'amp_height': amplitudes[i][0], 'amp_deflect': amplitudes[i][1]})
+        elif method == 'Sine Fit':
+            zheight, vdeflection, time_2 =\
+                detrend_rolling_average(freq, segment.zheight, segment.vdeflection, time, 'zheight', 'deflection', [])
+            plot_time_2 = time_2 - time_2[0] + t0_2
+            segment_preview.update({
+                'detrended_time': plot_time_2, 'detrended_raw_time': time_2,
+                'detrended_indentation': zheight - vdeflection, 'detrended_vdeflection': vdeflection
+            })
+            t0_2 = plot_time_2[-1]
+        segments.append(segment_preview)
+    return segments
+
+def compute_microrheo_preview(file, curve_idx, params, method, curve_result, stages):
+    force_curve, curve_key = load_curve_stage(stages, file, curve_idx, params)
+    if force_curve.modulation_segments == []:
+        return None
+    _, _, poc, indented_curve, _ = run_common_stages(stages, file, curve_idx, params)
+    ext_data = force_curve.extend_segments[0][1]
+    indapp = indented_curve.extend_segments[0][1].indentation
+    preview = {
+        'ext_zheight': ext_data.zheight, 'ext_vdeflection': ext_data.vdeflection,
+        'indapp': indapp, 'forceapp': indented_curve.extend_segments[0][1].force,
+        'maxind': indapp.max()*1e9
+    }
+    segments = stages.run('modulation', (curve_key, method), get_modulation_data, force_curve, method)
+    # The fit overlay changes with the results, it is always computed
+    if curve_result is not None and method == 'Sine Fit':
+        freqs, ind_results, defl_results = curve_result[0], curve_result[3], curve_result[4]
+        if ind_results is not None and defl_results is not None:
+            segments = [dict(segment) for segment in segments]
+            for segment in segments:
+                idx = int((np.abs(np.array(freqs) - segment['freq'])).argmin())
+                segment['indentation_fit'] = -1 * ind_results[idx].eval(time=segment['detrended_raw_time'])
+                segment['deflection_fit'] = defl_results[idx].eval(time=segment['detrended_raw_time'])
+    preview['segments'] = segments
+    return preview
@@ -0,0 +1,103 @@
+# Import for multiprocessing
+import os
+import time
+import concurrent.futures
+from functools import partial
+from concurrent.futures.process import BrokenProcessPool
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import constants
+import pyfmgui.const as cts
+
+def get_pool_size():
+    # Leave one core free for the GUI thread. On Windows
+    # ProcessPoolExecutor does not support more than 61 workers.
+    nb_workers = cts.pool_max_workers or (os.cpu_count() or 1) - 1
+    return max(1, min(nb_workers, 61))
+
+def init_worker():
+    # Import the heavy modules once per worker, so the jobs
+    # submitted afterwards do not pay for them.
+    import pyfmreader
+    import pyfmrheo.routines
+    import pyfmgui.compute
+    import pyfmgui.loadfiles
+    import pyfmgui.export
+
+def warmup_worker(delay):
+    # Keep the worker busy for a moment so the executor has
+    # to spawn a new process for the next warm up task.
+    time.sleep(delay)
+    return os.getpid()
+
+class ProcessPool:
+    '''
+    Long lived pool of worker processes shared by all the jobs
+    launched from the GUI (loading, computing and exporting).
+
+    The executor is created lazily and recreated if one of its
+    workers dies, so callers can always use ProcessPool.submit.
+    '''
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or get_pool_size()
+        self.warmup_time = None
+        self._executor = None
+        self._warmup_start = None
+        self._warmup_pending = 0
+        # Incremented every time the workers are spawned, warm up
+        # tasks of a previous executor are ignored when they finish.
+        self._generation = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers, initializer=init_worker
+            )
+        return self._executor
+
+    def start(self):
+        # Spawn all the workers without blocking the caller.
+        # The warm up cost is logged once every worker is ready.
+        self._generation += 1
+        self._warmup_start = time.perf_counter()
+        futures = [
+            self.executor.submit(warmup_worker, cts.pool_warmup_delay)
+            for _ in range(self.max_workers)
+        ]
+        self._warmup_pending = len(futures)
+        for future in futures:
+            future.add_done_callback(partial(self._on_warmup_done, self._generation))
+
+    def _on_warmup_done(self, generation, future):
+        if generation != self._generation:
+            # Cancelled when the previous executor was shut down
+            return
+        self._warmup_pending -= 1
+        if self._warmup_pending > 0:
+            return
+        self.warmup_time = time.perf_counter() - self._warmup_start
+        if future.cancelled() or future.exception() is not None:
+            logger.info('Failed to warm up the process pool.')
+            return
+        logger.info(f'Process pool ready: {self.max_workers} workers warmed up in {self.warmup_time:.2f} s')
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            return self.executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # A worker died (e.g. crashed while decoding a file),
+            # replace the executor and try once more.
+            self.restart()
+            return self.executor.submit(fn, *args, **kwargs)
+
+    def restart(self):
+        logger.info('Restarting process pool...')
+        self.shutdown()
+        self.start()
+
+    def shutdown(self, wait=False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
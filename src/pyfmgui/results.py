@@ -0,0 +1,252 @@
+from abc import ABC, abstractmethod
+import numpy as np
+# Import models to rebuild the fit results
+from pyfmrheo.models.hertz import HertzModel
+from pyfmrheo.models.ting import TingModel
+
+# Columns saved for each model: (column name, model attribute, kind)
+# kind --> float, optional (float or None), int (int or None), bool or str
+hertz_columns = [
+    ('hertz_ind_geometry', 'ind_geom', 'str'),
+    ('hertz_tip_parameter', 'tip_parameter', 'float'),
+    ('hertz_apply_BEC', 'apply_bec_flag', 'bool'),
+    ('hertz_BEC_model', 'bec_model', 'str'),
+    ('hertz_fit_hline_on_baseline', 'fit_hline_flag', 'bool'),
+    ('hertz_delta0', 'delta0', 'float'),
+    ('hertz_E0', 'E0', 'float'),
+    ('hertz_f0', 'f0', 'float'),
+    ('hertz_slope', 'slope', 'optional'),
+    ('hertz_poisson_ratio', 'poisson_ratio', 'float'),
+    ('hertz_sample_height', 'sample_height', 'optional'),
+    ('hertz_MAE', 'MAE', 'float'),
+    ('hertz_MSE', 'MSE', 'float'),
+    ('hertz_RMSE', 'RMSE', 'float'),
+    ('hertz_Rsquared', 'Rsquared', 'float'),
+    ('hertz_chisq', 'chisq', 'float'),
+    ('hertz_redchi', 'redchi', 'float')
+]
+
+# Only needed to rebuild the model, not exported
+hertz_model_columns = hertz_columns + [
+    ('hertz_n_params', 'n_params', 'int')
+]
+
+ting_columns = [
+    ('ting_ind_geometry', 'ind_geom', 'str'),
+    ('ting_tip_parameter', 'tip_parameter', 'float'),
+    ('ting_modelFt', 'modelFt', 'str'),
+    ('ting_apply_BEC', 'apply_bec_flag', 'bool'),
+    ('ting_BEC_model', 'bec_model', 'str'),
+    ('ting_fit_hline_on_baseline', 'fit_hline_flag', 'bool'),
+    ('ting_t0', 't0', 'float'),
+    ('ting_E0', 'E0', 'float'),
+    ('ting_tc', 'tc', 'float'),
+    ('ting_betaE', 'betaE', 'float'),
+    ('ting_f0', 'F0', 'float'),
+    ('ting_poisson_ratio', 'poisson_ratio', 'float'),
+    ('ting_vdrag', 'vdrag', 'float'),
+    ('ting_smooth_w', 'smooth_w', 'int'),
+    ('ting_idx_tm', 'idx_tm', 'int'),
+    ('ting_MAE', 'MAE', 'float'),
+    ('ting_MSE', 'MSE', 'float'),
+    ('ting_RMSE', 'RMSE', 'float'),
+    ('ting_Rsquared', 'Rsquared', 'float'),
+    ('ting_chisq', 'chisq', 'float'),
+    ('ting_redchi', 'redchi', 'float')
+]
+
+# Only needed to rebuild the model, not exported
+ting_model_columns = ting_columns + [
+    ('ting_n_params', 'n_params', 'int'),
+    ('ting_v0t', 'v0t', 'optional'),
+    ('ting_v0r', 'v0r', 'optional')
+]
+
+def empty_value(kind):
+    # Value saved for the attributes that are None
+    if kind == 'bool':
+        return False
+    elif kind == 'str':
+        return None
+    return np.nan
+
+def empty_column(kind, size):
+    if kind == 'bool':
+        return np.zeros(size, dtype=bool)
+    elif kind == 'str':
+        return np.full(size, None, dtype=object)
+    return np.full(size, np.nan)
+
+def to_attribute(value, kind):
+    # Convert the stored value back to the type used by the model
+    if kind == 'bool':
+        return bool(value)
+    elif kind == 'optional':
+        return None if np.isnan(value) else float(value)
+    elif kind == 'int':
+        return None if np.isnan(value) else int(value)
+    return value
+
+def read_columns(model, columns):
+    return {name: getattr(model, attribute, None) for name, attribute, _ in columns}
+
+def write_columns(model, columns, row):
+    for name, attribute, kind in columns:
+        setattr(model, attribute, to_attribute(row[name], kind))
+    return model
+
+class ResultStore:
+    '''
+    Results of one method for one file, saved by curve index.
+
+    Iterating over the store yields (curve_idx, result) pairs,
+    including the errors raised while processing the curves.
+    '''
+    def __init__(self):
+        # Map curve index --> result
+        self.results = {}
+        self.errors = {}
+
+    def add(self, curve_idx, result):
+        if isinstance(result, Exception):
+            self.results.pop(curve_idx, None)
+            self.errors[curve_idx] = result
+        else:
+            self.errors.pop(curve_idx, None)
+            self.results[curve_idx] = result
+
+    def get(self, curve_idx):
+        # Returns None if the curve was not processed or failed
+        return self.results.get(curve_idx)
+
+    def __iter__(self):
+        yield from sorted(list(self.results.items()) + list(self.errors.items()), key=lambda item: item[0])
+
+    def __len__(self):
+        return len(self.results) + len(self.errors)
+
+class ColumnarResultStore(ResultStore, ABC):
+    '''
+    Saves the scalar values of the fitted models in arrays indexed by
+    curve index. The models are rebuilt from the arrays when requested,
+    the full objects are only kept if keep_objects is True.
+
+    :param keep_objects: Keep the objects returned by the routines.
+    :type keep_objects: bool
+
+    '''
+    columns = []
+    # Columns in the exported tables
+    export_columns = []
+
+    def __init__(self, keep_objects=False):
+        super(ColumnarResultStore, self).__init__()
+        self.keep_objects = keep_objects
+        self.objects = {}
+        self.data = {name: empty_column(kind, 0) for name, _, kind in self.columns}
+        self.kinds = {name: kind for name, _, kind in self.columns}
+        self.filled = np.zeros(0, dtype=bool)
+
+    def _grow(self, size):
+        capacity = max(size, 2 * len(self.filled))
+        for name, _, kind in self.columns:
+            column = empty_column(kind, capacity)
+            column[:len(self.filled)] = self.data[name]
+            self.data[name] = column
+        # Resize the mask last, so readers never see a row without data
+        filled = np.zeros(capacity, dtype=bool)
+        filled[:len(self.filled)] = self.filled
+        self.filled = filled
+
+    @abstractmethod
+    def unpack(self, result):
+        # Result of a curve --> dict with the values of its columns
+        pass
+
+    @abstractmethod
+    def pack(self, row):
+        # Dict with the values of the columns --> rebuilt result
+        pass
+
+    def add(self, curve_idx, result):
+        if isinstance(result, Exception) or result is None:
+            if curve_idx < len(self.filled):
+                self.filled[curve_idx] = False
+            self.objects.pop(curve_idx, None)
+            self.errors[curve_idx] = result
+            return
+        self.errors.pop(curve_idx, None)
+        if curve_idx >= len(self.filled):
+            self._grow(curve_idx + 1)
+        for name, value in self.unpack(result).items():
+            self.data[name][curve_idx] = empty_value(self.kinds[name]) if value is None else value
+        self.filled[curve_idx] = True
+        if self.keep_objects:
+            self.objects[curve_idx] = result
+
+    def get(self, curve_idx):
+        if curve_idx is None or curve_idx >= len(self.filled) or not self.filled[curve_idx]:
+            return None
+        if curve_idx in self.objects:
+            return self.objects[curve_idx]
+        return self.pack({name: column[curve_idx] for name, column in self.data.items()})
+
+    @property
+    def indices(self):
+        # Indices of the curves with results
+        return np.flatnonzero(self.filled)
+
+    def export_indices(self):
+        # Sorted indices of the curves with results or errors
+        errors = np.fromiter(self.errors.keys(), dtype=int, count=len(self.errors))
+        return np.union1d(self.indices, errors)
+
+    def export_column(self, name, indices, out):
+        # Write the values of the column for the given curve
+        # indices in out, failed curves are left empty.
+        valid = np.zeros(len(indices), dtype=bool)
+        in_range = indices < len(self.filled)
+        valid[in_range] = self.filled[indices[in_range]]
+        out[~valid] = np.nan if out.dtype.kind == 'f' else None
+        out[valid] = self.data[name][indices[valid]]
+
+    def __iter__(self):
+        items = [(idx, self.get(idx)) for idx in self.indices.tolist()]
+        yield from sorted(items + list(self.errors.items()), key=lambda item: item[0])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.filled)) + len(self.errors)
+
+class HertzResultStore(ColumnarResultStore):
+    columns = hertz_model_columns
+    export_columns = hertz_columns
+
+    def unpack(self, hertz_result):
+        return read_columns(hertz_result, hertz_model_columns)
+
+    def pack(self, row):
+        hertz_result = HertzModel(row['hertz_ind_geometry'], row['hertz_tip_parameter'])
+        return write_columns(hertz_result, hertz_model_columns, row)
+
+class TingResultStore(ColumnarResultStore):
+    # TingFit returns the TingFit and HertzFit results
+    columns = ting_model_columns + hertz_model_columns
+    export_columns = hertz_columns + ting_columns
+
+    def unpack(self, result):
+        ting_result, hertz_result = result
+        row = read_columns(ting_result, ting_model_columns)
+        row.update(read_columns(hertz_result, hertz_model_columns))
+        return row
+
+    def pack(self, row):
+        ting_result = TingModel(row['ting_ind_geometry'], row['ting_tip_parameter'], row['ting_modelFt'])
+        hertz_result = HertzModel(row['hertz_ind_geometry'], row['hertz_tip_parameter'])
+        return write_columns(ting_result, ting_model_columns, row), write_columns(hertz_result, hertz_model_columns, row)
+
+def new_result_store(method, keep_objects=False):
+    if method == 'HertzFit':
+        return HertzResultStore(keep_objects)
+    elif method == 'TingFit':
+        return TingResultStore(keep_objects)
+    return ResultStore()
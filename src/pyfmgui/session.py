@@ -1,5 +1,11 @@
+from pyfmgui.process_pool import ProcessPool
+from pyfmgui.curve_cache import get_memory_cache
+from pyfmgui.prefetch import CurvePrefetcher
+
 class Session:
     def __init__(self):
+        self.process_pool = ProcessPool()
+        self.curve_prefetcher = CurvePrefetcher()
         self.loaded_files_paths = []
         self.loaded_files = {}
         self.hertz_fit_results = {}
@@ -8,6 +14,7 @@ class Session:
         self.piezo_char_results = {}
         self.vdrag_results = {}
         self.microrheo_results = {}
+        self.poc_maps = {}
         self.current_file=None
         self.map_coords = None
         self.current_curve_index=None
@@ -35,6 +42,7 @@ class Session:
         'vdrag_results': None,
         'microrheo_results': None
         }
+        self.prepared_results_rows = {}
     
     def remove_piezo_char_data(self):
         self.piezo_char_data = None
@@ -43,12 +51,15 @@ class Session:
     def remove_results(self):
         self.loaded_files_paths = []
         self.loaded_files = {}
+        self.curve_prefetcher.cancel()
+        get_memory_cache().clear()
         self.hertz_fit_results = {}
         self.thermal_tune_results = {}
         self.ting_fit_results = {}
         self.piezo_char_results = {}
         self.vdrag_results = {}
         self.microrheo_results = {}
+        self.poc_maps = {}
     
     def remove_data_and_results(self):
         self.remove_results()
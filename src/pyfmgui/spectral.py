@@ -0,0 +1,427 @@
+import copy
+from functools import lru_cache
+from collections import defaultdict
+import numpy as np
+from scipy.fft import rfft, rfftfreq
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import routines and models from PyFMRheo
+from pyfmrheo.utils.force_curves import get_poc_RoV_method, get_poc_regulaFalsi_method
+from pyfmrheo.utils.signal_processing import detrend_rolling_average
+from pyfmrheo.routines.HertzFit import doHertzFit
+from pyfmrheo.routines.ViscousDragSteps import get_retract_ramp_sizes
+from pyfmrheo.models.rheology import single_freq_models, ComputeComplexModulusSine
+from pyfmrheo.models.sine import SineWave
+
+def stack_rfft(signals):
+    # Real FFT of a list of signals with the same number of points in a
+    # single call. scipy.fft keeps the plans of the recent sizes cached.
+    return rfft(np.stack(signals), axis=-1)
+
+def get_psds(segments):
+    '''
+    Power spectral density of the zheight and deflection of a list of
+    modulation segments, the segments with the same number of points are
+    transformed together.
+
+    Returns a list with (frequencies, zheight PSD, deflection PSD) for each
+    segment, only for the positive frequencies, as plotted in the widgets.
+    '''
+    psds = [None] * len(segments)
+    groups = defaultdict(list)
+    for i, segment in enumerate(segments):
+        groups[len(segment.vdeflection)].append(i)
+    for nfft, group in groups.items():
+        spectra = stack_rfft([segments[i].zheight for i in group] + [segments[i].vdeflection for i in group])
+        psd = (spectra * np.conj(spectra)).real / nfft
+        L = np.arange(1, np.floor(nfft/2), dtype='int')
+        for row, i in enumerate(group):
+            time = segments[i].time
+            W = rfftfreq(nfft, d=time[1] - time[0])
+            psds[i] = (W[L], psd[row, L], psd[len(group) + row, L])
+    return psds
+
+@lru_cache(maxsize=256)
+def get_coherence_kernel(nfft, idx):
+    # Hann window times the DFT basis at bin idx, used to compute the
+    # coherence at a single bin from the first half of the spectrum.
+    j = np.arange(nfft // 2 + 1)
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * j / nfft)
+    return window * np.exp(-2j * np.pi * idx * j / nfft)
+
+def get_bin(spectra, nfft, idx):
+    # Value at bin idx of the full spectrum of real signals
+    if idx <= nfft // 2:
+        return spectra[:, idx]
+    return np.conj(spectra[:, nfft - idx])
+
+def windowed_bin(spectra, nfft, idx):
+    # Bin idx of the FFT of the Hann windowed full spectrum, the second
+    # half of the spectrum is the conjugate of the first one.
+    kernel = get_coherence_kernel(nfft, idx)
+    tail = nfft - nfft // 2
+    return spectra @ kernel + np.conj(spectra[:, 1:tail] @ kernel[1:tail])
+
+def fit_length(signal, nfft):
+    # The input is cropped or zero padded to the length of the output
+    if len(signal) >= nfft:
+        return signal[:nfft]
+    return np.pad(signal, (0, nfft - len(signal)))
+
+def get_drive_bin(job, nfft):
+    # Index and frequency of the spectrum bin of the drive frequency
+    deltat = 1 / job['fs']
+    idx = int(np.round(job['frequency'] / (1 / (deltat * nfft))))
+    if not 0 <= idx < nfft:
+        raise IndexError(f"The frequency {job['frequency']} is out of the spectrum")
+    W = (idx if idx < (nfft + 1) // 2 else idx - nfft) / (deltat * nfft)
+    if not abs(job['frequency'] - W) <= job.get('freq_tol', 0.0001):
+        logger.info(f"The frequency found at index {W} does not match with the frequency applied {job['frequency']}")
+    return idx, W
+
+def get_transfer_functions(jobs):
+    '''
+    Transfer function between the input and output signals of each job at
+    its drive frequency, same values as TransferFunction from PyFMRheo.
+    The jobs with the same number of points are transformed together and
+    only the drive frequency bins are extracted from the spectra.
+
+    :param jobs: List of dicts with the 'input' and 'output' signals, the
+                 sampling frequency 'fs' and the drive frequency 'frequency'.
+    :type jobs: list
+
+    Returns a list with (frequency, G, gamma2, input_hat, output_hat) for each job.
+    '''
+    results = [None] * len(jobs)
+    groups = defaultdict(list)
+    for i, job in enumerate(jobs):
+        groups[len(job['output'])].append(i)
+    for nfft, group in groups.items():
+        spectra = stack_rfft([fit_length(jobs[i]['input'], nfft) for i in group] + [jobs[i]['output'] for i in group])
+        for row, i in enumerate(group):
+            idx, W = get_drive_bin(jobs[i], nfft)
+            rows = spectra[[row, len(group) + row]]
+            input_hat, output_hat = get_bin(rows, nfft, idx)
+            # Coherence of the spectra as computed by TransferFunction,
+            # a single segment spanning the whole spectrum
+            input_w, output_w = windowed_bin(rows, nfft, idx)
+            results[i] = (W, output_hat / input_hat, get_coherence(input_w, output_w), input_hat, output_hat)
+    return results
+
+def get_coherence(input_hat, output_hat):
+    Pxy = np.conj(input_hat) * output_hat
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.abs(Pxy)**2 / np.abs(input_hat)**2 / np.abs(output_hat)**2
+
+@lru_cache(maxsize=16)
+def get_lock_in_reference(nfft, idx):
+    # Complex reference oscillating at the frequency of bin idx
+    return np.exp(-2j * np.pi * idx * np.arange(nfft) / nfft)
+
+def demodulate(signal, idx):
+    # Lock-in demodulation, the value of bin idx of the DFT of signal
+    return signal @ get_lock_in_reference(len(signal), idx)
+
+def get_lock_in_transfer_functions(jobs):
+    '''
+    Same as get_transfer_functions, demodulating the signals at the drive
+    frequency instead of transforming them. Each signal is multiplied by
+    a complex reference, O(N) and without computing any spectrum.
+
+    The coherence computed by TransferFunction uses a single segment, it
+    is 1 unless a signal has no power at the drive frequency, here it is
+    computed from the demodulated values.
+    '''
+    results = []
+    for job in jobs:
+        nfft = len(job['output'])
+        idx, W = get_drive_bin(job, nfft)
+        input_hat = demodulate(fit_length(job['input'], nfft), idx)
+        output_hat = demodulate(job['output'], idx)
+        results.append((W, output_hat / input_hat, get_coherence(input_hat, output_hat), input_hat, output_hat))
+    return results
+
+def get_lock_in_amplitudes(segments):
+    # Amplitude of the zheight and deflection of each modulation
+    # segment at its drive frequency, for the preview plots.
+    amplitudes = []
+    for segment in segments:
+        nfft = len(segment.vdeflection)
+        job = {'frequency': segment.segment_metadata['frequency'], 'fs': 1 / (segment.time[1] - segment.time[0])}
+        idx, _ = get_drive_bin(job, nfft)
+        zheight = segment.zheight - segment.zheight.mean()
+        vdeflection = segment.vdeflection - segment.vdeflection.mean()
+        amplitudes.append((2 * np.abs(demodulate(zheight, idx)) / nfft, 2 * np.abs(demodulate(vdeflection, idx)) / nfft))
+    return amplitudes
+
+def get_piezo_correction(param_dict, frequency, fi, amp_quotient):
+    # Phase and amplitude corrections from the piezo characterization,
+    # the previous values are kept if the frequency is out of its range.
+    if param_dict['piezo_char_data'] is not None:
+        correction = param_dict['piezo_char_data'].get(frequency)
+        if correction is None:
+            logger.info(f"The frequency {frequency} is out of the range of the piezo characterization")
+        else:
+            fi = correction[0] # In degrees
+            if param_dict['corr_amp']:
+                amp_quotient = correction[1]
+            else:
+                amp_quotient = 1
+    return fi, amp_quotient
+
+def get_modulation_jobs(fdc, param_dict):
+    # Detrended signals of the modulation segments to analyze
+    jobs = []
+    for seg_id, segment in fdc.modulation_segments:
+        time = segment.time
+        frequency = segment.segment_metadata['frequency']
+        if param_dict['max_freq'] != 0 and frequency > param_dict['max_freq']:
+            continue
+        zheight, deflection, detrended_time =\
+            detrend_rolling_average(frequency, segment.zheight, segment.vdeflection, time, 'zheight', 'deflection', [])
+        jobs.append({
+            'seg_id': seg_id, 'frequency': frequency, 'fs': 1 / (time[1] - time[0]),
+            'time': detrended_time, 'zheight': zheight, 'deflection': deflection
+        })
+    return jobs
+
+def prepare_piezo_char(fdc, param_dict):
+    jobs = get_modulation_jobs(fdc, param_dict)
+    for job in jobs:
+        job['input'], job['output'] = job['zheight'], job['deflection']
+    return None, jobs
+
+def finish_piezo_char(context, jobs, transfer_functions):
+    # Same results as doPiezoCharacterization
+    results = []
+    for job, (_, G, gamma2, zheight_hat, deflection_hat) in zip(jobs, transfer_functions):
+        fi = np.angle(G, deg=True)
+        amp_quotient = np.abs(deflection_hat) / np.abs(zheight_hat)
+        results.append((job['frequency'], fi, amp_quotient, gamma2))
+    results = sorted(results, key=lambda x: int(x[0]))
+    return tuple([x[i] for x in results] for i in range(4))
+
+def prepare_vdrag(fdc, param_dict):
+    fi, amp_quotient = 0, 1
+    jobs = get_modulation_jobs(fdc, param_dict)
+    for job in jobs:
+        fi, amp_quotient = get_piezo_correction(param_dict, job['frequency'], fi, amp_quotient)
+        job['fi'], job['amp_quotient'] = fi, amp_quotient
+        job['input'] = job['zheight'] * amp_quotient - job['deflection']
+        job['output'] = job['deflection'] * param_dict['k']
+    return get_retract_ramp_sizes(fdc), jobs
+
+def finish_vdrag(distances, jobs, transfer_functions):
+    # Same results as doViscousDragSteps
+    results = []
+    for job, (_, G, gamma2, _, _) in zip(jobs, transfer_functions):
+        Hd = G * np.exp(-1 * np.radians(job['fi']))
+        Bh = np.imag(Hd) / (2 * np.pi * job['frequency'])
+        results.append((job['seg_id'], job['frequency'], Bh, Hd, gamma2, job['fi'], job['amp_quotient']))
+    results = sorted(results, key=lambda x: int(x[0]))
+    frequencies_results = [x[1] for x in results]
+    Bh_results = [x[2] for x in results]
+    Hd_results = np.array([x[3] for x in results])
+    gamma2_results = [x[4] for x in results]
+    fi_results = [x[5] for x in results]
+    amp_quotient_results = [x[6] for x in results]
+    return (frequencies_results, Bh_results, Hd_results, gamma2_results, distances, fi_results, amp_quotient_results)
+
+def get_working_indentation(fdc, param_dict):
+    # Working indentation obtained as in doMicrorheologyFFT
+    if param_dict['curve_seg'] == 'extend':
+        segment_data = fdc.extend_segments[0][1]
+    else:
+        segment_data = fdc.retract_segments[-1][1]
+        segment_data.zheight = segment_data.zheight[::-1]
+        segment_data.vdeflection = segment_data.vdeflection[::-1]
+    if param_dict['poc_method'] == 'RoV':
+        comp_PoC = get_poc_RoV_method(
+            segment_data.zheight, segment_data.vdeflection, param_dict['poc_win'])
+    else:
+        comp_PoC = get_poc_regulaFalsi_method(
+            segment_data.zheight, segment_data.vdeflection, param_dict['sigma'])
+    poc = [comp_PoC[0], 0]
+    # Perform HertzFit to obtain refined posiiton of PoC
+    hertz_result = doHertzFit(copy.deepcopy(fdc), param_dict)
+    poc[0] += hertz_result.delta0
+    segment_data.get_force_vs_indentation(poc, param_dict['k'])
+    if param_dict.get('wc') is None:
+        return segment_data.indentation.max()
+    return param_dict.get('wc')
+
+def prepare_microrheo(fdc, param_dict):
+    wc = get_working_indentation(fdc, param_dict)
+    fi, amp_quotient = 0, 1
+    jobs = get_modulation_jobs(fdc, param_dict)
+    for job in jobs:
+        fi, amp_quotient = get_piezo_correction(param_dict, job['frequency'], fi, amp_quotient)
+        job['fi'], job['amp_quotient'] = fi, amp_quotient
+        # In contact, d0 is 0
+        job['input'] = job['zheight'] * amp_quotient - job['deflection']
+        job['output'] = job['deflection'] * param_dict['k']
+    return (param_dict, wc), jobs
+
+def finish_microrheo(context, jobs, transfer_functions):
+    # Same results as doMicrorheologyFFT
+    param_dict, wc = context
+    bcoef = param_dict['bcoef']
+    model_func = single_freq_models[param_dict['contact_model']]
+    results = []
+    for job, (_, G, gamma2, _, _) in zip(jobs, transfer_functions):
+        G_storage, G_loss = model_func(
+            G, wc, param_dict['tip_param'], job['frequency'], job['fi'], bcoef, param_dict['poisson'])
+        results.append((job['frequency'], G_storage, G_loss, gamma2, job['fi'], job['amp_quotient']))
+    results = sorted(results, key=lambda x: int(x[0]))
+    return tuple([x[i] for x in results] for i in range(6)) + (bcoef, wc)
+
+def get_sine_design(time, frequency):
+    # Columns of the sine model at a known frequency, linear in the
+    # sin and cos coefficients and the offset
+    omega = 2 * np.pi * frequency
+    return np.column_stack([np.sin(omega * time), np.cos(omega * time), np.ones(len(time))])
+
+def get_sine_waves(design, waves, omega):
+    '''
+    Least squares sine fit of a stack of waves sampled at the same times,
+    one wave per column, solved with a single lstsq call.
+
+    Returns a SineWave for each wave, with the same parameters and goodness
+    of fit metrics as SineWave.fit. The amplitudes are always positive.
+    '''
+    coefs = np.linalg.lstsq(design, waves, rcond=None)[0]
+    predictions = design @ coefs
+    errors = predictions - waves
+    squared_errors = errors * errors
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chisq_terms = squared_errors / waves
+    chisq = np.where(np.isfinite(chisq_terms), chisq_terms, 0).sum(axis=0)
+    MSE = squared_errors.mean(axis=0)
+    Rsquared = 1.0 - errors.var(axis=0) / waves.var(axis=0)
+    # a * sin(wt) + b * cos(wt) = A * sin(wt + phase)
+    amplitudes = np.hypot(coefs[0], coefs[1])
+    phases = np.arctan2(coefs[1], coefs[0])
+    sine_waves = []
+    for col in range(waves.shape[1]):
+        sine_wave = SineWave(omega)
+        sine_wave.n_params = 3
+        sine_wave.amplitude, sine_wave.phase, sine_wave.offset = amplitudes[col], phases[col], coefs[2, col]
+        sine_wave.MAE = errors[:, col].mean()
+        sine_wave.SE = squared_errors[:, col]
+        sine_wave.MSE = MSE[col]
+        sine_wave.RMSE = np.sqrt(MSE[col])
+        sine_wave.Rsquared = Rsquared[col]
+        sine_wave.chisq = chisq[col]
+        sine_wave.redchi = chisq[col] / sine_wave.n_params
+        sine_waves.append(sine_wave)
+    return sine_waves
+
+def get_sine_fits(jobs):
+    '''
+    Sine fits of the input and output signals of each job at its drive
+    frequency, same model as doMicrorheologySine. With a known frequency
+    the fit is linear, the jobs sampled at the same times are stacked
+    and solved together, so all the curves of a block share a single
+    lstsq call per modulation segment.
+
+    :param jobs: List of dicts with the 'input' and 'output' signals, their
+                 'time' and the drive frequency 'frequency'.
+    :type jobs: list
+
+    Returns a list with (input SineWave, output SineWave) for each job.
+    '''
+    results = [None] * len(jobs)
+    groups = defaultdict(list)
+    for i, job in enumerate(jobs):
+        time = job['time']
+        groups[(len(time), job['frequency'], time[0], time[-1])].append(i)
+    for (_, frequency, _, _), group in groups.items():
+        design = get_sine_design(jobs[group[0]]['time'], frequency)
+        waves = np.column_stack([jobs[i]['input'] for i in group] + [jobs[i]['output'] for i in group])
+        sine_waves = get_sine_waves(design, waves, 2 * np.pi * frequency)
+        for col, i in enumerate(group):
+            results[i] = (sine_waves[col], sine_waves[len(group) + col])
+    return results
+
+def prepare_microrheo_sine(fdc, param_dict):
+    wc = get_working_indentation(fdc, param_dict)
+    fi, amp_quotient = 0, 1
+    jobs = get_modulation_jobs(fdc, param_dict)
+    for job in jobs:
+        fi, amp_quotient = get_piezo_correction(param_dict, job['frequency'], fi, amp_quotient)
+        job['fi'], job['amp_quotient'] = fi, amp_quotient
+        # Indentation in contact, d0 is 0
+        job['input'] = job['zheight'] - job['deflection']
+        job['output'] = job['deflection']
+    return (param_dict, wc), jobs
+
+def finish_microrheo_sine(context, jobs, sine_fits):
+    # Same results as doMicrorheologySine
+    param_dict, wc = context
+    bcoef = param_dict['bcoef']
+    results = []
+    for job, (ind_sine_wave, defl_sine_wave) in zip(jobs, sine_fits):
+        dPhi = defl_sine_wave.phase - ind_sine_wave.phase
+        G = ComputeComplexModulusSine(
+            defl_sine_wave.amplitude, ind_sine_wave.amplitude, wc, dPhi, job['frequency'],
+            param_dict['contact_model'], param_dict['tip_param'], param_dict['k'], fi=job['fi'],
+            amp_quotient=job['amp_quotient'], bcoef=bcoef, poisson_ratio=param_dict['poisson']
+        )
+        results.append((job['frequency'], G.real, G.imag, ind_sine_wave, defl_sine_wave, job['fi'], job['amp_quotient']))
+    results = sorted(results, key=lambda x: int(x[0]))
+    return tuple([x[i] for x in results] for i in range(7)) + (bcoef, wc)
+
+# Map relating methods to their (prepare, analyze, finish) steps, the
+# analyze step processes the jobs of all the curves of a block at once
+spectral_routines = {
+    "PiezoChar": (prepare_piezo_char, get_transfer_functions, finish_piezo_char),
+    "VDrag": (prepare_vdrag, get_transfer_functions, finish_vdrag),
+    "Microrheo": (prepare_microrheo, get_transfer_functions, finish_microrheo),
+    "MicrorheoLockIn": (prepare_microrheo, get_lock_in_transfer_functions, finish_microrheo),
+    "MicrorheoSine": (prepare_microrheo_sine, get_sine_fits, finish_microrheo_sine)
+}
+
+def analyze_spectral_block(force_curves, param_dict):
+    '''
+    Run a spectral routine on a block of curves. The modulation segments of
+    all the curves are prepared first and analyzed together.
+
+    Returns a list with the result of each curve, or the error raised
+    if the curve could not be processed.
+    '''
+    prepare, analyze, finish = spectral_routines[param_dict['method']]
+    prepared = []
+    all_jobs = []
+    for fdc in force_curves:
+        try:
+            context, jobs = prepare(fdc, param_dict)
+            prepared.append((context, len(all_jobs), len(jobs)))
+            all_jobs.extend(jobs)
+        except Exception as error:
+            prepared.append(error)
+    try:
+        analyzed = analyze(all_jobs)
+    except Exception:
+        # Find the jobs that failed, curve by curve
+        analyzed = None
+    results = []
+    for fdc, item in zip(force_curves, prepared):
+        if isinstance(item, Exception):
+            results.append(item)
+            continue
+        context, start, nb_jobs = item
+        jobs = all_jobs[start:start+nb_jobs]
+        try:
+            curve_results = analyzed[start:start+nb_jobs] if analyzed is not None else analyze(jobs)
+            results.append(finish(context, jobs, curve_results))
+        except Exception as error:
+            results.append(error)
+    return results
+
+def doSpectralRoutine(fdc, param_dict):
+    # Same interface as the routines of PyFMRheo, for single curves
+    result = analyze_spectral_block([fdc], param_dict)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
@@ -1,6 +1,11 @@
 import PyQt5
 from pyqtgraph.Qt import QtCore
 import traceback, sys
+import threading
+import concurrent.futures
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
 
 class WorkerSignals(QtCore.QObject):
     '''
@@ -17,6 +22,9 @@ class WorkerSignals(QtCore.QObject):
     result
         object data returned from processing, anything
 
+    results
+        str id of the file whose results in the session were updated
+
     '''
     finished = QtCore.pyqtSignal()
     error = QtCore.pyqtSignal(tuple)
@@ -24,6 +32,7 @@ class WorkerSignals(QtCore.QObject):
     progress = QtCore.pyqtSignal(int)
     range = QtCore.pyqtSignal(int)
     step = QtCore.pyqtSignal(str)
+    results = QtCore.pyqtSignal(str)
 
 class Worker(QtCore.QObject):
     '''
@@ -50,6 +59,19 @@ class Worker(QtCore.QObject):
         self.kwargs['progress_callback'] = self.signals.progress
         self.kwargs['range_callback'] = self.signals.range
         self.kwargs['step_callback'] = self.signals.step
+        self.kwargs['results_callback'] = self.signals.results
+
+        # Event checked by the callback to stop early
+        self.stop_event = threading.Event()
+        self.kwargs['stop_event'] = self.stop_event
+
+    def stop(self):
+        '''
+        Ask the callback to stop. It is called from the GUI thread,
+        the callback cancels its pending tasks and keeps the results
+        that were already completed.
+        '''
+        self.stop_event.set()
 
     @QtCore.pyqtSlot()
     def run(self):
@@ -58,10 +80,70 @@ class Worker(QtCore.QObject):
         '''
         # Retrieve args/kwargs here; and fire processing using them
         try:
-            self.fn(*self.args, **self.kwargs)
+            result = self.fn(*self.args, **self.kwargs)
         except:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
             self.signals.error.emit((exctype, value, traceback.format_exc()))
+        else:
+            self.signals.result.emit(result)
+            if self.stop_event.is_set():
+                logger.info('Job cancelled, completed results have been kept.')
         finally:
-            self.signals.finished.emit()  # Done
\ No newline at end of file
+            self.signals.finished.emit()  # Done
+class PreviewSignals(QtCore.QObject):
+    '''
+    Signals used to send the results of a preview computed
+    in a background thread to the GUI thread.
+    '''
+    result = QtCore.pyqtSignal(object)
+
+class PreviewRunner:
+    '''
+    Runs the computations needed to draw a widget in a background
+    thread, so the GUI stays responsive while curves are loaded and
+    processed.
+
+    Only the last request matters: requests still queued when a new
+    one is submitted are dropped and the results of stale requests
+    are discarded. The callback is called in the GUI thread with the
+    value returned by fn.
+    '''
+    def __init__(self):
+        self.signals = PreviewSignals()
+        self.signals.result.connect(self._on_result)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='preview')
+        self._request_id = 0
+        self._pending = None
+
+    def submit(self, callback, fn, *args, **kwargs):
+        self._request_id += 1
+        if self._pending is not None:
+            self._pending.cancel()
+        self._pending = self._executor.submit(self._run, self._request_id, callback, fn, args, kwargs)
+
+    def _run(self, request_id, callback, fn, args, kwargs):
+        # Skip requests made obsolete while they were queued
+        if request_id != self._request_id:
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as error:
+            logger.info(f'Failed to compute preview: {error}')
+            logger.debug(traceback.format_exc())
+            return
+        self.signals.result.emit((request_id, callback, result))
+
+    def _on_result(self, item):
+        request_id, callback, result = item
+        if request_id != self._request_id:
+            return
+        callback(result)
+
+    def cancel(self):
+        # Results of the requests already submitted are ignored
+        self._request_id += 1
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,201 @@
+import time
+import numpy as np
+# Import logging and get global logger
+import logging
+logger = logging.getLogger()
+# Import constants
+import pyfmgui.const as cts
+# Import batched PoC detection
+from pyfmgui.poc import get_poc_segment, get_segments_poc
+# Import models and routines from PyFMRheo
+from pyfmrheo.models.hertz import HertzModel
+from pyfmrheo.routines.TingFit import doTingFit
+
+def get_map_coords(file):
+    # Curve index of each pixel of a force map, same layout as the
+    # one displayed in the widgets. Falls back to a single row of
+    # pixels if the map geometry can not be read from the file.
+    nb_curves = file.filemetadata['Entry_tot_nb_curve']
+    try:
+        if file.filemetadata['file_type'] in cts.jpk_file_extensions:
+            img = file.imagedata.get('Height(measured)', None)
+            if img is None:
+                img = file.imagedata.get('Height', None)
+            rows, cols = np.rot90(np.fliplr(img)).shape[:2]
+            curve_coords = np.rot90(np.fliplr(np.arange(cols*rows).reshape((cols, rows))))
+            if file.filemetadata['file_type'] == "jpk-force-map":
+                curve_coords = np.asarray([row[::(-1)**i] for i, row in enumerate(curve_coords)])
+        else:
+            rows, cols = file.piezoimg.shape[:2]
+            curve_coords = np.arange(cols*rows).reshape((cols, rows))
+        if curve_coords.size >= nb_curves:
+            return curve_coords
+    except Exception as error:
+        logger.debug(f"Failed to read the map geometry of file {file.filemetadata['Entry_filename']}: {error}")
+    return np.arange(nb_curves).reshape((1, nb_curves))
+
+def get_tiles(map_coords, tile_size, nb_curves):
+    '''
+    Split a force map in square tiles of tile_size pixels per side.
+    The pixels of each tile are ordered row by row, alternating the
+    direction of the rows, so every pixel but the first one has at
+    least one neighbour fitted before it.
+
+    Returns a list of tiles, each tile is a list of (curve_idx, neighbours)
+    pairs, where neighbours are the curve indices of the adjacent pixels
+    of the tile that come before it.
+    '''
+    nx, ny = map_coords.shape[:2]
+    tiles = []
+    for x0 in range(0, nx, tile_size):
+        for y0 in range(0, ny, tile_size):
+            x1, y1 = min(x0 + tile_size, nx), min(y0 + tile_size, ny)
+            tile = []
+            done = set()
+            for row, x in enumerate(range(x0, x1)):
+                columns = range(y0, y1) if row % 2 == 0 else range(y1 - 1, y0 - 1, -1)
+                for y in columns:
+                    curve_idx = int(map_coords[x, y])
+                    if curve_idx >= nb_curves:
+                        continue
+                    neighbours = [
+                        int(map_coords[x + dx, y + dy]) for dx, dy in ((-1, 0), (0, -1), (0, 1), (1, 0))
+                        if x0 <= x + dx < x1 and y0 <= y + dy < y1 and int(map_coords[x + dx, y + dy]) in done
+                    ]
+                    tile.append((curve_idx, neighbours))
+                    done.add(curve_idx)
+            if tile:
+                tiles.append(tile)
+    return tiles
+
+class SeededHertzModel(HertzModel):
+    '''
+    HertzModel that starts the fit from the values of a seed instead
+    of the default initial values, and counts the evaluations of the
+    model done by the optimiser.
+
+    :param seed: Initial values of the fit parameters by name, None to use the defaults.
+    :type seed: dict
+
+    '''
+    def __init__(self, ind_geom, tip_param, bec_model=None, seed=None) -> None:
+        super(SeededHertzModel, self).__init__(ind_geom, tip_param, bec_model)
+        self.seed = seed
+        self.nfev = 0
+        self._evaluating = False
+
+    def build_params(self):
+        params = super(SeededHertzModel, self).build_params()
+        for name, value in (self.seed or {}).items():
+            if name in params and np.isfinite(value) and params[name].min < value < params[name].max:
+                params[name].set(value=value)
+        return params
+
+    def model(self, indentation, delta0, E0, f0, slope=None, sample_height=None):
+        # Evaluations done to compute the fit metrics are not counted
+        if not self._evaluating:
+            self.nfev += 1
+        return super(SeededHertzModel, self).model(indentation, delta0, E0, f0, slope, sample_height)
+
+    def eval(self, indentation, sample_height=None):
+        self._evaluating = True
+        try:
+            return super(SeededHertzModel, self).eval(indentation, sample_height)
+        finally:
+            self._evaluating = False
+
+def doHertzFitSeeded(fdc, param_dict, seed=None):
+    # Same as doHertzFit, with the fit started from seed
+    zheight, vdeflection = get_poc_segment(fdc, param_dict)
+    poc = get_segments_poc([(zheight, vdeflection)], param_dict)[0]
+    if np.isnan(poc):
+        raise ValueError('Failed to compute the PoC')
+    # Downsample signal
+    if param_dict['downsample_flag']:
+        downfactor= len(zheight) // param_dict['pts_downsample']
+        zheight, vdeflection = zheight[::downfactor], vdeflection[::downfactor]
+    # Prepare data for the fit
+    indentation = zheight - vdeflection - poc
+    force = vdeflection * param_dict['k']
+    force = force - force[0]
+    contact_mask = indentation >= 0
+    cont_ind, cont_force = indentation[contact_mask], force[contact_mask]
+    if param_dict['fit_range_type'] == 'indentation':
+        mask = (cont_ind >= param_dict['min_ind']) & (cont_ind <= param_dict['max_ind'])
+        cont_ind, cont_force = cont_ind[mask], cont_force[mask]
+    elif param_dict['fit_range_type'] == 'force':
+        mask = (cont_force >= param_dict['min_force']) & (cont_force <= param_dict['max_force'])
+        cont_ind, cont_force = cont_ind[mask], cont_force[mask]
+    indentation = np.r_[indentation[~contact_mask], cont_ind]
+    force = np.r_[force[~contact_mask], cont_force]
+    # Perform fit
+    hertz_model = SeededHertzModel(param_dict['contact_model'], param_dict['tip_param'], seed=seed)
+    hertz_model.fit_hline_flag = param_dict['fit_line']
+    hertz_model.f0_init = param_dict['f0']
+    if param_dict['fit_line']:
+        hertz_model.slope_init = param_dict['slope']
+    hertz_model.fit(indentation, force)
+    return hertz_model
+
+def get_seed(neighbour_results, method):
+    # Initial values from the median of the fitted neighbours
+    if not neighbour_results:
+        return None
+    if method == 'HertzFit':
+        names = ('E0', 'delta0', 'f0', 'slope')
+        values = [[getattr(result, name) for result in neighbour_results] for name in names]
+    else:
+        # Ting results are (TingModel, HertzModel) pairs
+        names = ('betaE', 'f0')
+        values = [[result[0].betaE for result in neighbour_results], [result[1].f0 for result in neighbour_results]]
+    return {name: float(np.median(column)) for name, column in zip(names, values) if None not in column}
+
+def fit_seeded(fdc, param_dict, seed=None):
+    '''
+    Fit a curve with HertzFit or TingFit starting from the values in seed.
+    The cost of the fit is saved in the fit_cost attribute of the model:
+    whether it was seeded, the model evaluations and the time spent.
+
+    doTingFit only takes the initial fluid exponent and the f0 of its
+    Hertz fit from the parameters, those are the values seeded for it.
+    '''
+    t0 = time.perf_counter()
+    if param_dict['method'] == 'HertzFit':
+        result = doHertzFitSeeded(fdc, param_dict, seed)
+        result.fit_cost = {'seeded': seed is not None, 'nfev': result.nfev}
+    else:
+        if seed is not None:
+            param_dict = dict(param_dict, auto_init_betaE=False, fluid_exp=seed['betaE'], f0=seed['f0'])
+        result = doTingFit(fdc, param_dict)
+        result[0].fit_cost = {'seeded': seed is not None, 'nfev': None}
+    model = result if param_dict['method'] == 'HertzFit' else result[0]
+    model.fit_cost['time'] = time.perf_counter() - t0
+    return result
+
+class WarmStartReport:
+    '''
+    Compares the cost of the fits started from the values of their
+    neighbours with the ones started from the default values.
+    '''
+    def __init__(self):
+        self.costs = {True: [], False: []}
+
+    def add(self, result):
+        model = result[0] if isinstance(result, tuple) else result
+        fit_cost = getattr(model, 'fit_cost', None)
+        if fit_cost is not None:
+            self.costs[fit_cost['seeded']].append(fit_cost)
+
+    def describe(self, seeded):
+        costs = self.costs[seeded]
+        if not costs:
+            return f"0 {'seeded' if seeded else 'unseeded'} fits"
+        mean_time = np.mean([cost['time'] for cost in costs]) * 1e3
+        text = f"{len(costs)} {'seeded' if seeded else 'unseeded'} fits, {mean_time:.1f} ms"
+        nfev = [cost['nfev'] for cost in costs if cost['nfev'] is not None]
+        if nfev:
+            text += f" and {np.mean(nfev):.1f} model evaluations"
+        return text + " per fit"
+
+    def summary(self):
+        return f"Warm start: {self.describe(True)}; {self.describe(False)}"
@@ -5,6 +5,7 @@ import numpy as np
 from pyqtgraph.parametertree import Parameter, ParameterTree
 
 import pyfmgui.const as cts
+from pyfmgui.curve_cache import get_force_curve
 
 def summarize_metadata(current_file_metadata):
     return {
@@ -47,6 +48,8 @@ class DataViewerWidget(QtWidgets.QWidget):
         self.paramTree.setParameters(self.params, showTop=False)
 
         self.l = pg.GraphicsLayoutWidget()
+        # Connected once, the map plot is added to and removed from this scene
+        self.l.scene().sigMouseClicked.connect(self.mouseMoved)
 
         ## Add 3 plots into the first row (automatic position)
         self.plotItem = pg.PlotItem(lockAspect=True)
@@ -78,6 +81,9 @@ class DataViewerWidget(QtWidgets.QWidget):
         layout.setColumnStretch(1, 4)
     
     def mouseMoved(self,event):
+        # The map is only shown for force maps
+        if self.plotItem.scene() is None:
+            return
         vb = self.plotItem.vb
         scene_coords = event.scenePos()
         if self.correlogram.sceneBoundingRect().contains(scene_coords):
@@ -144,10 +150,9 @@ class DataViewerWidget(QtWidgets.QWidget):
             deflection_sens = self.session.current_file.filemetadata['defl_sens_nmbyV'] / 1e9
         else:
             deflection_sens = self.session.global_involts
-        force_curve = self.session.current_file.getcurve(idx)
-        force_curve.preprocess_force_curve(deflection_sens, height_channel)
-        if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
-            force_curve.shift_height()
+        force_curve = get_force_curve(self.session.current_file, idx, deflection_sens, height_channel)
+        # Load the curves around the selected pixel in the background
+        self.session.curve_prefetcher.prefetch(self.session.current_file, self.session.map_coords, idx, deflection_sens, height_channel)
         self.make_plot(force_curve)
     
     def updatePlots(self, item=None):
@@ -169,7 +174,6 @@ class DataViewerWidget(QtWidgets.QWidget):
             self.plotItem.setLabel('left', 'y pixels')
             self.plotItem.setLabel('bottom', 'x pixels')
             self.plotItem.addItem(self.ROI)
-            self.plotItem.scene().sigMouseClicked.connect(self.mouseMoved)
             # create transform to center the corner element on the origin, for any assigned image:
             if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
                 img = self.session.current_file.imagedata.get('Height(measured)', None)
@@ -3,7 +3,7 @@ from pyqtgraph.Qt import QtWidgets, QtCore, QtGui
 from pyqtgraph import TableWidget
 
 from pyfmgui.threading import Worker
-from pyfmgui.export import result_types, prepare_export_results, export_results
+from pyfmgui.export import result_types, prepare_export_results, export_results, get_export_formats
 
 class ExportDialog(QtWidgets.QWidget):
     def __init__(self, session, parent=None):
@@ -47,6 +47,12 @@ class ExportDialog(QtWidgets.QWidget):
         self.save_folder_bttn.setText("Browse")
         self.save_folder_bttn.clicked.connect(self.get_save_folder)
 
+        self.file_format_label = QtWidgets.QLabel("File Format")
+        self.file_format_label.setAlignment(QtCore.Qt.AlignmentFlag.AlignRight | QtCore.Qt.AlignmentFlag.AlignVCenter)
+        self.file_format_label.setMaximumWidth(150)
+        self.file_format_cb = QtWidgets.QComboBox()
+        self.file_format_cb.addItems(get_export_formats())
+
         self.layout_2 = QtWidgets.QHBoxLayout()
         self.layout_2.addWidget(self.updateButton)
         self.layout_2.addWidget(self.exportButton)
@@ -55,6 +61,8 @@ class ExportDialog(QtWidgets.QWidget):
         gridlayout.addWidget(self.file_prefix_text, 0, 1, 1, 2)
         gridlayout.addWidget(self.save_folder_label, 1, 0, 1, 1)
         gridlayout.addWidget(self.save_folder_text, 1, 1, 1, 2)
+        gridlayout.addWidget(self.file_format_label, 2, 0, 1, 1)
+        gridlayout.addWidget(self.file_format_cb, 2, 1, 1, 1)
         gridlayout.addWidget(self.save_folder_bttn, 2, 2, 1, 1)
         gridlayout.addWidget(self.results_cb, 3, 0, 1, 2)
         gridlayout.addLayout(self.layout_2, 3, 2, 1, 1)
@@ -82,6 +90,7 @@ class ExportDialog(QtWidgets.QWidget):
         self.session.pbar_widget.show()
         self.thread = QtCore.QThread()
         self.worker = Worker(prepare_export_results, self.session)
+        self.session.pbar_widget.set_worker(self.worker)
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
         self.worker.signals.progress.connect(self.reportProgress)
@@ -95,11 +104,31 @@ class ExportDialog(QtWidgets.QWidget):
     def reportProgress(self, n):
         self.session.pbar_widget.set_pbar_value(n)
     
+    def changestep(self, step):
+        self.session.pbar_widget.set_label_sub_text(step)
+    
     def oncomplete(self):
         self.thread.terminate()
         self.session.pbar_widget.hide()
         self.session.pbar_widget.reset_pbar()
         self.update_table()
+    
+    def onexportcomplete(self):
+        self.thread.terminate()
+        self.session.pbar_widget.hide()
+        self.session.pbar_widget.reset_pbar()
+        self.exportButton.setEnabled(True)
+    
+    def onexported(self, success_flag):
+        if success_flag:
+            self.open_msg_box("Export was successful!")
+        elif not self.worker.stop_event.is_set():
+            self.open_msg_box("No results were found to export!")
+    
+    def onexportfailed(self, error):
+        # The incomplete files were already removed by the export
+        _, value, _ = error
+        self.open_msg_box(f"Export failed: {value}")
         
     def update_table(self):
         result_key = self.results_cb.currentText()
@@ -107,12 +136,11 @@ class ExportDialog(QtWidgets.QWidget):
         if self.results[result_key] is None:
             self.table_preview.clear()
         else:
-            res = self.results[result_key].to_dict('records')
-            if len(res) < 50:
-                self.table_preview.setData(self.results[result_key].to_dict('records'))
-            else:
-                self.table_preview.setData(self.results[result_key].head(50).to_dict('records'))
-                self.open_msg_box(f"Showing only first 50 out of {len(res)} results.")
+            # Only the first rows are prepared for the preview
+            nb_rows = self.session.prepared_results_rows.get(result_key, len(self.results[result_key]))
+            self.table_preview.setData(self.results[result_key].to_dict('records'))
+            if nb_rows > len(self.results[result_key]):
+                self.open_msg_box(f"Showing only first {len(self.results[result_key])} out of {nb_rows} results.")
     
     def open_msg_box(self, message):
         dlg = QtWidgets.QMessageBox(self)
@@ -123,11 +151,25 @@ class ExportDialog(QtWidgets.QWidget):
     def doexport(self):
         self.file_prefix = self.file_prefix_text.toPlainText()
         if self.dirname and self.file_prefix:
-            success_flag = export_results(self.results, self.dirname, self.file_prefix)
-            if success_flag:
-                self.open_msg_box("Export was successful!")
-            else:
-                self.open_msg_box("No results were found to export!")
+            file_format = self.file_format_cb.currentText()
+            self.session.pbar_widget.reset_pbar()
+            self.session.pbar_widget.set_label_text('Exporting Results...')
+            self.session.pbar_widget.set_label_sub_text('')
+            self.session.pbar_widget.show()
+            self.thread = QtCore.QThread()
+            # Results are written to disk as they are unpacked
+            self.worker = Worker(export_results, self.session, self.dirname, self.file_prefix, file_format)
+            self.session.pbar_widget.set_worker(self.worker)
+            self.worker.moveToThread(self.thread)
+            self.thread.started.connect(self.worker.run)
+            self.worker.signals.progress.connect(self.reportProgress)
+            self.worker.signals.range.connect(self.setPbarRange)
+            self.worker.signals.step.connect(self.changestep)
+            self.worker.signals.result.connect(self.onexported)
+            self.worker.signals.error.connect(self.onexportfailed)
+            self.worker.signals.finished.connect(self.onexportcomplete)
+            self.exportButton.setEnabled(False)
+            self.thread.start()
         elif self.dirname is None:
             self.open_msg_box("Please provide a directory!")
         elif self.file_prefix == "":
@@ -9,14 +9,14 @@ def get_params(params, method):
     param_dict['height_channel'] = analysis_params.child('Height Channel').value()
     param_dict['def_sens'] = analysis_params.child('Deflection Sensitivity').value() / 1e9
     param_dict['k'] = analysis_params.child('Spring Constant').value()
-    if method in ("PiezoChar", "VDrag", "Microrheo", "MicrorheoSine"):
+    if method in ("PiezoChar", "VDrag", "Microrheo", "MicrorheoLockIn", "MicrorheoSine"):
         param_dict['max_freq'] = analysis_params.child('Max Frequency').value()
-    if method in ("VDrag", "Microrheo", "MicrorheoSine"):
+    if method in ("VDrag", "Microrheo", "MicrorheoLockIn", "MicrorheoSine"):
         correction_params = params.child('Correction Params')
         param_dict['corr_amp'] = correction_params.child('Correct Amplitude').value()
     if method in ("PiezoChar", "VDrag"):
         return param_dict
-    if method in ("Microrheo", "MicrorheoSine"):
+    if method in ("Microrheo", "MicrorheoLockIn", "MicrorheoSine"):
         param_dict['bcoef'] = analysis_params.child('B Coef').value()
         param_dict['wc'] = analysis_params.child('Working Indentation').value() / 1e9 # nm
     param_dict['contact_model'] = analysis_params.child('Contact Model').value()
@@ -36,12 +36,17 @@ def get_params(params, method):
         param_dict['max_offset'] = analysis_params.child('Abs. Max Offset').value() / 1e9 #nm
     
     # HertzFit specific parameters
-    if method  in ("HertzFit", "Microrheo", "MicrorheoSine"):
+    if method  in ("HertzFit", "Microrheo", "MicrorheoLockIn", "MicrorheoSine"):
         hertz_params = params.child('Hertz Fit Params')
         param_dict['poisson'] = hertz_params.child('Poisson Ratio').value()
         param_dict['poc_method'] = hertz_params.child('PoC Method').value()
         param_dict['poc_win'] = hertz_params.child('PoC Window').value() / 1e9 #nm
         param_dict['sigma'] = hertz_params.child('Sigma').value()
+        if method == "HertzFit":
+            # lmfit --> iterative fit, closed form --> fast estimate with d0 fixed at the PoC
+            param_dict['fit_method'] = hertz_params.child('Fit Method').value()
+            # Fit the maps in tiles, starting each fit from its fitted neighbours
+            param_dict['warm_start'] = hertz_params.child('Warm Start').value()
         param_dict['downsample_flag'] = hertz_params.child('Downsample Signal').value()
         param_dict['pts_downsample'] = hertz_params.child('Downsample Pts.').value()
         param_dict['auto_init_E0'] = hertz_params.child('Auto Init E0').value()
@@ -68,6 +73,7 @@ def get_params(params, method):
         param_dict['poc_method'] = ting_params.child('PoC Method').value()
         param_dict['poc_win'] = ting_params.child('PoC Window').value() / 1e9 #nm
         param_dict['sigma'] = ting_params.child('Sigma').value()
+        param_dict['warm_start'] = ting_params.child('Warm Start').value()
         param_dict['max_ind'] = ting_params.child('Max Indentation').value() / 1e9 #nm
         param_dict['min_ind'] = ting_params.child('Min Indentation').value() / 1e9 #nm
         param_dict['max_force'] = ting_params.child('Max Force').value() / 1e9 #nN
@@ -3,15 +3,16 @@ from pyqtgraph.Qt import QtGui, QtWidgets, QtCore
 import pyqtgraph as pg
 from pyqtgraph.parametertree import Parameter, ParameterTree
 import numpy as np
+from functools import partial
 import logging
 logger = logging.getLogger()
 
 import pyfmgui.const as cts
-from pyfmgui.threading import Worker
-from pyfmgui.compute import compute
+from pyfmgui.threading import Worker, PreviewRunner
+from pyfmgui.compute import compute, compute_poc_map
+from pyfmgui.preview import StageCache, compute_hertz_preview
 from pyfmgui.widgets.get_params import get_params
-
-from pyfmrheo.utils.force_curves import get_poc_RoV_method, get_poc_regulaFalsi_method, correct_tilt, correct_offset
+from pyfmgui.widgets.update_scheduler import UpdateScheduler
 
 class HertzFitWidget(QtWidgets.QWidget):
     def __init__(self, session, parent=None):
@@ -21,9 +22,15 @@ class HertzFitWidget(QtWidgets.QWidget):
         self.min_val_line = None
         self.max_val_line = None
         self.offset_roi = None
+        self.indentation = None
         self.file_dict = {}
+        self.preview = PreviewRunner()
+        # Outputs of the preview stages, reused while their inputs do not change
+        self.preview_stages = StageCache()
         self.session.hertz_fit_widget = self
         self.init_gui()
+        self.updates = UpdateScheduler([('preview', self.updatePlots), ('fit_range', self.update_fit_range)], parent=self)
+        self.connectParams()
         if self.session.loaded_files != {}:
             self.updateCombo()
 
@@ -37,6 +44,10 @@ class HertzFitWidget(QtWidgets.QWidget):
         self.pushButton.setText("Compute")
         self.pushButton.clicked.connect(self.do_hertzfit)
 
+        self.pocButton = QtWidgets.QPushButton("pocButton")
+        self.pocButton.setText("PoC Map")
+        self.pocButton.clicked.connect(self.do_poc_map)
+
         self.combobox = QtWidgets.QComboBox()
         self.combobox.currentTextChanged.connect(self.file_changed)
 
@@ -46,10 +57,13 @@ class HertzFitWidget(QtWidgets.QWidget):
         self.paramTree.setParameters(self.params, showTop=False)
 
         self.l2 = pg.GraphicsLayoutWidget()
+        # Connected once, the map plot is added to and removed from this scene
+        self.l2.scene().sigMouseClicked.connect(self.mouseMoved)
 
         params_layout.addWidget(self.combobox, 1)
         params_layout.addWidget(self.paramTree, 3)
         params_layout.addWidget(self.pushButton, 1)
+        params_layout.addWidget(self.pocButton, 1)
         params_layout.addWidget(self.l2, 2)
 
         self.l = pg.GraphicsLayoutWidget()
@@ -77,6 +91,8 @@ class HertzFitWidget(QtWidgets.QWidget):
         main_layout.addWidget(self.l, 3)
     
     def closeEvent(self, evnt):
+        self.updates.cancel()
+        self.preview.shutdown()
         self.session.hertz_fit_widget = None
     
     def clear(self):
@@ -102,6 +118,7 @@ class HertzFitWidget(QtWidgets.QWidget):
         self.thread = QtCore.QThread()
         # Create worker to run compute
         self.worker = Worker(compute, self.session, params, filedict, "HertzFit")
+        self.session.pbar_widget.set_worker(self.worker)
         # Move worker to thread
         self.worker.moveToThread(self.thread)
         # When thread starts run worker
@@ -109,7 +126,8 @@ class HertzFitWidget(QtWidgets.QWidget):
         self.worker.signals.progress.connect(self.reportProgress)
         self.worker.signals.range.connect(self.setPbarRange)
         self.worker.signals.step.connect(self.changestep)
-        self.worker.signals.finished.connect(self.oncomplete) # Reset button
+        self.worker.signals.results.connect(self.updateResults)
+        self.worker.signals.finished.connect(partial(self.oncomplete, 'ElasticityFit')) # Reset button
         # Start thread
         self.thread.start()
         # Final resets
@@ -117,6 +135,37 @@ class HertzFitWidget(QtWidgets.QWidget):
         # Update the gui
         self.updatePlots()
     
+    def do_poc_map(self):
+        if not self.current_file or not self.current_file.isFV:
+            return
+        params = get_params(self.params, "HertzFit")
+        logger.info('Started PoC map...')
+        self.session.pbar_widget.reset_pbar()
+        self.session.pbar_widget.set_label_text('Computing PoC map...')
+        self.session.pbar_widget.show()
+        # Create thread and worker to compute the PoC of every curve
+        self.thread = QtCore.QThread()
+        self.worker = Worker(compute_poc_map, self.session, params, self.current_file)
+        self.session.pbar_widget.set_worker(self.worker)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.signals.progress.connect(self.reportProgress)
+        self.worker.signals.range.connect(self.setPbarRange)
+        self.worker.signals.step.connect(self.changestep)
+        self.worker.signals.results.connect(self.showPocMap)
+        self.worker.signals.finished.connect(partial(self.oncomplete, 'PoC map'))
+        self.thread.start()
+        self.pushButton.setEnabled(False)
+        self.pocButton.setEnabled(False)
+
+    def showPocMap(self, file_id):
+        # Display the PoC heights in place of the height image
+        poc_map = self.session.poc_maps.get(file_id)
+        if poc_map is None or self.session.map_coords is None:
+            return
+        if self.current_file and file_id == self.current_file.filemetadata['Entry_filename']:
+            self.correlogram.setImage(poc_map[self.session.map_coords])
+    
     def changestep(self, step):
         self.session.pbar_widget.set_label_sub_text(step)
     
@@ -126,13 +175,19 @@ class HertzFitWidget(QtWidgets.QWidget):
     def setPbarRange(self, n):
         self.session.pbar_widget.set_pbar_range(0, n)
     
-    def oncomplete(self):
+    def updateResults(self, file_id):
+        # Show the new results if they belong to the file being displayed
+        if self.current_file and file_id == self.current_file.filemetadata['Entry_filename']:
+            self.updatePlots()
+    
+    def oncomplete(self, job_name):
         self.thread.terminate()
         self.session.pbar_widget.hide()
         self.session.pbar_widget.reset_pbar()
         self.pushButton.setEnabled(True)
+        self.pocButton.setEnabled(True)
         self.updatePlots()
-        logger.info('ElasticityFit completed!')
+        logger.info(f'{job_name} completed!')
 
     def update(self):
         self.current_file = self.session.current_file
@@ -141,7 +196,6 @@ class HertzFitWidget(QtWidgets.QWidget):
         if self.current_file.isFV:
             self.l2.addItem(self.plotItem)
             self.plotItem.addItem(self.ROI)
-            self.plotItem.scene().sigMouseClicked.connect(self.mouseMoved)
             # create transform to center the corner element on the origin, for any assigned image:
             if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
                 img = self.session.current_file.imagedata.get('Height(measured)', None)
@@ -180,6 +234,9 @@ class HertzFitWidget(QtWidgets.QWidget):
         self.update()
     
     def mouseMoved(self,event):
+        # The map is only shown for force maps
+        if self.plotItem.scene() is None:
+            return
         vb = self.plotItem.vb
         scene_coords = event.scenePos()
         if self.correlogram.sceneBoundingRect().contains(scene_coords):
@@ -199,6 +256,22 @@ class HertzFitWidget(QtWidgets.QWidget):
     def updatePlots(self):
         if not self.current_file:
             return
+        current_file_id = self.current_file.filemetadata['Entry_filename']
+        current_curve_indx = self.session.current_curve_index
+        params = get_params(self.params, "HertzFit")
+
+        fit_data = None
+        file_hertz_result = self.session.hertz_fit_results.get(current_file_id, None)
+        if file_hertz_result is not None:
+            fit_data = file_hertz_result.get(current_curve_indx)
+
+        # Load and process the curve in the background, the plots
+        # are drawn when the last requested curve is ready.
+        self.preview.submit(self.drawPlots, compute_hertz_preview, self.current_file, current_curve_indx, params, fit_data, self.preview_stages)
+        # Load the curves around the selected pixel in the background
+        self.session.curve_prefetcher.prefetch(self.current_file, self.session.map_coords, current_curve_indx, params['def_sens'], params['height_channel'])
+
+    def drawPlots(self, preview):
         self.l.clear()
         self.p1.clear()
         self.p2.clear()
@@ -208,104 +281,25 @@ class HertzFitWidget(QtWidgets.QWidget):
 
         self.hertz_E = None
         self.hertz_d0 = 0
-        self.fit_data = None
+        self.fit_data = preview['fit_data']
         self.residual = None
 
-        current_file_id = self.current_file.filemetadata['Entry_filename']
-        current_curve_indx = self.session.current_curve_index
-        
-        analysis_params = self.params.child('Analysis Params')
-        height_channel = analysis_params.child('Height Channel').value()
-        deflection_sens = analysis_params.child('Deflection Sensitivity').value() / 1e9
-        spring_k = analysis_params.child('Spring Constant').value()
-        curve_seg = analysis_params.child('Curve Segment').value()
-        correct_tilt_flag = analysis_params.child('Correct Tilt').value()
-        
-        hertz_params = self.params.child('Hertz Fit Params')
-        poc_method = hertz_params.child('PoC Method').value()
-        poc_win = hertz_params.child('PoC Window').value() / 1e9
-        poc_sigma = hertz_params.child('Sigma').value()
-
-        print(self.current_file)
-        print(type(self.current_file))
-        print(self.current_file.filemetadata['file_path'])
-
-        force_curve = self.current_file.getcurve(current_curve_indx)
-        force_curve.preprocess_force_curve(deflection_sens, height_channel)
-
-        if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
-            force_curve.shift_height()
-
-        file_hertz_result = self.session.hertz_fit_results.get(current_file_id, None)
+        if self.fit_data is not None:
+            self.hertz_E = self.fit_data.E0
+            self.hertz_d0 = self.fit_data.delta0
+            self.hertz_f0 = self.fit_data.f0
+            self.hertz_redchi = self.fit_data.redchi
 
-        # print(file_hertz_result)
-        # print(current_file_id)
+        self.p3.plot(preview['ext_zheight'], preview['ext_vdeflection'])
+        self.p3.plot(preview['ret_zheight'], preview['ret_vdeflection'])
 
-        if file_hertz_result is not None:
-            for curve_indx, curve_hertz_result in file_hertz_result:
-                try:
-                    if curve_hertz_result is None:
-                        continue
-                    if curve_indx == self.session.current_curve_index:
-                        self.hertz_E = curve_hertz_result.E0
-                        self.hertz_d0 = curve_hertz_result.delta0
-                        self.hertz_f0 = curve_hertz_result.f0
-                        self.hertz_redchi = curve_hertz_result.redchi
-                        self.fit_data = curve_hertz_result
-                except Exception:
-                    continue
-
-        ext_data = force_curve.extend_segments[0][1]
-        ret_data = force_curve.retract_segments[-1][1]
-
-        self.p3.plot(ext_data.zheight, ext_data.vdeflection)
-        self.p3.plot(ret_data.zheight, ret_data.vdeflection)
-
-        if curve_seg == 'extend': self.seg_data  = ext_data
-        else: self.seg_data  = ret_data
-        
+        self.maxoffset = preview['maxoffset']
+        self.minoffset = preview['minoffset']
         self.update_tilt_range()
 
-        # Perform tilt correction
-        if correct_tilt_flag:
-            self.seg_data.vdeflection = correct_tilt(
-                self.seg_data.zheight, self.seg_data.vdeflection, self.maxoffset, self.minoffset
-            )
-        else:
-            self.seg_data.vdeflection = correct_offset(
-                self.seg_data.zheight, self.seg_data.vdeflection, self.maxoffset, self.minoffset
-            )
-
-        comp_PoC = [0, 0]
-        
-        if poc_method == 'RoV':
-            comp_PoC = get_poc_RoV_method(self.seg_data.zheight, self.seg_data.vdeflection, poc_win)
-        else:
-            comp_PoC = get_poc_regulaFalsi_method(self.seg_data.zheight, self.seg_data.vdeflection, poc_sigma)
-
-        if comp_PoC is not None:
-            poc = [comp_PoC[0], 0]
-        else:
-            poc = [0, 0]
-
-        force_curve.get_force_vs_indentation(poc, spring_k)
-
-        if curve_seg == 'extend':
-            self.indentation  = ext_data.indentation
-            self.force = ext_data.force
-            self.force = self.force - self.force[0]
-            
-        else:
-            self.indentation  = ret_data.indentation
-            self.force = ret_data.force
-            self.force = self.force - self.force[-1]
-        
-        if hertz_params.child('Downsample Signal').value():
-            pts_downsample = hertz_params.child('Downsample Pts.').value()
-            downfactor= len(self.indentation) // pts_downsample
-            idxDown = list(range(0, len(self.indentation), downfactor))
-            self.indentation = self.indentation[idxDown]
-            self.force = self.force[idxDown]
+        poc = preview['poc']
+        self.indentation = preview['indentation']
+        self.force = preview['force']
 
         self.p1.plot(self.indentation, self.force)
         vertical_line = pg.InfiniteLine(pos=0, angle=90, pen='y', movable=False, label='Init d0', labelOpts={'color':'y', 'position':0.5})
@@ -320,13 +314,12 @@ class HertzFitWidget(QtWidgets.QWidget):
  
         if self.fit_data is not None:
             x = self.indentation
-            y = self.fit_data.eval(x)
-            self.p2.plot(x - self.hertz_d0, y, pen ='g', name='Fit')
+            self.p2.plot(x - self.hertz_d0, preview['fit'], pen ='g', name='Fit')
             style = pg.PlotDataItem(pen=None)
             self.p2legend.addItem(style, f'Hertz E: {self.hertz_E:.2f} Pa')
             self.p2legend.addItem(style, f'Hertz d0: {self.hertz_d0 + poc[0]:.3E} m')
             self.p2legend.addItem(style, f'Red. Chi: {self.hertz_redchi:.3E}')
-            res = self.p4.plot(x - self.hertz_d0, self.fit_data.get_residuals(x, self.force), pen=None, symbol='o')
+            res = self.p4.plot(x - self.hertz_d0, preview['residuals'], pen=None, symbol='o')
             res.setSymbolSize(5)
         
         self.p1.setLabel('left', 'Force', 'N')
@@ -350,18 +343,8 @@ class HertzFitWidget(QtWidgets.QWidget):
         self.l.addItem(self.p4)
     
     def update_tilt_range(self):
+        # Draw the region used to correct the baseline
         dataItems = self.p3.listDataItems()
-        analysis_params = self.params.child('Analysis Params')
-        offset_type = analysis_params.child('Offset Type').value()
-        if offset_type == 'percentage':
-            deltaz = self.seg_data.zheight.max() - self.seg_data.zheight.min()
-            maxperc = analysis_params.child('Perc. Max Offset').value() / 1e2
-            minperc = analysis_params.child('Perc. Min Offset').value() / 1e2
-            self.maxoffset = self.seg_data.zheight.min() + deltaz * maxperc
-            self.minoffset = self.seg_data.zheight.min() + deltaz * minperc
-        else:
-            self.maxoffset = analysis_params.child('Abs. Max Offset').value() / 1e9
-            self.minoffset = analysis_params.child('Abs. Min Offset').value() / 1e9
         if self.offset_roi is not None:
             self.p3.removeItem(self.offset_roi)
         self.offset_roi = pg.LinearRegionItem(brush=(50,50,200,0), pen='w', movable=False)
@@ -372,6 +355,8 @@ class HertzFitWidget(QtWidgets.QWidget):
         self.offset_roi.setRegion([self.minoffset, self.maxoffset])
 
     def update_fit_range(self):
+        if self.indentation is None:
+            return
         hertz_params = self.params.child('Hertz Fit Params')
         fit_range_type = hertz_params.child('Fit Range Type').value()
         if fit_range_type == 'full':
@@ -414,21 +399,15 @@ class HertzFitWidget(QtWidgets.QWidget):
             analysis_params.child('Deflection Sensitivity').setValue(self.current_file.filemetadata['defl_sens_nmbyV'])
         else:
             analysis_params.child('Deflection Sensitivity').setValue(self.session.global_involts)
-        
-        analysis_params.child('Correct Tilt').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Offset Type').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Perc. Min Offset').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Perc. Max Offset').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Abs. Min Offset').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Abs. Max Offset').sigValueChanged.connect(self.updatePlots)
-        
+
+    def connectParams(self):
+        # Changes are coalesced, the curve is only processed again
+        # if the changed parameter is used to compute the preview.
+        analysis_params = self.params.child('Analysis Params')
+        for name in ('Curve Segment', 'Correct Tilt', 'Offset Type', 'Perc. Min Offset', 'Perc. Max Offset', 'Abs. Min Offset', 'Abs. Max Offset'):
+            self.updates.connect(analysis_params.child(name), 'preview')
         hertz_params = self.params.child('Hertz Fit Params')
-        hertz_params.child('Fit Range Type').sigValueChanged.connect(self.update_fit_range)
-        hertz_params.child('Max Indentation').sigValueChanged.connect(self.update_fit_range)
-        hertz_params.child('Min Indentation').sigValueChanged.connect(self.update_fit_range)
-        hertz_params.child('Max Force').sigValueChanged.connect(self.update_fit_range)
-        hertz_params.child('Min Force').sigValueChanged.connect(self.update_fit_range)
-        hertz_params.child('Downsample Signal').sigValueChanged.connect(self.updatePlots)
-        hertz_params.child('PoC Method').sigValueChanged.connect(self.updatePlots)
-        hertz_params.child('PoC Window').sigValueChanged.connect(self.updatePlots)
-        hertz_params.child('Sigma').sigValueChanged.connect(self.updatePlots)
\ No newline at end of file
+        for name in ('Downsample Signal', 'Downsample Pts.', 'PoC Method', 'PoC Window', 'Sigma'):
+            self.updates.connect(hertz_params.child(name), 'preview')
+        for name in ('Fit Range Type', 'Max Indentation', 'Min Indentation', 'Max Force', 'Min Force'):
+            self.updates.connect(hertz_params.child(name), 'fit_range')
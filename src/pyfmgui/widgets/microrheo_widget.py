@@ -4,18 +4,24 @@ from pyqtgraph.Qt import QtGui, QtWidgets, QtCore
 import pyqtgraph as pg
 from pyqtgraph.parametertree import Parameter, ParameterTree
 import numpy as np
-import pandas as pd
-from scipy.fft import fft, fftfreq
+from functools import partial
 import logging
 logger = logging.getLogger()
 
 import pyfmgui.const as cts
 from pyfmrheo.utils.signal_processing import *
-from pyfmgui.threading import Worker
+from pyfmgui.threading import Worker, PreviewRunner
 from pyfmgui.compute import compute
+from pyfmgui.preview import StageCache, compute_microrheo_preview
+from pyfmgui.piezo_char import get_calibration
 from pyfmgui.widgets.get_params import get_params
 
-from pyfmrheo.utils.force_curves import get_poc_RoV_method, get_poc_regulaFalsi_method
+# Map relating the methods in the parameters to compute methods
+method_keys = {
+    "FFT": "Microrheo",
+    "Lock-in": "MicrorheoLockIn",
+    "Sine Fit": "MicrorheoSine"
+}
 
 class MicrorheoWidget(QtWidgets.QWidget):
     def __init__(self, session, parent=None):
@@ -24,6 +30,9 @@ class MicrorheoWidget(QtWidgets.QWidget):
         self.methodkey = None
         self.current_file = None
         self.file_dict = {}
+        self.preview = PreviewRunner()
+        # Outputs of the preview stages, reused while their inputs do not change
+        self.preview_stages = StageCache()
         self.session.microrheo_widget = self
         self.init_gui()
         if self.session.loaded_files != {}:
@@ -68,6 +77,8 @@ class MicrorheoWidget(QtWidgets.QWidget):
         self.paramTree.setParameters(self.params, showTop=False)
 
         self.l2 = pg.GraphicsLayoutWidget()
+        # Connected once, the map plot is added to and removed from this scene
+        self.l2.scene().sigMouseClicked.connect(self.mouseMoved)
 
         params_layout.addWidget(self.combobox, 1)
         params_layout.addLayout(piezochar_select_layout, 1)
@@ -107,6 +118,7 @@ class MicrorheoWidget(QtWidgets.QWidget):
         main_layout.addWidget(self.l, 3)
     
     def closeEvent(self, evnt):
+        self.preview.shutdown()
         self.session.microrheo_widget = None
     
     def clear(self):
@@ -121,10 +133,7 @@ class MicrorheoWidget(QtWidgets.QWidget):
             filedict = self.session.loaded_files
         else:
             filedict = {self.session.current_file.filemetadata['Entry_filename']:self.session.current_file}
-        if self.params.child('Analysis Params').child('Method').value() == "FFT":
-            self.methodkey = "Microrheo"
-        else:
-            self.methodkey = "MicrorheoSine"
+        self.methodkey = method_keys[self.params.child('Analysis Params').child('Method').value()]
         self.session.microrheo_results = {}
         params = get_params(self.params, self.methodkey)
         params['piezo_char_data'] = self.session.piezo_char_data
@@ -140,6 +149,7 @@ class MicrorheoWidget(QtWidgets.QWidget):
         self.thread = QtCore.QThread()
         # Create worker to run compute
         self.worker = Worker(compute, self.session, params, filedict, self.methodkey)
+        self.session.pbar_widget.set_worker(self.worker)
         # Move worker to thread
         self.worker.moveToThread(self.thread)
         # When thread starts run worker
@@ -147,6 +157,7 @@ class MicrorheoWidget(QtWidgets.QWidget):
         self.worker.signals.progress.connect(self.reportProgress)
         self.worker.signals.range.connect(self.setPbarRange)
         self.worker.signals.step.connect(self.changestep)
+        self.worker.signals.results.connect(self.updateResults)
         self.worker.signals.finished.connect(self.oncomplete) # Reset button
         # Start thread
         self.thread.start()
@@ -164,6 +175,11 @@ class MicrorheoWidget(QtWidgets.QWidget):
     def setPbarRange(self, n):
         self.session.pbar_widget.set_pbar_range(0, n)
     
+    def updateResults(self, file_id):
+        # Show the new results if they belong to the file being displayed
+        if self.current_file and file_id == self.current_file.filemetadata['Entry_filename']:
+            self.updatePlots()
+    
     def oncomplete(self):
         self.thread.terminate()
         self.session.pbar_widget.hide()
@@ -179,9 +195,7 @@ class MicrorheoWidget(QtWidgets.QWidget):
         if fname != "":
             self.session.piezo_char_file_path = fname
             self.piezochar_text.setText(os.path.basename(self.session.piezo_char_file_path))
-            piezo_char_data_raw = pd.read_csv(self.session.piezo_char_file_path)
-            piezo_char_data = piezo_char_data_raw[["frequency",  "fi_degrees",  "amp_quotient"]]
-            self.session.piezo_char_data = piezo_char_data.groupby('frequency', as_index=False).median()
+            self.session.piezo_char_data = get_calibration(self.session.piezo_char_file_path)
             if self.session.vdrag_widget:
                 self.session.vdrag_widget.piezochar_text.setText(os.path.basename(self.session.piezo_char_file_path))
         else:
@@ -201,7 +215,6 @@ class MicrorheoWidget(QtWidgets.QWidget):
         if self.current_file.isFV:
             self.l2.addItem(self.plotItem)
             self.plotItem.addItem(self.ROI)
-            self.plotItem.scene().sigMouseClicked.connect(self.mouseMoved)
             # create transform to center the corner element on the origin, for any assigned image:
             if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
                 img = self.session.current_file.imagedata.get('Height(measured)', None)
@@ -244,6 +257,9 @@ class MicrorheoWidget(QtWidgets.QWidget):
         self.update()
     
     def mouseMoved(self,event):
+        # The map is only shown for force maps
+        if self.plotItem.scene() is None:
+            return
         vb = self.plotItem.vb
         scene_coords = event.scenePos()
         if self.correlogram.sceneBoundingRect().contains(scene_coords):
@@ -271,6 +287,33 @@ class MicrorheoWidget(QtWidgets.QWidget):
         if not self.current_file:
             return
 
+        analysis_params = self.params.child('Analysis Params')
+        current_file_id = self.current_file.filemetadata['Entry_filename']
+        current_file = self.current_file
+        current_curve_indx = self.session.current_curve_index
+        method = analysis_params.child('Method').value()
+        params = get_params(self.params, method_keys[method])
+
+        curve_microrheo_result = None
+        microrheo_result = self.session.microrheo_results.get(current_file_id, None)
+        if microrheo_result:
+            curve_microrheo_result = microrheo_result.get(current_curve_indx)
+
+        # Load and process the curve in the background, the plots
+        # are drawn when the last requested curve is ready.
+        self.preview.submit(
+            partial(self.drawPlots, current_file_id, method, curve_microrheo_result), compute_microrheo_preview,
+            current_file, current_curve_indx, params, method, curve_microrheo_result, self.preview_stages
+        )
+        # Load the curves around the selected pixel in the background
+        self.session.curve_prefetcher.prefetch(current_file, self.session.map_coords, current_curve_indx, params['def_sens'], params['height_channel'])
+
+    def drawPlots(self, current_file_id, method, curve_microrheo_result, preview):
+
+        if preview is None:
+            self.open_msg_box(f'No modulation segments found in file:\n {current_file_id}')
+            return
+
         self.l.clear()
         self.p1.clear()
         self.p2.clear()
@@ -292,94 +335,33 @@ class MicrorheoWidget(QtWidgets.QWidget):
         self.defl_results = None
 
         analysis_params = self.params.child('Analysis Params')
-        current_file_id = self.current_file.filemetadata['Entry_filename']
-        current_file = self.current_file
-        current_curve_indx = self.session.current_curve_index
-        height_channel = analysis_params.child('Height Channel').value()
-        spring_k = analysis_params.child('Spring Constant').value()
-        deflection_sens = analysis_params.child('Deflection Sensitivity').value() / 1e9
-        method = analysis_params.child('Method').value()
-
-        hertz_params = self.params.child('Hertz Fit Params')
-        poc_method = hertz_params.child('PoC Method').value()
-        poc_win = hertz_params.child('PoC Window').value() / 1e9
-        poc_sigma = hertz_params.child('Sigma').value()
 
-        force_curve = current_file.getcurve(current_curve_indx)
-        force_curve.preprocess_force_curve(deflection_sens, height_channel)
-        if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
-            force_curve.shift_height()
-        # force_curve_segments = force_curve.get_segments()
-        modulation_segments = force_curve.modulation_segments
-
-        if modulation_segments == []:
-            self.open_msg_box(f'No modulation segments found in file:\n {current_file_id}')
-            return
-
-        microrheo_result = self.session.microrheo_results.get(current_file_id, None)
-
-        if microrheo_result:
-            for curve_indx, curve_microrheo_result in microrheo_result:
-                try:
-                    if curve_microrheo_result is None:
-                        continue
-                    if curve_indx == self.session.current_curve_index:
-                        # print(curve_microrheo_result)
-                        self.freqs = curve_microrheo_result[0]
-                        self.G_storage = np.array(curve_microrheo_result[1])
-                        self.G_loss = np.array(curve_microrheo_result[2])
-                        self.Loss_tan = self.G_loss / self.G_storage
-                        if method == 'Sine Fit':
-                            self.ind_results = curve_microrheo_result[3]
-                            self.defl_results = curve_microrheo_result[4]
-                except Exception:
-                    continue
+        if curve_microrheo_result is not None:
+            self.freqs = curve_microrheo_result[0]
+            self.G_storage = np.array(curve_microrheo_result[1])
+            self.G_loss = np.array(curve_microrheo_result[2])
+            self.Loss_tan = self.G_loss / self.G_storage
+            if method == 'Sine Fit':
+                self.ind_results = curve_microrheo_result[3]
+                self.defl_results = curve_microrheo_result[4]
         
-        ext_data = force_curve.extend_segments[0][1]
-        self.p7.plot(ext_data.zheight, ext_data.vdeflection)
+        self.p7.plot(preview['ext_zheight'], preview['ext_vdeflection'])
 
-        comp_PoC = [0, 0]
-        if poc_method == 'RoV':
-            comp_PoC = get_poc_RoV_method(ext_data.zheight, ext_data.vdeflection, poc_win)
-        else:
-            comp_PoC = get_poc_regulaFalsi_method(ext_data.zheight, ext_data.vdeflection, poc_sigma)
-        
-        if comp_PoC is not None:
-            poc = [comp_PoC[0], 0]
-        else:
-            poc = [0, 0]
-        
-        force_curve.get_force_vs_indentation(poc, spring_k)
-        indapp = ext_data.indentation
-        forceapp = ext_data.force
-        maxind = indapp.max()*1e9
+        maxind = preview['maxind']
         analysis_params.child('Computed Working Indentation').setValue(maxind)
-        self.p8.plot(indapp, forceapp)
+        self.p8.plot(preview['indapp'], preview['forceapp'])
         vertical_line = pg.InfiniteLine(pos=0, angle=90, pen='y', movable=False, label='Init d0', labelOpts={'color':'y', 'position':0.5})
         self.p8.addItem(vertical_line, ignoreBounds=True)
 
-        t0 = 0
-        t0_2 = 0
-        n_segments = len(modulation_segments)
+        segments = preview['segments']
+        n_segments = len(segments)
         if method == 'FFT':
-            for i, (_, segment) in enumerate(modulation_segments):
-                time = segment.time
-                freq = segment.segment_metadata['frequency']
-                label = f"{freq} Hz"
-                deltat = time[1] - time[0]
-                nfft = len(segment.vdeflection)
-                W = fftfreq(nfft, d=deltat)
-                fft_height = fft(segment.zheight, nfft)
-                psd_height = fft_height * np.conj(fft_height) / nfft
-                fft_deflect = fft(segment.vdeflection, nfft)
-                psd_deflect = fft_deflect * np.conj(fft_deflect) / nfft
-                L = np.arange(1, np.floor(nfft/2), dtype='int')
-                self.p3.plot(W[L], psd_height[L].real, pen=(i,n_segments), name=f"{freq} Hz")
-                self.p4.plot(W[L], psd_deflect[L].real, pen=(i,n_segments), name=f"{freq} Hz")
-                plot_time = time + t0
-                self.p1.plot(plot_time, segment.zheight, pen=(i,n_segments), name=label)
-                self.p2.plot(plot_time, segment.vdeflection, pen=(i,n_segments), name=label)
-                t0 = plot_time[-1]
+            for i, segment in enumerate(segments):
+                label = f"{segment['freq']} Hz"
+                self.p3.plot(segment['W'], segment['psd_height'], pen=(i,n_segments), name=label)
+                self.p4.plot(segment['W'], segment['psd_deflect'], pen=(i,n_segments), name=label)
+                self.p1.plot(segment['time'], segment['zheight'], pen=(i,n_segments), name=label)
+                self.p2.plot(segment['time'], segment['vdeflection'], pen=(i,n_segments), name=label)
         
             self.p3.setLabel('left', 'zHeight PSD')
             self.p3.setLabel('bottom', 'Frequency', 'Hz')
@@ -393,28 +375,35 @@ class MicrorheoWidget(QtWidgets.QWidget):
             self.p4.setLogMode(True, False)
             self.p4.addLegend()
 
+        elif method == 'Lock-in':
+            for i, segment in enumerate(segments):
+                label = f"{segment['freq']} Hz"
+                self.p1.plot(segment['time'], segment['zheight'], pen=(i,n_segments), name=label)
+                self.p2.plot(segment['time'], segment['vdeflection'], pen=(i,n_segments), name=label)
+            freqs = [segment['freq'] for segment in segments]
+            self.p3.plot(freqs, [segment['amp_height'] for segment in segments], symbol='o')
+            self.p4.plot(freqs, [segment['amp_deflect'] for segment in segments], symbol='o')
+
+            self.p3.setLabel('left', 'zHeight Amplitude', 'm')
+            self.p3.setLabel('bottom', 'Frequency', 'Hz')
+            self.p3.setTitle("Lock-in")
+            self.p3.setLogMode(True, False)
+
+            self.p4.setLabel('left', 'Deflection Amplitude', 'm')
+            self.p4.setLabel('bottom', 'Frequency', 'Hz')
+            self.p4.setTitle("Lock-in")
+            self.p4.setLogMode(True, False)
+
         elif method == 'Sine Fit':
-            for i, (_, segment) in enumerate(modulation_segments):
-                time = segment.time
-                freq = segment.segment_metadata['frequency']
-                label = f"{freq} Hz"
-                zheight, vdeflection, time_2 =\
-                    detrend_rolling_average(freq, segment.zheight, segment.vdeflection, time, 'zheight', 'deflection', [])
-                indentation = zheight -  vdeflection
-                plot_time_2 = time_2 - time_2[0] + t0_2
-                self.p3.plot(plot_time_2 , indentation, pen='w')
-                self.p4.plot(plot_time_2, vdeflection, pen='w')
-                if self.ind_results is not None and self.defl_results is not None:
-                    idx = int((np.abs(np.array(self.freqs) - freq)).argmin())
-                    indentation_res = self.ind_results[idx].eval(time=time_2)
-                    deflection_res = self.defl_results[idx].eval(time=time_2)
-                    self.p3.plot(plot_time_2, -1 * indentation_res, pen='g')
-                    self.p4.plot(plot_time_2, deflection_res, pen='g')
-                plot_time_1 = time + t0
-                self.p1.plot(plot_time_1, segment.zheight, pen=(i,n_segments), name=label)
-                self.p2.plot(plot_time_1, segment.vdeflection, pen=(i,n_segments), name=label)
-                t0 = plot_time_1[-1]
-                t0_2 = plot_time_2[-1]
+            for i, segment in enumerate(segments):
+                label = f"{segment['freq']} Hz"
+                self.p3.plot(segment['detrended_time'], segment['detrended_indentation'], pen='w')
+                self.p4.plot(segment['detrended_time'], segment['detrended_vdeflection'], pen='w')
+                if 'indentation_fit' in segment:
+                    self.p3.plot(segment['detrended_time'], segment['indentation_fit'], pen='g')
+                    self.p4.plot(segment['detrended_time'], segment['deflection_fit'], pen='g')
+                self.p1.plot(segment['time'], segment['zheight'], pen=(i,n_segments), name=label)
+                self.p2.plot(segment['time'], segment['vdeflection'], pen=(i,n_segments), name=label)
 
             self.p3.setLabel('left', 'Detrended Indentation', 'm')
             self.p3.setLabel('bottom', 'Time', 's')
@@ -3,7 +3,6 @@ import PyQt5
 from pyqtgraph.Qt import QtGui, QtWidgets, QtCore
 import pyqtgraph as pg
 from pyqtgraph.parametertree import Parameter, ParameterTree
-from scipy.fft import fft, fftfreq
 import numpy as np
 import logging
 logger = logging.getLogger()
@@ -11,6 +10,8 @@ logger = logging.getLogger()
 import pyfmgui.const as cts
 from pyfmgui.threading import Worker
 from pyfmgui.compute import compute
+from pyfmgui.curve_cache import get_force_curve
+from pyfmgui.spectral import get_psds
 from pyfmgui.widgets.get_params import get_params
 
 class PiezoCharWidget(QtWidgets.QWidget):
@@ -43,6 +44,8 @@ class PiezoCharWidget(QtWidgets.QWidget):
         self.paramTree.setParameters(self.params, showTop=False)
 
         self.l2 = pg.GraphicsLayoutWidget()
+        # Connected once, the map plot is added to and removed from this scene
+        self.l2.scene().sigMouseClicked.connect(self.mouseMoved)
 
         params_layout.addWidget(self.combobox, 1)
         params_layout.addWidget(self.paramTree, 3)
@@ -102,6 +105,7 @@ class PiezoCharWidget(QtWidgets.QWidget):
         self.thread = QtCore.QThread()
         # Create worker to run compute
         self.worker = Worker(compute, self.session, params, filedict, "PiezoChar")
+        self.session.pbar_widget.set_worker(self.worker)
         # Move worker to thread
         self.worker.moveToThread(self.thread)
         # When thread starts run worker
@@ -109,6 +113,7 @@ class PiezoCharWidget(QtWidgets.QWidget):
         self.worker.signals.progress.connect(self.reportProgress)
         self.worker.signals.range.connect(self.setPbarRange)
         self.worker.signals.step.connect(self.changestep)
+        self.worker.signals.results.connect(self.updateResults)
         self.worker.signals.finished.connect(self.oncomplete) # Reset button
         # Start thread
         self.thread.start()
@@ -126,6 +131,11 @@ class PiezoCharWidget(QtWidgets.QWidget):
     def setPbarRange(self, n):
         self.session.pbar_widget.set_pbar_range(0, n)
     
+    def updateResults(self, file_id):
+        # Show the new results if they belong to the file being displayed
+        if self.current_file and file_id == self.current_file.filemetadata['Entry_filename']:
+            self.updatePlots()
+    
     def oncomplete(self):
         self.thread.terminate()
         self.session.pbar_widget.hide()
@@ -147,7 +157,6 @@ class PiezoCharWidget(QtWidgets.QWidget):
         if self.current_file.isFV:
             self.l2.addItem(self.plotItem)
             self.plotItem.addItem(self.ROI)
-            self.plotItem.scene().sigMouseClicked.connect(self.mouseMoved)
             # create transform to center the corner element on the origin, for any assigned image:
             if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
                 img = self.session.current_file.imagedata.get('Height(measured)', None)
@@ -190,6 +199,9 @@ class PiezoCharWidget(QtWidgets.QWidget):
         self.update()
     
     def mouseMoved(self,event):
+        # The map is only shown for force maps
+        if self.plotItem.scene() is None:
+            return
         vb = self.plotItem.vb
         scene_coords = event.scenePos()
         if self.correlogram.sceneBoundingRect().contains(scene_coords):
@@ -231,8 +243,9 @@ class PiezoCharWidget(QtWidgets.QWidget):
         height_channel = analysis_params.child('Height Channel').value()
         deflection_sens = analysis_params.child('Deflection Sensitivity').value() / 1e9
 
-        force_curve = current_file.getcurve(current_curve_indx)
-        force_curve.preprocess_force_curve(deflection_sens, height_channel)
+        force_curve = get_force_curve(current_file, current_curve_indx, deflection_sens, height_channel, shift_height=False)
+        # Load the curves around the selected pixel in the background
+        self.session.curve_prefetcher.prefetch(current_file, self.session.map_coords, current_curve_indx, deflection_sens, height_channel, shift_height=False)
 
         modulation_segs = force_curve.modulation_segments
 
@@ -243,34 +256,24 @@ class PiezoCharWidget(QtWidgets.QWidget):
         piezo_char_result = self.session.piezo_char_results.get(current_file_id, None)
 
         if piezo_char_result:
-            for curve_indx, curve_piezo_char_result in piezo_char_result:
-                try:
-                    if curve_piezo_char_result is None:
-                        continue
-                    if curve_indx == self.session.current_curve_index:
-                        self.freqs = curve_piezo_char_result[0]
-                        self.fi = curve_piezo_char_result[1]
-                        self.amp_quot = curve_piezo_char_result[2]
-                except Exception:
-                    continue
+            curve_piezo_char_result = piezo_char_result.get(self.session.current_curve_index)
+            if curve_piezo_char_result is not None:
+                self.freqs = curve_piezo_char_result[0]
+                self.fi = curve_piezo_char_result[1]
+                self.amp_quot = curve_piezo_char_result[2]
+        # Spectra of all the segments computed at once
+        psds = get_psds([segment for _, segment in modulation_segs])
         t0 = 0
         n_segments = len(modulation_segs)
         for i, (_, segment) in enumerate(modulation_segs):
             time = segment.time
             freq = segment.segment_metadata['frequency']
-            deltat = time[1] - time[0]
-            nfft = len(segment.vdeflection)
-            W = fftfreq(nfft, d=deltat)
-            fft_height = fft(segment.zheight, nfft)
-            psd_height = fft_height * np.conj(fft_height) / nfft
-            fft_deflect = fft(segment.vdeflection, nfft)
-            psd_deflect = fft_deflect * np.conj(fft_deflect) / nfft
-            L = np.arange(1, np.floor(nfft/2), dtype='int')
+            W, psd_height, psd_deflect = psds[i]
             plot_time = time + t0
             self.p1.plot(plot_time, segment.zheight, pen=(i,n_segments), name=f"{freq} Hz")
             self.p2.plot(plot_time, segment.vdeflection, pen=(i,n_segments), name=f"{freq} Hz")
-            self.p3.plot(W[L], psd_height[L].real, pen=(i,n_segments), name=f"{freq} Hz")
-            self.p4.plot(W[L], psd_deflect[L].real, pen=(i,n_segments), name=f"{freq} Hz")
+            self.p3.plot(W, psd_height, pen=(i,n_segments), name=f"{freq} Hz")
+            self.p4.plot(W, psd_deflect, pen=(i,n_segments), name=f"{freq} Hz")
             t0 = plot_time[-1]
          
         if self.fi is not None:
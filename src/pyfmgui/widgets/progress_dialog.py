@@ -5,6 +5,7 @@ from pyqtgraph.Qt import QtWidgets
 class ProgressDialog(QtWidgets.QDialog):
     def __init__(self, parent=None):
         super(ProgressDialog, self).__init__(parent)
+        self.worker = None
         self.init_gui()
 
     def init_gui(self):
@@ -12,14 +13,40 @@ class ProgressDialog(QtWidgets.QDialog):
         self.textLabel = QtWidgets.QLabel()
         self.subTextLabel = QtWidgets.QLabel()
         self.pbar = QtWidgets.QProgressBar()
-        # self.button_box = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Cancel)
+        self.button_box = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Cancel)
+        self.button_box.rejected.connect(self.cancel)
 
         vBox.addWidget(self.textLabel)
         vBox.addWidget(self.subTextLabel)
         vBox.addWidget(self.pbar)
-        # vBox.addWidget(self.button_box)
+        vBox.addWidget(self.button_box)
         self.setLayout(vBox)
     
+    def set_worker(self, worker):
+        # Worker stopped when the user presses cancel
+        self.worker = worker
+        self.button_box.setEnabled(True)
+        worker.signals.finished.connect(lambda: self.clear_worker(worker))
+
+    def clear_worker(self, worker):
+        # Forget the worker once its job is done, unless
+        # a new job was started in the meantime.
+        if self.worker is worker:
+            self.worker = None
+
+    def cancel(self):
+        if self.worker is None:
+            return
+        self.worker.stop()
+        self.button_box.setEnabled(False)
+        self.set_label_sub_text('Cancelling...')
+
+    def reject(self):
+        # Closing the dialog cancels the running job
+        if self.worker is None:
+            super(ProgressDialog, self).reject()
+        self.cancel()
+    
     def set_pbar_range(self, min, max):
         self.pbar.setRange(min, max)
 
@@ -34,6 +61,3 @@ class ProgressDialog(QtWidgets.QDialog):
 
     def set_label_sub_text(self, text):
         self.subTextLabel.setText(text)
-    
-
-
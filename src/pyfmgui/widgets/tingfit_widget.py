@@ -3,15 +3,16 @@ from pyqtgraph.Qt import QtGui, QtWidgets, QtCore
 import pyqtgraph as pg
 from pyqtgraph.parametertree import Parameter, ParameterTree
 import numpy as np
+from functools import partial
 import logging
 logger = logging.getLogger()
 
 import pyfmgui.const as cts
-from pyfmgui.threading import Worker
+from pyfmgui.threading import Worker, PreviewRunner
 from pyfmgui.compute import compute
+from pyfmgui.preview import StageCache, compute_ting_preview
 from pyfmgui.widgets.get_params import get_params
-
-from pyfmrheo.utils.force_curves import get_poc_RoV_method, get_poc_regulaFalsi_method, correct_viscous_drag, correct_tilt, correct_offset
+from pyfmgui.widgets.update_scheduler import UpdateScheduler
 
 class TingFitWidget(QtWidgets.QWidget):
     def __init__(self, session, parent=None):
@@ -22,8 +23,13 @@ class TingFitWidget(QtWidgets.QWidget):
         self.max_val_line = None
         self.offset_roi = None
         self.file_dict = {}
+        self.preview = PreviewRunner()
+        # Outputs of the preview stages, reused while their inputs do not change
+        self.preview_stages = StageCache()
         self.session.ting_fit_widget = self
         self.init_gui()
+        self.updates = UpdateScheduler([('preview', self.updatePlots)], parent=self)
+        self.connectParams()
         if self.session.loaded_files != {}:
             self.updateCombo()
 
@@ -46,6 +52,8 @@ class TingFitWidget(QtWidgets.QWidget):
         self.paramTree.setParameters(self.params, showTop=False)
 
         self.l2 = pg.GraphicsLayoutWidget()
+        # Connected once, the map plot is added to and removed from this scene
+        self.l2.scene().sigMouseClicked.connect(self.mouseMoved)
 
         params_layout.addWidget(self.combobox, 1)
         params_layout.addWidget(self.paramTree, 3)
@@ -77,6 +85,8 @@ class TingFitWidget(QtWidgets.QWidget):
         main_layout.addWidget(self.l, 3)
     
     def closeEvent(self, evnt):
+        self.updates.cancel()
+        self.preview.shutdown()
         self.session.ting_fit_widget = None
     
     def clear(self):
@@ -104,6 +114,7 @@ class TingFitWidget(QtWidgets.QWidget):
         self.thread = QtCore.QThread()
         # Create worker to run compute
         self.worker = Worker(compute, self.session, params, filedict, "TingFit")
+        self.session.pbar_widget.set_worker(self.worker)
         # Move worker to thread
         self.worker.moveToThread(self.thread)
         # When thread starts run worker
@@ -111,6 +122,7 @@ class TingFitWidget(QtWidgets.QWidget):
         self.worker.signals.progress.connect(self.reportProgress)
         self.worker.signals.range.connect(self.setPbarRange)
         self.worker.signals.step.connect(self.changestep)
+        self.worker.signals.results.connect(self.updateResults)
         self.worker.signals.finished.connect(self.oncomplete) # Reset button
         # Start thread
         self.thread.start()
@@ -129,6 +141,11 @@ class TingFitWidget(QtWidgets.QWidget):
     def setPbarRange(self, n):
         self.session.pbar_widget.set_pbar_range(0, n)
     
+    def updateResults(self, file_id):
+        # Show the new results if they belong to the file being displayed
+        if self.current_file and file_id == self.current_file.filemetadata['Entry_filename']:
+            self.updatePlots()
+    
     def oncomplete(self):
         self.thread.terminate()
         self.session.pbar_widget.hide()
@@ -144,7 +161,6 @@ class TingFitWidget(QtWidgets.QWidget):
         if self.current_file.isFV:
             self.l2.addItem(self.plotItem)
             self.plotItem.addItem(self.ROI)
-            self.plotItem.scene().sigMouseClicked.connect(self.mouseMoved)
             # create transform to center the corner element on the origin, for any assigned image:
             if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
                 img = self.session.current_file.imagedata.get('Height(measured)', None)
@@ -187,6 +203,9 @@ class TingFitWidget(QtWidgets.QWidget):
         self.update()
     
     def mouseMoved(self,event):
+        # The map is only shown for force maps
+        if self.plotItem.scene() is None:
+            return
         vb = self.plotItem.vb
         scene_coords = event.scenePos()
         if self.correlogram.sceneBoundingRect().contains(scene_coords):
@@ -205,6 +224,27 @@ class TingFitWidget(QtWidgets.QWidget):
         if not self.current_file:
             return
 
+        current_file_id = self.current_file.filemetadata['Entry_filename']
+        current_curve_indx = self.session.current_curve_index
+        params = get_params(self.params, "TingFit")
+
+        result = None
+        file_ting_result = self.session.ting_fit_results.get(current_file_id, None)
+        if file_ting_result:
+            result = file_ting_result.get(current_curve_indx)
+        hertz_d0 = result[1].delta0 if result is not None else 0
+
+        # Load and process the curve in the background, the plots
+        # are drawn when the last requested curve is ready.
+        self.preview.submit(
+            partial(self.drawPlots, result), compute_ting_preview, self.current_file, current_curve_indx,
+            params, result[0] if result is not None else None, hertz_d0, self.preview_stages
+        )
+        # Load the curves around the selected pixel in the background
+        self.session.curve_prefetcher.prefetch(self.current_file, self.session.map_coords, current_curve_indx, params['def_sens'], params['height_channel'])
+
+    def drawPlots(self, result, preview):
+
         self.l.clear()
         self.p1.clear()
         self.p2.clear()
@@ -219,133 +259,40 @@ class TingFitWidget(QtWidgets.QWidget):
         self.residual = None
         self.ting_tc = None
 
-        current_file_id = self.current_file.filemetadata['Entry_filename']
-        current_curve_indx = self.session.current_curve_index
-
-        analysis_params = self.params.child('Analysis Params')
-        ting_params = self.params.child('Ting Fit Params')
-
-        height_channel = analysis_params.child('Height Channel').value()
-        deflection_sens = analysis_params.child('Deflection Sensitivity').value() / 1e9
-        spring_k = analysis_params.child('Spring Constant').value()
-        
-        poc_method = ting_params.child('PoC Method').value()
-        poc_win = ting_params.child('PoC Window').value() / 1e9
-        poc_sigma = ting_params.child('Sigma').value()
-        vdragcorr = ting_params.child('Correct Viscous Drag').value()
-        polyordr = ting_params.child('Poly. Order').value()
-        rampspeed = ting_params.child('Ramp Speed').value() / 1e6
-        contact_offset = ting_params.child('Contact Offset').value() / 1e6
-        t0_scaling = ting_params.child('t0').value()
-        pts_downsample = ting_params.child('Downsample Pts.').value()
-        correct_tilt_flag = analysis_params.child('Correct Tilt').value()
-
-        force_curve = self.current_file.getcurve(current_curve_indx)
-        force_curve.preprocess_force_curve(deflection_sens, height_channel)
-
-        if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
-            force_curve.shift_height()
-
-        file_ting_result = self.session.ting_fit_results.get(current_file_id, None)
-
-        if file_ting_result:
-            for curve_indx, result in file_ting_result:
-                try:
-                    if result is None:
-                        continue
-                    else:
-                        curve_ting_result, curve_hertz_result = result
-                    if curve_indx == self.session.current_curve_index:
-                        self.ting_E = curve_ting_result.E0
-                        self.ting_exp = curve_ting_result.betaE
-                        self.ting_tc = curve_ting_result.tc
-                        self.ting_redchi = curve_ting_result.redchi
-                        self.ting_f0 = curve_ting_result.F0
-                        self.hertz_E = curve_hertz_result.E0
-                        self.hertz_d0 = curve_hertz_result.delta0
-                        self.hertz_redchi = curve_hertz_result.redchi
-                        self.fit_data = curve_ting_result
-                except Exception:
-                    continue
-
-        ext_data = force_curve.extend_segments[0][1]
-        ret_data = force_curve.retract_segments[-1][1]
-
-        self.p3.plot(ext_data.zheight, ext_data.vdeflection)
-        self.p3.plot(ret_data.zheight, ret_data.vdeflection)
-
-        self.sep_idx = len(ext_data.zheight)
-        self.zheight = np.r_[ext_data.zheight, ret_data.zheight]
-        self.vdeflection = np.r_[ext_data.vdeflection, ret_data.vdeflection]
-
+        if result is not None:
+            curve_ting_result, curve_hertz_result = result
+            self.ting_E = curve_ting_result.E0
+            self.ting_exp = curve_ting_result.betaE
+            self.ting_tc = curve_ting_result.tc
+            self.ting_redchi = curve_ting_result.redchi
+            self.ting_f0 = curve_ting_result.F0
+            self.hertz_E = curve_hertz_result.E0
+            self.hertz_d0 = curve_hertz_result.delta0
+            self.hertz_redchi = curve_hertz_result.redchi
+            self.fit_data = curve_ting_result
+
+        self.p3.plot(preview['ext_zheight'], preview['ext_vdeflection'])
+        self.p3.plot(preview['ret_zheight'], preview['ret_vdeflection'])
+
+        self.maxoffset = preview['maxoffset']
+        self.minoffset = preview['minoffset']
         self.update_tilt_range()
 
-        # Perform tilt correction
-        if correct_tilt_flag:
-            self.vdeflection = correct_tilt(
-                self.zheight, self.vdeflection, self.maxoffset, self.minoffset
-            )
-        else:
-            self.vdeflection = correct_offset(
-                self.zheight, self.vdeflection, self.maxoffset, self.minoffset
-            )
-
-        ext_data.vdeflection = self.vdeflection[:self.sep_idx]
-        ret_data.vdeflection = self.vdeflection[self.sep_idx:]
-
-        comp_PoC = [0, 0]
-        if poc_method == 'RoV':
-            comp_PoC = get_poc_RoV_method(ext_data.zheight, ext_data.vdeflection, poc_win)
-        else:
-            comp_PoC = get_poc_regulaFalsi_method(ext_data.zheight, ext_data.vdeflection, poc_sigma)
-
-        if comp_PoC is not None:
-            poc = [comp_PoC[0], 0]
-        else:
-            poc = [0, 0]
+        poc = preview['poc']
 
         vertical_line = pg.InfiniteLine(pos=0, angle=90, pen='y', movable=False, label='Init d0', labelOpts={'color':'y', 'position':0.5})
         self.p1.addItem(vertical_line, ignoreBounds=True)
         if self.hertz_d0 != 0:
             d0_vertical_line = pg.InfiniteLine(pos=self.hertz_d0, angle=90, pen='g', movable=False, label='Hertz d0', labelOpts={'color':'g', 'position':0.7})
             self.p1.addItem(d0_vertical_line, ignoreBounds=True)
-            poc[0] += self.hertz_d0
-        force_curve.get_force_vs_indentation(poc, spring_k)
-        if vdragcorr:
-            ext_data.force, ret_data.force = correct_viscous_drag(
-                ext_data.indentation, ext_data.force, ret_data.indentation, ret_data.force, poly_order=polyordr, speed=rampspeed)
-        self.p1.plot(ext_data.indentation, ext_data.force)
-        self.p1.plot(ret_data.indentation, ret_data.force)
-        
-        idx_tc = (np.abs(ext_data.indentation - 0)).argmin()
-        t0 = ext_data.time[-1]
-        indentation = np.r_[ext_data.indentation, ret_data.indentation]
-        time = np.r_[ext_data.time, ret_data.time + t0]
-        force = np.r_[ext_data.force, ret_data.force]
-        fit_mask = indentation > (-1 * contact_offset)
-        tc = time[idx_tc]
-        ind_fit = indentation[fit_mask]
-        force_fit = force[fit_mask]
-        force_fit = force_fit - force_fit[0]
-        time_fit = time[fit_mask]
-        tc_fit = tc-time_fit[0]
-        time_fit = time_fit - time_fit[0] - tc_fit
-        
-        downfactor= len(time_fit) // pts_downsample
-        idxDown = list(range(0, len(time_fit), downfactor))
+        self.p1.plot(preview['ext_indentation'], preview['ext_force'])
+        self.p1.plot(preview['ret_indentation'], preview['ret_force'])
 
-        self.p2.plot(time_fit[idxDown], force_fit[idxDown])
-
-        self.update_tilt_range()
+        time_fit = preview['time_fit']
+        self.p2.plot(time_fit, preview['force_fit'])
 
         if self.fit_data is not None:
-            self.p2.plot(
-                time_fit[idxDown],
-                self.fit_data.eval(
-                    time_fit[idxDown], force_fit[idxDown], ind_fit[idxDown], t0=t0_scaling,
-                    idx_tm=self.fit_data.idx_tm, smooth_w=self.fit_data.smooth_w,
-                    v0t=self.fit_data.v0t, v0r=self.fit_data.v0r
-                ), pen ='g', name='Fit')
+            self.p2.plot(time_fit, preview['fit'], pen ='g', name='Fit')
             vertical_line_tinc_tc = pg.InfiniteLine(
                 pos=self.ting_tc, angle=90, pen='y', movable=False, label='Ting tc', labelOpts={'color':'y', 'position':0.5}
             )
@@ -356,15 +303,9 @@ class TingFitWidget(QtWidgets.QWidget):
             self.p2legend.addItem(style, f'Hertz Red. Chi: {self.hertz_redchi:.3E}')
             self.p2legend.addItem(style, f'Ting E: {self.ting_E:.2f} Pa')
             self.p2legend.addItem(style, f'Ting Fluid. Exp.: {self.ting_exp:.3f}')
-            self.p2legend.addItem(style, f'Ting tc: {self.ting_tc+tc_fit:.2f} s')
+            self.p2legend.addItem(style, f'Ting tc: {self.ting_tc+preview["tc_fit"]:.2f} s')
             self.p2legend.addItem(style, f'Ting Red. Chi: {self.ting_redchi:.3E}')
-            res = self.p4.plot(
-                time_fit[idxDown],
-                self.fit_data.get_residuals(
-                    time_fit[idxDown], force_fit[idxDown], ind_fit[idxDown], t0=t0_scaling,
-                    idx_tm=self.fit_data.idx_tm, smooth_w=self.fit_data.smooth_w,
-                    v0t=self.fit_data.v0t, v0r=self.fit_data.v0r
-                ), pen=None, symbol='o')
+            res = self.p4.plot(time_fit, preview['residuals'], pen=None, symbol='o')
             res.setSymbolSize(5)
         
         self.p1.setLabel('left', 'Force', 'N')
@@ -388,19 +329,8 @@ class TingFitWidget(QtWidgets.QWidget):
         self.l.addItem(self.p4)
     
     def update_tilt_range(self):
-        zheight = self.zheight[:self.sep_idx]
+        # Draw the region used to correct the baseline
         dataItems = self.p3.listDataItems()
-        analysis_params = self.params.child('Analysis Params')
-        offset_type = analysis_params.child('Offset Type').value()
-        if offset_type == 'percentage':
-            deltaz = zheight.max() - zheight.min()
-            maxperc = analysis_params.child('Perc. Max Offset').value() / 1e2
-            minperc = analysis_params.child('Perc. Min Offset').value() / 1e2
-            self.maxoffset = zheight.min() + deltaz * maxperc
-            self.minoffset = zheight.min() + deltaz * minperc
-        else:
-            self.maxoffset = analysis_params.child('Abs. Max Offset').value() / 1e9
-            self.minoffset = analysis_params.child('Abs. Min Offset').value() / 1e9
         if self.offset_roi is not None:
             self.p3.removeItem(self.offset_roi)
         self.offset_roi = pg.LinearRegionItem(brush=(50,50,200,0), pen='w', movable=False)
@@ -423,10 +353,10 @@ class TingFitWidget(QtWidgets.QWidget):
             analysis_params.child('Deflection Sensitivity').setValue(self.current_file.filemetadata['defl_sens_nmbyV'])
         else:
             analysis_params.child('Deflection Sensitivity').setValue(self.session.global_involts)
-        
-        analysis_params.child('Correct Tilt').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Offset Type').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Perc. Min Offset').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Perc. Max Offset').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Abs. Min Offset').sigValueChanged.connect(self.updatePlots)
-        analysis_params.child('Abs. Max Offset').sigValueChanged.connect(self.updatePlots)
\ No newline at end of file
+
+    def connectParams(self):
+        # Changes are coalesced, the curve is only processed
+        # once the parameters stop changing.
+        analysis_params = self.params.child('Analysis Params')
+        for name in ('Correct Tilt', 'Offset Type', 'Perc. Min Offset', 'Perc. Max Offset', 'Abs. Min Offset', 'Abs. Max Offset'):
+            self.updates.connect(analysis_params.child(name), 'preview')
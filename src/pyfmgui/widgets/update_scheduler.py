@@ -0,0 +1,52 @@
+from pyqtgraph.Qt import QtCore
+
+import pyfmgui.const as cts
+
+class UpdateScheduler(QtCore.QObject):
+    '''
+    Coalesces the updates requested when the parameters of a widget change.
+
+    The stages are given from upstream to downstream as (name, callback)
+    pairs, running a stage also updates every stage after it. Changes are
+    debounced: the update runs once no parameter changed for a while, and
+    only the most upstream stage requested in the meantime is run.
+
+    :param stages: List of (stage name, callback) pairs.
+    :type stages: list
+    :param interval: Debounce interval in ms.
+    :type interval: int
+
+    '''
+    def __init__(self, stages, interval=None, parent=None):
+        super(UpdateScheduler, self).__init__(parent)
+        self.stages = [name for name, _ in stages]
+        self.callbacks = dict(stages)
+        self._pending = None
+        self._connected = set()
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval or cts.update_debounce_interval)
+        self._timer.timeout.connect(self.flush)
+
+    def connect(self, param, stage):
+        # Parameters are connected only once, even if called again
+        if id(param) in self._connected:
+            return
+        self._connected.add(id(param))
+        param.sigValueChanged.connect(lambda *args: self.schedule(stage))
+
+    def schedule(self, stage):
+        if self._pending is None or self.stages.index(stage) < self.stages.index(self._pending):
+            self._pending = stage
+        # Restart the timer, so a burst of changes runs a single update
+        self._timer.start()
+
+    def flush(self):
+        self._timer.stop()
+        stage, self._pending = self._pending, None
+        if stage is not None:
+            self.callbacks[stage]()
+
+    def cancel(self):
+        self._timer.stop()
+        self._pending = None
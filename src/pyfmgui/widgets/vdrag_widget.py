@@ -4,14 +4,15 @@ from pyqtgraph.Qt import QtGui, QtWidgets, QtCore
 import pyqtgraph as pg
 from pyqtgraph.parametertree import Parameter, ParameterTree
 import numpy as np
-import pandas as pd
-from scipy.fft import fft, fftfreq
 import logging
 logger = logging.getLogger()
 
 import pyfmgui.const as cts
 from pyfmgui.threading import Worker
 from pyfmgui.compute import compute
+from pyfmgui.curve_cache import get_force_curve
+from pyfmgui.spectral import get_psds
+from pyfmgui.piezo_char import get_calibration
 from pyfmgui.widgets.get_params import get_params
 
 class VDragWidget(QtWidgets.QWidget):
@@ -64,6 +65,8 @@ class VDragWidget(QtWidgets.QWidget):
         self.paramTree.setParameters(self.params, showTop=False)
 
         self.l2 = pg.GraphicsLayoutWidget()
+        # Connected once, the map plot is added to and removed from this scene
+        self.l2.scene().sigMouseClicked.connect(self.mouseMoved)
 
         params_layout.addWidget(self.combobox, 1)
         params_layout.addLayout(piezochar_select_layout, 1)
@@ -126,6 +129,7 @@ class VDragWidget(QtWidgets.QWidget):
         self.thread = QtCore.QThread()
         # Create worker to run compute
         self.worker = Worker(compute, self.session, params, filedict, "VDrag")
+        self.session.pbar_widget.set_worker(self.worker)
         # Move worker to thread
         self.worker.moveToThread(self.thread)
         # When thread starts run worker
@@ -133,6 +137,7 @@ class VDragWidget(QtWidgets.QWidget):
         self.worker.signals.progress.connect(self.reportProgress)
         self.worker.signals.range.connect(self.setPbarRange)
         self.worker.signals.step.connect(self.changestep)
+        self.worker.signals.results.connect(self.updateResults)
         self.worker.signals.finished.connect(self.oncomplete) # Reset button
         # Start thread
         self.thread.start()
@@ -150,6 +155,11 @@ class VDragWidget(QtWidgets.QWidget):
     def setPbarRange(self, n):
         self.session.pbar_widget.set_pbar_range(0, n)
     
+    def updateResults(self, file_id):
+        # Show the new results if they belong to the file being displayed
+        if self.current_file and file_id == self.current_file.filemetadata['Entry_filename']:
+            self.updatePlots()
+    
     def oncomplete(self):
         self.thread.terminate()
         self.session.pbar_widget.hide()
@@ -165,9 +175,7 @@ class VDragWidget(QtWidgets.QWidget):
         if fname != "":
             self.session.piezo_char_file_path = fname
             self.piezochar_text.setText(os.path.basename(self.session.piezo_char_file_path))
-            piezo_char_data_raw = pd.read_csv(self.session.piezo_char_file_path)
-            piezo_char_data = piezo_char_data_raw[["frequency",  "fi_degrees",  "amp_quotient"]]
-            self.session.piezo_char_data = piezo_char_data.groupby('frequency', as_index=False).median()
+            self.session.piezo_char_data = get_calibration(self.session.piezo_char_file_path)
             if self.session.microrheo_widget:
                 self.session.microrheo_widget.piezochar_text.setText(os.path.basename(self.session.piezo_char_file_path))
         else:
@@ -187,7 +195,6 @@ class VDragWidget(QtWidgets.QWidget):
         if self.current_file.isFV:
             self.l2.addItem(self.plotItem)
             self.plotItem.addItem(self.ROI)
-            self.plotItem.scene().sigMouseClicked.connect(self.mouseMoved)
             # create transform to center the corner element on the origin, for any assigned image:
             if self.session.current_file.filemetadata['file_type'] in cts.jpk_file_extensions:
                 img = self.session.current_file.imagedata.get('Height(measured)', None)
@@ -230,6 +237,9 @@ class VDragWidget(QtWidgets.QWidget):
         self.update()
     
     def mouseMoved(self,event):
+        # The map is only shown for force maps
+        if self.plotItem.scene() is None:
+            return
         vb = self.plotItem.vb
         scene_coords = event.scenePos()
         if self.correlogram.sceneBoundingRect().contains(scene_coords):
@@ -275,8 +285,9 @@ class VDragWidget(QtWidgets.QWidget):
         height_channel = analysis_params.child('Height Channel').value()
         deflection_sens = analysis_params.child('Deflection Sensitivity').value() / 1e9
 
-        force_curve = current_file.getcurve(current_curve_indx)
-        force_curve.preprocess_force_curve(deflection_sens, height_channel)
+        force_curve = get_force_curve(current_file, current_curve_indx, deflection_sens, height_channel, shift_height=False)
+        # Load the curves around the selected pixel in the background
+        self.session.curve_prefetcher.prefetch(current_file, self.session.map_coords, current_curve_indx, deflection_sens, height_channel, shift_height=False)
 
         modulation_segs = force_curve.modulation_segments
 
@@ -287,18 +298,15 @@ class VDragWidget(QtWidgets.QWidget):
         vdrag_result = self.session.vdrag_results.get(current_file_id, None)
 
         if vdrag_result:
-            for curve_indx, curve_vdrag_result in vdrag_result:
-                try:
-                    if curve_vdrag_result is None:
-                        continue
-                    if curve_indx == self.session.current_curve_index:
-                        self.Bh = curve_vdrag_result[1]
-                        self.Hd = curve_vdrag_result[2]
-                        distances = curve_vdrag_result[4]
-                except Exception:
-                    continue
+            curve_vdrag_result = vdrag_result.get(self.session.current_curve_index)
+            if curve_vdrag_result is not None:
+                self.Bh = curve_vdrag_result[1]
+                self.Hd = curve_vdrag_result[2]
+                distances = curve_vdrag_result[4]
         
         curve_segments = force_curve.get_segments()
+        # Spectra of all the modulation segments computed at once
+        psds = dict(zip([seg_id for seg_id, _ in modulation_segs], get_psds([segment for _, segment in modulation_segs])))
         
         t0 = 0
         n_segments = len(curve_segments)
@@ -307,18 +315,11 @@ class VDragWidget(QtWidgets.QWidget):
             plot_time = time + t0
             if segment.segment_type == 'Modulation':
                 freq = segment.segment_metadata['frequency']
-                deltat = time[1] - time[0]
-                nfft = len(segment.vdeflection)
-                W = fftfreq(nfft, d=deltat)
-                fft_height = fft(segment.zheight, nfft)
-                psd_height = fft_height * np.conj(fft_height) / nfft
-                fft_deflect = fft(segment.vdeflection, nfft)
-                psd_deflect = fft_deflect * np.conj(fft_deflect) / nfft
-                L = np.arange(1, np.floor(nfft/2), dtype='int')
+                W, psd_height, psd_deflect = psds[seg_id]
                 self.p1.plot(plot_time, segment.zheight, pen=(i,n_segments), name=f"{freq} Hz")
                 self.p2.plot(plot_time, segment.vdeflection, pen=(i,n_segments), name=f"{freq} Hz")
-                self.p3.plot(W[L], psd_height[L].real, pen=(i,n_segments), name=f"{freq} Hz")
-                self.p4.plot(W[L], psd_deflect[L].real, pen=(i,n_segments), name=f"{freq} Hz")
+                self.p3.plot(W, psd_height, pen=(i,n_segments), name=f"{freq} Hz")
+                self.p4.plot(W, psd_deflect, pen=(i,n_segments), name=f"{freq} Hz")
             else:
                 self.p1.plot(plot_time, segment.zheight, pen=(i,n_segments), name=f"{segment.segment_type} {seg_id}")
                 self.p2.plot(plot_time, segment.vdeflection, pen=(i,n_segments), name=f"{segment.segment_type} {seg_id}")
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Run the tests against the sources in src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
@@ -0,0 +1,242 @@
+import os
+import threading
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+
+import pyfmgui.const as cts
+import pyfmgui.export as export
+from pyfmgui.export import export_results
+from pyfmgui.results import new_result_store
+from test_results import make_hertz_result, make_ting_result
+
+# Columns of the tables built by the original prepare_export_results
+hertz_attributes = [
+    ('hertz_ind_geometry', 'ind_geom'), ('hertz_tip_parameter', 'tip_parameter'),
+    ('hertz_apply_BEC', 'apply_bec_flag'), ('hertz_BEC_model', 'bec_model'),
+    ('hertz_fit_hline_on_baseline', 'fit_hline_flag'), ('hertz_delta0', 'delta0'),
+    ('hertz_E0', 'E0'), ('hertz_f0', 'f0'), ('hertz_slope', 'slope'),
+    ('hertz_poisson_ratio', 'poisson_ratio'), ('hertz_sample_height', 'sample_height'),
+    ('hertz_MAE', 'MAE'), ('hertz_MSE', 'MSE'), ('hertz_RMSE', 'RMSE'),
+    ('hertz_Rsquared', 'Rsquared'), ('hertz_chisq', 'chisq'), ('hertz_redchi', 'redchi')
+]
+ting_attributes = [
+    ('ting_ind_geometry', 'ind_geom'), ('ting_tip_parameter', 'tip_parameter'),
+    ('ting_modelFt', 'modelFt'), ('ting_apply_BEC', 'apply_bec_flag'),
+    ('ting_BEC_model', 'bec_model'), ('ting_fit_hline_on_baseline', 'fit_hline_flag'),
+    ('ting_t0', 't0'), ('ting_E0', 'E0'), ('ting_tc', 'tc'), ('ting_betaE', 'betaE'),
+    ('ting_f0', 'F0'), ('ting_poisson_ratio', 'poisson_ratio'), ('ting_vdrag', 'vdrag'),
+    ('ting_smooth_w', 'smooth_w'), ('ting_idx_tm', 'idx_tm'), ('ting_MAE', 'MAE'),
+    ('ting_MSE', 'MSE'), ('ting_RMSE', 'RMSE'), ('ting_Rsquared', 'Rsquared'),
+    ('ting_chisq', 'chisq'), ('ting_redchi', 'redchi')
+]
+
+
+def baseline_row(result_type, result):
+    # Values of one curve, as unpacked by the original get_file_results
+    if result_type == 'hertz_results':
+        return {name: getattr(result, attribute) for name, attribute in hertz_attributes}
+    if result_type == 'ting_results':
+        row = {name: getattr(result[1], attribute) for name, attribute in hertz_attributes}
+        row.update({name: getattr(result[0], attribute) for name, attribute in ting_attributes})
+        return row
+    if result_type == 'piezochar_results':
+        return {'frequency': result[0], 'fi_degrees': result[1], 'amp_quotient': result[2]}
+    if result_type == 'vdrag_results':
+        return {
+            'frequency': result[0], 'Bh': result[1], 'Hd_real': result[2].real, 'Hd_imag': result[2].imag,
+            'distances': result[4], 'fi_degrees': result[5], 'amp_quotient': result[6]
+        }
+    return {
+        'frequency': result[0], 'G_storage': result[1], 'G_loss': result[2],
+        'losstan': np.array(result[1]) / np.array(result[2]), 'fi_degrees': result[-4],
+        'amp_quotient': result[-3], 'B(0)': result[-2], 'w_ind': result[-1]
+    }
+
+baseline_explode = {
+    'piezochar_results': ['frequency', 'fi_degrees', 'amp_quotient'],
+    'vdrag_results': ['frequency', 'Bh', 'Hd_real', 'Hd_imag', 'distances', 'fi_degrees', 'amp_quotient'],
+    'microrheo_results': ['frequency', 'G_storage', 'G_loss', 'losstan', 'fi_degrees', 'amp_quotient']
+}
+
+
+def baseline_table(result_type, session, results):
+    # Table built by the original prepare_export_results, failed curves
+    # only have the file columns. Sorted as the streamed export.
+    rows = []
+    for file_id, file_results in results.items():
+        filemetadata = session.loaded_files[file_id].filemetadata
+        for curve_idx, result in file_results:
+            row = {
+                'file_path': filemetadata['file_path'], 'file_id': file_id, 'curve_idx': curve_idx,
+                'kcanti': filemetadata['spring_const_Nbym'], 'defl_sens': filemetadata['defl_sens_nmbyV']
+            }
+            if not isinstance(result, Exception):
+                row.update(baseline_row(result_type, result))
+            rows.append(row)
+    table = pd.DataFrame(rows)
+    if result_type in baseline_explode:
+        table = table.explode(baseline_explode[result_type])
+    return table.sort_values(by=['file_path', 'curve_idx'], kind='stable')
+
+
+def make_list_result(result_type, nb_values, scale):
+    frequency = np.arange(1, nb_values + 1) * 10.0
+    values = [scale * np.arange(1, nb_values + 1) + i for i in range(4)]
+    if result_type == 'piezochar_results':
+        return frequency, values[0], values[1], values[2]
+    if result_type == 'vdrag_results':
+        return frequency, values[0], values[1] + 1j * values[2], values[3], values[3] * 2, values[0] * 3, values[1] * 3
+    # Microrheology FFT: (frequency, G', G'', gamma2, fi, amp quotient, B(0), working indentation)
+    return frequency, values[0], values[1], values[2], values[3], values[0] / 2, 1e-3 * scale, 1e-7
+
+
+def make_results(result_type):
+    # Two files with a failed curve each, listed out of path order
+    results = {}
+    for file_id, scale in (('b', 2.0), ('a', 1.0)):
+        file_results = []
+        for curve_idx in range(4):
+            if curve_idx == 1:
+                result = ValueError('fit failed')
+            elif result_type == 'hertz_results':
+                result = make_hertz_result(E0=1000.0 * scale + curve_idx, slope=None if curve_idx else 1e-3)
+            elif result_type == 'ting_results':
+                result = (make_ting_result(betaE=0.1 * scale + curve_idx), make_hertz_result(E0=1000.0 * scale))
+            else:
+                result = make_list_result(result_type, 2 + curve_idx, scale + curve_idx)
+            file_results.append((curve_idx, result))
+        results[file_id] = file_results
+    return results
+
+
+def make_session(results):
+    # Session holding the results of each type in the stores used by compute
+    methods = {
+        'hertz_results': 'HertzFit', 'ting_results': 'TingFit', 'piezochar_results': 'PiezoChar',
+        'vdrag_results': 'VDrag', 'microrheo_results': 'Microrheo'
+    }
+    stores = {}
+    for result_type, type_results in results.items():
+        stores[result_type] = {}
+        for file_id, file_results in type_results.items():
+            store = new_result_store(methods[result_type])
+            for curve_idx, result in file_results:
+                store.add(curve_idx, result)
+            stores[result_type][file_id] = store
+    loaded_files = {
+        file_id: SimpleNamespace(filemetadata={
+            'file_path': f'/data/{file_id}.jpk-force-map', 'spring_const_Nbym': 0.1, 'defl_sens_nmbyV': 20.0
+        }) for file_id in ('a', 'b')
+    }
+    return SimpleNamespace(
+        loaded_files=loaded_files,
+        hertz_fit_results=stores.get('hertz_results', {}),
+        ting_fit_results=stores.get('ting_results', {}),
+        piezo_char_results=stores.get('piezochar_results', {}),
+        vdrag_results=stores.get('vdrag_results', {}),
+        microrheo_results=stores.get('microrheo_results', {})
+    )
+
+
+class Signal:
+    def __init__(self, callback=None):
+        self.values = []
+        self.callback = callback
+
+    def emit(self, value):
+        self.values.append(value)
+        if self.callback is not None:
+            self.callback(value)
+
+
+def run_export(session, dirname, file_format='CSV', stop_event=None, progress=None):
+    stop_event = threading.Event() if stop_event is None else stop_event
+    return export_results(
+        session, dirname, 'test', file_format, progress or Signal(), Signal(), Signal(), Signal(), stop_event
+    )
+
+
+@pytest.mark.parametrize('result_type', [
+    'hertz_results', 'ting_results', 'piezochar_results', 'vdrag_results', 'microrheo_results'
+])
+def test_csv_export_matches_baseline(tmp_path, monkeypatch, result_type):
+    # Small blocks, so the tables are written in several parts
+    monkeypatch.setattr(cts, 'export_block_rows', 3)
+    results = {result_type: make_results(result_type)}
+    session = make_session(results)
+    assert run_export(session, str(tmp_path))
+    assert os.listdir(tmp_path) == [f'test_{result_type}.csv']
+    # Compare the tables as written to CSV by the original export
+    expected_path = tmp_path / 'expected.csv'
+    baseline_table(result_type, session, results[result_type]).to_csv(expected_path, index=False)
+    exported = pd.read_csv(tmp_path / f'test_{result_type}.csv')
+    expected = pd.read_csv(expected_path)
+    pd.testing.assert_frame_equal(exported, expected, check_dtype=False)
+
+
+def test_cancelled_export_leaves_no_partial_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(cts, 'export_block_rows', 2)
+    session = make_session({
+        'hertz_results': make_results('hertz_results'), 'ting_results': make_results('ting_results')
+    })
+    stop_event = threading.Event()
+    # The progress counts the files, cancel once the
+    # first file of the Ting results has been written.
+    progress = Signal(lambda value: stop_event.set() if value > len(session.hertz_fit_results) else None)
+    assert not run_export(session, str(tmp_path), stop_event=stop_event, progress=progress)
+    # Only the results written completely are kept
+    assert os.listdir(tmp_path) == ['test_hertz_results.csv']
+    assert len(pd.read_csv(tmp_path / 'test_hertz_results.csv')) == 8
+
+
+def test_cancelled_hdf_export_leaves_no_partial_files(tmp_path, monkeypatch):
+    pytest.importorskip('tables')
+    monkeypatch.setattr(cts, 'export_block_rows', 2)
+    session = make_session({'hertz_results': make_results('hertz_results')})
+    stop_event = threading.Event()
+    progress = Signal(lambda value: stop_event.set())
+    assert not run_export(session, str(tmp_path), 'HDF5', stop_event, progress)
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_export_leaves_no_partial_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(cts, 'export_block_rows', 2)
+    session = make_session({'piezochar_results': make_results('piezochar_results')})
+    written = []
+
+    def fail_after_first_block(self, table):
+        if written:
+            raise OSError('No space left on device')
+        written.append(original_write(self, table))
+
+    original_write = export.ResultWriter.write
+    monkeypatch.setattr(export.ResultWriter, 'write', fail_after_first_block)
+    with pytest.raises(OSError):
+        run_export(session, str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('result_type', ['hertz_results', 'ting_results', 'microrheo_results'])
+def test_preview_matches_baseline(monkeypatch, result_type):
+    monkeypatch.setattr(cts, 'export_preview_rows', 5)
+    results = {result_type: make_results(result_type)}
+    session = make_session(results)
+    export.prepare_export_results(session, Signal(), Signal(), Signal(), Signal(), threading.Event())
+    expected = baseline_table(result_type, session, results[result_type])
+    assert session.prepared_results_rows[result_type] == len(expected)
+    preview = session.prepared_results[result_type]
+    expected = expected.head(5).reset_index(drop=True)
+    assert list(preview.columns) == list(expected.columns)
+    for name in preview.columns:
+        # The failed curves are empty in both tables
+        values, expected_values = preview[name].tolist(), expected[name].tolist()
+        assert [pd.isna(value) for value in values] == [pd.isna(value) for value in expected_values], name
+        for value, expected_value in zip(values, expected_values):
+            if pd.isna(expected_value):
+                assert pd.isna(value), name
+            elif isinstance(expected_value, float):
+                assert value == pytest.approx(expected_value), name
+            else:
+                assert value == expected_value, name
@@ -0,0 +1,84 @@
+import threading
+import time
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+import pytest
+
+import pyfmgui.loadfiles as loadfiles_module
+from pyfmgui.loadfiles import loadfiles
+
+
+class Signal:
+    def __init__(self):
+        self.values = []
+
+    def emit(self, value):
+        self.values.append(value)
+
+
+class ThreadPool:
+    # Runs the tasks in threads, with the interface of the shared process pool
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.restarts = 0
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def restart(self):
+        self.restarts += 1
+
+
+def make_session():
+    return SimpleNamespace(process_pool=ThreadPool(), loaded_files={}, loaded_files_paths=[])
+
+
+def run_loadfiles(session, filelist, stop_event=None, progress=None):
+    stop_event = threading.Event() if stop_event is None else stop_event
+    loadfiles(session, filelist, progress or Signal(), Signal(), Signal(), Signal(), stop_event)
+
+
+def test_failed_files_are_skipped(monkeypatch):
+    # load_single_file returns None for the files it could not load
+    monkeypatch.setattr(loadfiles_module, 'load_single_file', lambda path: None if path == 'bad' else (path, object()))
+    session = make_session()
+    progress = Signal()
+    run_loadfiles(session, ['a', 'bad', 'b'], progress=progress)
+    assert sorted(session.loaded_files) == ['a', 'b']
+    assert progress.values == [1, 2, 3]
+
+
+def test_cancel_does_not_wait_for_running_loads(monkeypatch):
+    release = threading.Event()
+
+    def load_single_file(path):
+        if path == 'slow':
+            release.wait(10)
+        return path, object()
+
+    monkeypatch.setattr(loadfiles_module, 'load_single_file', load_single_file)
+    session = make_session()
+    stop_event = threading.Event()
+    threading.Timer(0.5, stop_event.set).start()
+    t0 = time.perf_counter()
+    run_loadfiles(session, ['fast', 'slow'], stop_event)
+    elapsed = time.perf_counter() - t0
+    release.set()
+    assert elapsed < 2
+    assert list(session.loaded_files) == ['fast']
+
+
+def test_broken_pool_is_restarted_and_loaded_files_kept(monkeypatch):
+    def load_single_file(path):
+        if path == 'crash':
+            time.sleep(0.2)
+            raise BrokenProcessPool('A worker died')
+        return path, object()
+
+    monkeypatch.setattr(loadfiles_module, 'load_single_file', load_single_file)
+    session = make_session()
+    with pytest.raises(BrokenProcessPool):
+        run_loadfiles(session, ['a', 'crash'])
+    assert session.process_pool.restarts == 1
+    assert list(session.loaded_files) == ['a']
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from pyfmrheo.models.hertz import HertzModel
+from pyfmrheo.models.ting import TingModel
+from pyfmgui.results import (
+    HertzResultStore, TingResultStore, hertz_model_columns, ting_model_columns, write_columns
+)
+
+
+def make_hertz_result(E0=2000.0, slope=None):
+    hertz_result = HertzModel('paraboloid', 5e-6)
+    hertz_result.bec_model = 'Garcia'
+    hertz_result.fit_hline_flag = False
+    hertz_result.apply_bec_flag = True
+    hertz_result.n_params = 3
+    hertz_result.delta0 = -1e-7
+    hertz_result.E0 = E0
+    hertz_result.f0 = 1e-10
+    hertz_result.slope = slope
+    hertz_result.poisson_ratio = 0.5
+    hertz_result.sample_height = None
+    hertz_result.MAE = 1e-11
+    hertz_result.MSE = 1e-22
+    hertz_result.RMSE = 1e-11
+    hertz_result.Rsquared = 0.99
+    hertz_result.chisq = 2e-20
+    hertz_result.redchi = 1e-22
+    return hertz_result
+
+
+def make_ting_result(betaE=0.2):
+    ting_result = TingModel('paraboloid', 5e-6, 'analytical')
+    ting_result.bec_model = None
+    ting_result.fit_hline_flag = True
+    ting_result.apply_bec_flag = False
+    ting_result.n_params = 5
+    ting_result.t0 = 0.0
+    ting_result.E0 = 1500.0
+    ting_result.tc = 0.5
+    ting_result.betaE = betaE
+    ting_result.F0 = 1e-10
+    ting_result.poisson_ratio = 0.5
+    ting_result.vdrag = 0.0
+    ting_result.smooth_w = 5
+    ting_result.idx_tm = 120
+    ting_result.v0t = 1e-6
+    ting_result.v0r = None
+    ting_result.MAE = 1e-11
+    ting_result.MSE = 1e-22
+    ting_result.RMSE = 1e-11
+    ting_result.Rsquared = 0.98
+    ting_result.chisq = 2e-20
+    ting_result.redchi = 1e-22
+    return ting_result
+
+
+def assert_same_attributes(result, expected, columns):
+    for _, attribute, kind in columns:
+        value, expected_value = getattr(result, attribute), getattr(expected, attribute)
+        if kind in ('float', 'optional') and expected_value is not None:
+            assert value == pytest.approx(expected_value, nan_ok=True), attribute
+        else:
+            assert value == expected_value, attribute
+            assert type(value) is type(expected_value), attribute
+
+
+def test_hertz_store_round_trip():
+    store = HertzResultStore()
+    results = {0: make_hertz_result(), 3: make_hertz_result(E0=3000.0, slope=1e-3)}
+    for curve_idx, result in results.items():
+        store.add(curve_idx, result)
+    store.add(1, ValueError('fit failed'))
+    assert len(store) == 3
+    assert store.get(1) is None and store.get(2) is None
+    assert [curve_idx for curve_idx, _ in store] == [0, 1, 3]
+    for curve_idx, expected in results.items():
+        assert_same_attributes(store.get(curve_idx), expected, hertz_model_columns)
+        # The columns of the store rebuild the same model
+        row = {name: column[curve_idx] for name, column in store.data.items()}
+        rebuilt = write_columns(HertzModel('paraboloid', 5e-6), hertz_model_columns, row)
+        assert_same_attributes(rebuilt, expected, hertz_model_columns)
+
+
+def test_ting_store_round_trip():
+    store = TingResultStore()
+    results = {2: (make_ting_result(), make_hertz_result()), 5: (make_ting_result(betaE=0.3), make_hertz_result(slope=2e-3))}
+    for curve_idx, result in results.items():
+        store.add(curve_idx, result)
+    store.add(4, ValueError('fit failed'))
+    assert store.export_indices().tolist() == [2, 4, 5]
+    for curve_idx, (expected_ting, expected_hertz) in results.items():
+        ting_result, hertz_result = store.get(curve_idx)
+        assert_same_attributes(ting_result, expected_ting, ting_model_columns)
+        assert_same_attributes(hertz_result, expected_hertz, hertz_model_columns)
+
+
+def test_missing_flags_are_stored_as_disabled():
+    hertz_result = make_hertz_result()
+    hertz_result.apply_bec_flag = None
+    hertz_result.fit_hline_flag = None
+    store = HertzResultStore()
+    store.add(0, hertz_result)
+    assert not store.data['hertz_apply_BEC'][0]
+    assert not store.data['hertz_fit_hline_on_baseline'][0]
+    assert store.get(0).apply_bec_flag is False
+
+
+def test_error_replaces_result():
+    store = HertzResultStore(keep_objects=True)
+    store.add(0, make_hertz_result())
+    store.add(0, ValueError('fit failed'))
+    assert store.get(0) is None
+    assert isinstance(dict(store)[0], ValueError)
+    assert np.count_nonzero(store.filled) == 0
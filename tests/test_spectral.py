@@ -0,0 +1,118 @@
+import copy
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+
+from pyfmreader.utils.forcecurve import ForceCurve
+from pyfmreader.utils.segment import Segment
+from pyfmrheo.routines.PiezoCharacterization import doPiezoCharacterization
+from pyfmrheo.routines.ViscousDragSteps import doViscousDragSteps
+from pyfmrheo.routines.MicrorheologyFFT import doMicrorheologyFFT
+from pyfmrheo.routines.MicrorheologySine import doMicrorheologySine
+from pyfmgui.piezo_char import PiezoCharCalibration
+from pyfmgui.spectral import analyze_spectral_block
+
+reference_routines = {
+    'PiezoChar': doPiezoCharacterization,
+    'VDrag': doViscousDragSteps,
+    'Microrheo': doMicrorheologyFFT,
+    'MicrorheoSine': doMicrorheologySine
+}
+
+frequencies = [1, 2, 5, 10, 20]
+
+piezo_char = pd.DataFrame({
+    'frequency': frequencies,
+    'fi_degrees': [1.0, 2.0, 3.0, 4.0, -5.0],
+    'amp_quotient': [1.1, 1.0, 0.9, 1.2, 1.0]
+})
+
+
+def make_segment(segment_id, segment_type, time, zheight, vdeflection, metadata):
+    segment = Segment('synthetic', segment_id, segment_type)
+    segment.time, segment.zheight, segment.vdeflection = time, zheight, vdeflection
+    segment.segment_metadata = metadata
+    return segment
+
+
+def make_force_curve(rng, E0=1000.0, k=0.1, radius=5e-6, contact=1.5e-6):
+    # Approach following the Hertz model of a paraboloid, then a
+    # modulation in contact at each frequency, the deflection lags the
+    # piezo, and the retract steps used by the viscous drag.
+    fdc = ForceCurve(0, 'synthetic')
+    npts = 2000
+    zheight = np.linspace(0, 3e-6, npts)
+    deflection = np.zeros(npts)
+    for _ in range(50):
+        indentation = np.clip(zheight - contact - deflection, 0, None)
+        deflection = 4 / 3 * E0 / (1 - 0.5**2) * np.sqrt(radius) * indentation**1.5 / k
+    deflection = deflection + rng.normal(0, 1e-11, npts)
+    time = np.linspace(0, 1, npts)
+    fdc.extend_segments.append(('0', make_segment('0', 'Approach', time, zheight, deflection, {'duration': 1})))
+    for i, frequency in enumerate(frequencies):
+        npts = 4000
+        time = np.arange(npts) / 2000
+        zheight = 3e-6 + 1e-8 * np.sin(2 * np.pi * frequency * time) + rng.normal(0, 1e-12, npts)
+        deflection = deflection[-1] + 2e-9 * np.sin(2 * np.pi * frequency * time + 0.3) + rng.normal(0, 1e-12, npts)
+        segment = make_segment(str(i + 1), 'Modulation', time, zheight, deflection, {'frequency': frequency, 'ramp_size': 50})
+        fdc.modulation_segments.append((str(i + 1), segment))
+    for segment_id in ('9', '10'):
+        segment = make_segment(segment_id, 'Retract', time, zheight[::-1].copy(), deflection[::-1].copy(), {'ramp_size': 100})
+        fdc.retract_segments.append((segment_id, segment))
+    return fdc
+
+
+def make_params(method, piezo_char_data):
+    return {
+        'method': method, 'max_freq': 0, 'k': 0.1, 'piezo_char_data': piezo_char_data, 'corr_amp': True,
+        'curve_seg': 'extend', 'offset_type': 'percentage', 'max_offset': 0.3, 'min_offset': 0.01,
+        'correct_tilt': False, 'poc_method': 'RoV', 'poc_win': 350e-9, 'sigma': 3,
+        'contact_model': 'paraboloid', 'tip_param': 5e-6, 'fit_range_type': 'full', 'downsample_flag': False,
+        'pts_downsample': 300, 'fit_line': False, 'd0': 0, 'auto_init_E0': True, 'E0': 1000, 'f0': 0, 'slope': 0,
+        'bcoef': 1e-6, 'wc': None, 'poisson': 0.5
+    }
+
+
+def sine_wave_values(sine_wave):
+    # The amplitudes of the batched fits are always positive,
+    # a negative amplitude is the same wave shifted by pi.
+    amplitude, phase = sine_wave.amplitude, sine_wave.phase
+    if amplitude < 0:
+        amplitude, phase = -amplitude, phase + np.pi
+    return [amplitude, np.angle(np.exp(1j * phase)), sine_wave.offset]
+
+
+def assert_same_output(output, expected, name):
+    if isinstance(expected, (list, tuple)) and expected and hasattr(expected[0], 'amplitude'):
+        output = np.array([sine_wave_values(sine_wave) for sine_wave in output])
+        expected = np.array([sine_wave_values(sine_wave) for sine_wave in expected])
+        # The offsets of the detrended waves are about zero,
+        # they are compared relative to the amplitudes.
+        assert np.allclose(output[:, 2], expected[:, 2], rtol=0, atol=1e-4 * expected[:, 0].max()), name
+        output, expected = output[:, :2], expected[:, :2]
+    output, expected = np.asarray(output), np.asarray(expected)
+    assert output.shape == expected.shape, name
+    assert np.all(np.isfinite(expected)), name
+    assert np.allclose(output, expected, rtol=1e-4, atol=0), name
+
+
+@pytest.mark.parametrize('method', list(reference_routines))
+def test_block_matches_pyfmrheo(method):
+    rng = np.random.default_rng(0)
+    force_curves = [make_force_curve(rng, E0=E0) for E0 in (800.0, 1000.0, 1500.0)]
+    calibration = PiezoCharCalibration(
+        piezo_char['frequency'].values, piezo_char['fi_degrees'].values, piezo_char['amp_quotient'].values)
+    piezo_char_data = None if method == 'PiezoChar' else piezo_char
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = [
+            reference_routines[method](copy.deepcopy(fdc), make_params(method, piezo_char_data))
+            for fdc in force_curves
+        ]
+        results = analyze_spectral_block(force_curves, make_params(method, None if piezo_char_data is None else calibration))
+    for result, expected_result in zip(results, expected):
+        assert not isinstance(result, Exception), result
+        assert len(result) == len(expected_result)
+        for i, (output, expected_output) in enumerate(zip(result, expected_result)):
+            assert_same_output(output, expected_output, f'{method} output {i}')
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+import numpy as np
+
+import pyfmgui.compute as compute
+from pyfmgui.warm_start import get_tiles
+
+
+class FakeFile:
+    def __init__(self, nb_curves):
+        self.filemetadata = {
+            'file_path': 'map.spm', 'file_type': 'spm',
+            'Entry_filename': 'map.spm', 'Entry_tot_nb_curve': nb_curves
+        }
+        self.decoded = []
+
+    def getcurve(self, curve_idx):
+        self.decoded.append(curve_idx)
+        return SimpleNamespace(curve_index=curve_idx)
+
+
+class FakeDiskCache:
+    def __init__(self, curves):
+        self.curves = curves
+
+    def get(self, file_path, curve_idx, *params):
+        return self.curves.get(curve_idx)
+
+    def put(self, file_path, curve_idx, *params):
+        self.curves[curve_idx] = params[-1]
+
+
+def test_tile_fit_order_with_half_populated_cache(monkeypatch):
+    map_coords = np.arange(16).reshape((4, 4))
+    tiles = get_tiles(map_coords, 4, 16)
+    file = FakeFile(16)
+    # Every other curve of the tile was preprocessed before
+    cached = {idx: SimpleNamespace(curve_index=idx) for idx, _ in tiles[0][::2]}
+    fitted = []
+
+    def fake_fit_seeded(fdc, params, seed=None):
+        fitted.append((fdc.curve_index, seed is not None))
+        return SimpleNamespace(E0=1000.0, delta0=0.0, f0=0.0, slope=0.0)
+
+    monkeypatch.setattr(compute, 'get_worker_file', lambda file_path: file)
+    monkeypatch.setattr(compute, 'get_disk_cache', lambda: FakeDiskCache(cached))
+    monkeypatch.setattr(compute, 'preprocess_curve', lambda *args, **kwargs: None)
+    monkeypatch.setattr(compute, 'fit_seeded', fake_fit_seeded)
+
+    params = {'def_sens': None, 'height_channel': 'Height', 'method': 'HertzFit'}
+    chunk_results = compute.process_tile_chunk('map.spm', params, tiles)
+
+    tile_order = [idx for idx, _ in tiles[0]]
+    # Only the misses are decoded and the curves are fitted in the order
+    # of the tile, every curve but the first one starts from its neighbours.
+    assert file.decoded == tile_order[1::2]
+    assert [idx for idx, _ in fitted] == tile_order
+    assert [seeded for _, seeded in fitted] == [False] + [True] * 15
+    assert [result[1] for result in chunk_results[0]] == tile_order